@@ -14,17 +14,23 @@
 
 __lastedited__ = "2019-06-12 05:08:31"
 
-import sys, os, socket, subprocess, logging, argparse, time
+import sys, os, socket, logging, argparse, time, select, threading, shlex
 from collections import defaultdict
 import regd.util as util
 from regd.appsm.app import clc, declc, clp
 from regd.appsm.app import IKException, ErrorCode
 import regd.defs as defs
 import regd.appsm.app as app
-import regd.rgs as rgs
+# Server modules (regd.rgs) and subprocess are imported only by the commands 
+# which need them, so that client commands start faster.
 
 THISFILE = os.path.basename( __file__ )
 
+# Seconds to wait for a started server to begin accepting connections
+START_TIMEOUT = 30
+# Seconds to wait for a stopped server to exit
+STOP_TIMEOUT = 30
+
 USAGE = '''
 Usage:
 
@@ -43,7 +49,17 @@ remove-section <SECTION>   Remove section
 clear-session              Remove all session tokens
 load-file <FILENAME>       Read tokens from a file
 ls [SECTION] [--tree]      List tokens
+   [--stream]              (print large listings in parts as they arrive)
+export <SECTION> [-r]      Print section tokens as shell 'export' commands
+   [--null]                (or as NUL-terminated NAME=VALUE pairs)
+query <PREFIX> | <FROM> <TO>
+   [--limit N]             Print the tokens with path prefix or in path range
+   [--no-values]           (only the paths)
+find <PATTERN> [VALPATT]   Print the tokens whose paths (and values) match glob
+   [--regex] [--count]     or regex patterns, or only their number
+   [--limit N] [--no-values]
 show-log [N]               Show N last lines of the log file
+shell [FILE]               Execute commands read line by line from FILE or stdin
 
 For more information please read the regd manual.
 '''
@@ -80,12 +96,94 @@ def connectToServer( sockfile = None, host = None, port = None, tmout = 3 ):
 
 	return sock
 
+class ConnectionPool:
+	'''Pool of open connections to regd servers for reusing them between
+	commands. Connections are checked before reuse: a connection which is
+	readable while idle has been closed by the server (see 'keepalive_timeout'
+	in regd.conf) and is discarded.'''
+	def __init__( self, size = 4 ):
+		# Max number of idle connections kept for each server address
+		self.size = size
+		self.idle = {}
+		self.lock = threading.Lock()
+
+	def get( self, sockfile = None, host = None, port = None, tmout = 3 ):
+		'''Returns a connection to the server and the flag whether it's reused.'''
+		addr = ( sockfile, host, port )
+		while True:
+			with self.lock:
+				conns = self.idle.get( addr )
+				sock = conns.pop() if conns else None
+			if not sock:
+				return connectToServer( sockfile, host, port, tmout ), False
+			try:
+				r, _, _ = select.select( [sock], [], [], 0 )
+			except ( OSError, ValueError ):
+				r = True
+			if not r:
+				sock.settimeout( tmout )
+				return sock, True
+			sock.close()
+
+	def put( self, sock, sockfile = None, host = None, port = None ):
+		'''Returns a connection with no pending responses to the pool.'''
+		with self.lock:
+			conns = self.idle.setdefault( ( sockfile, host, port ), [] )
+			if len( conns ) < self.size:
+				conns.append( sock )
+				return
+		sock.close()
+
+	def close( self ):
+		with self.lock:
+			idle, self.idle = self.idle, {}
+		for conns in idle.values():
+			for sock in conns:
+				sock.close()
+
+def startServerProcess( opts, timeout = START_TIMEOUT ):
+	'''Runs the server start command line opts in a new process and waits till 
+	the server accepts connections. Returns False if the server has failed to 
+	start or isn't ready in timeout seconds.'''
+	import subprocess
+	rfd, wfd = os.pipe()
+	try:
+		subprocess.Popen( opts + [clp( defs.READY_FD ), str( wfd )], pass_fds = ( wfd, ) )
+		os.close( wfd )
+		wfd = None
+		r, _, _ = select.select( [rfd], [], [], timeout )
+		return bool( r ) and os.read( rfd, 1 ) == b'1'
+	finally:
+		os.close( rfd )
+		if wfd is not None:
+			os.close( wfd )
+
+def waitServerExit( sockfile = None, host = None, port = None, timeout = STOP_TIMEOUT ):
+	'''Waits till all the processes of a stopping server have exited and so have
+	released the instance lock. Returns False on timeout.'''
+	if host:
+		_, sockfile = util.get_filesock_addr( None, host + '_' + port )
+		sockfile += ".ip"
+	tm = time.monotonic() + timeout
+	while util.isInstanceRunning( sockfile ):
+		if time.monotonic() > tm:
+			return False
+		time.sleep( 0.02 )
+	return True
+
 def checkConnection( sockfile = None, host = None, port = None ):
 	'''Checks connection to server.'''
 	return Client( { "cmd": defs.CHECK_SERVER }, sockfile, host, port )[0]
 
-def Client( cpars, sockfile = None, host = None, port = None ):
-	'''"Client" function. Performs requests to a running server.'''
+def Client( cpars, sockfile = None, host = None, port = None, codec = None, compress = None,
+			pool = None ):
+	'''"Client" function. Performs requests to a running server. codec is
+	the wire codec: defs.CODEC_JSON (default) or defs.CODEC_BINARY. With 
+	compress large packets are sent compressed and the server is allowed to 
+	compress large responses; by default it's on for IP-based servers. With 
+	pool (ConnectionPool) the connection is taken from and returned to the pool.
+	A request which fails on a reused connection before any response is 
+	received is sent again on a new connection.'''
 	util.log.debug( "cpars={0}; sock={1}; host={2}; port={3}".format( 
 									cpars, sockfile, host, port ) )
 
@@ -96,39 +194,90 @@ def Client( cpars, sockfile = None, host = None, port = None ):
 	tmout = 10
 
 	try:
-		data = bytearray()
-		bpack = util.createPacket( cpars )
-		util.logcomm.debug( "sending packet: {0}".format( bpack ) )
-
+		bpack = util.createPacket( cpars, codec )
+		util.logcomm.debug( "sending packet: {0}".format( bpack[:1000] ) )
+		flag = None
+		if compress or ( compress is None and host ):
+			bpack, flag = util.compressPack( bpack )
+			flag = flag or util.HDR_ACCEPT_Z
+
+		sock = None
 		try:
-			sock = connectToServer( sockfile, host, port, tmout )
-			util.sendPack( sock, bpack )
-			util.recvPack( sock, data )
-		except IKException as e:
+			if pool:
+				sock, reused = pool.get( sockfile, host, port, tmout )
+			else:
+				sock, reused = connectToServer( sockfile, host, port, tmout ), False
+			try:
+				util.sendPack( sock, bpack, flag )
+				closed = reused and not sock.recv( 1, socket.MSG_PEEK )
+			except ( BrokenPipeError, ConnectionResetError ):
+				if not reused:
+					raise
+				closed = True
+			if closed:
+				# The server has closed the connection, which stayed idle too long
+				sock.close()
+				sock = connectToServer( sockfile, host, port, tmout )
+				util.sendPack( sock, bpack, flag )
+			data, flag = util.recvPacket( sock )
+			data = util.unpackData( data, flag )
+		except ( IKException, OSError ) as e:
+			if sock:
+				sock.close()
+			if isinstance( e, OSError ):
+				raise
 			return False, [str( e )]
 
-		util.logcomm.debug( "received packet: {0}".format( data ) )
+		util.logcomm.debug( "received packet: {0}".format( bytes( data[:1000] ) ) )
 
-		sock.shutdown( socket.SHUT_RDWR )
-		sock.close()
+		if pool:
+			pool.put( sock, sockfile, host, port )
+		else:
+			sock.shutdown( socket.SHUT_RDWR )
+			sock.close()
 		lres = []
-		if len( data ) < 11:
+		if not len( data ):
 			lres = ['0', 'Server returned empty response']
 		else:
-			lres = util.parsePacket( data[10:] )
+			lres = util.parsePacket( data )
 			util.logcomm.debug( "parsed packet: {0}".format( lres ) )
-		if len( lres ) == 2:
-			if type( lres[1] ) is list and len( lres[1] ) == 1:
-				ret = lres[1][0]
-			else:
-				ret = lres[1]
-		else:
-			ret = lres[1:] 
-		return ( lres[0] == '1', ret )
+		return util.unpackResponse( lres )
 	except OSError as er:
 		return False, ["regd: Client: Socket error {0}: {1}\nsockfile: {2}; host: {3}; port: {4}".format( 
 												er.errno, er.strerror, sockfile, host, port )]
 
+def ClientStream( cpars, sockfile = None, host = None, port = None, codec = None, compress = None ):
+	'''Generator version of Client() for commands with the 'stream' option. 
+	Yields ( result, items ) pairs for the frames of the response as they 
+	arrive. The stream ends after an empty frame or an error.'''
+	bpack = util.createPacket( cpars, codec )
+	flag = None
+	if compress or ( compress is None and host ):
+		bpack, flag = util.compressPack( bpack )
+		flag = flag or util.HDR_ACCEPT_Z
+
+	try:
+		sock = connectToServer( sockfile, host, port, 10 )
+	except IKException as e:
+		yield False, [str( e )]
+		return
+	try:
+		util.sendPack( sock, bpack, flag )
+		while True:
+			data, flag = util.recvPacket( sock )
+			data = util.unpackData( data, flag )
+			lres = util.parsePacket( data )
+			if lres[0] != '1':
+				yield False, lres[1]
+				return
+			if not lres[1]:
+				return
+			yield True, lres[1]
+	except ( IKException, OSError ) as e:
+		yield False, [str( e )]
+	finally:
+		sock.close()
+
 def isServerCmd( cpars ):
 	'''Checks whether the command is solely for communicating with server.'''
 	cmd = cpars.get( "cmd", None )
@@ -141,15 +290,14 @@ def isServerCmd( cpars ):
 			return True
 	return False
 
-def doServerCmd( copts, sockfile, host, port ):
+def doServerCmd( copts, sockfile, host, port, codec = None, pool = None ):
 	'''Calls Client() with some pre- and postprocessing.'''
 
 	if copts["cmd"] == defs.LOAD_FILE and not copts.get( "server_side", None ):
 		files = []
 		for fname in copts["params"]:
 			if not os.path.exists( fname ):
-				print( "File not found: ", fname )
-				return -1
+				return False, "File not found: " + fname
 			with open( fname ) as f:
 				files.append( f.read() )
 
@@ -159,21 +307,18 @@ def doServerCmd( copts, sockfile, host, port ):
 	elif copts["cmd"] == defs.COPY_FILE:
 		if len( copts["params"] ) != 2 or \
 			len( copts["params"][0] ) == 0 or len( copts["params"][1] ) == 0:
-			print( "'cp' command requires two parameters." )
-			return 1
+			return False, "'cp' command requires two parameters."
 		src = copts["params"][0]
 		dst = copts["params"][1]
 		writeFile = None
 		if src[0] == ':':
 			if copts["server_side"]:
-				print( "Destination file cannot be on server side." )
-				return 1
+				return False, "Destination file cannot be on server side."
 			else:
 				writeFile = dst
 		if dst[0] == ':' and not copts["server_side"]:
 			if not os.path.exists( src ):
-				print( "File not found: ", src )
-				return 1
+				return False, "File not found: " + src
 			with open( src ) as f:
 				copts["params"][0] = f.read()
 
@@ -184,7 +329,7 @@ def doServerCmd( copts, sockfile, host, port ):
 	if not copts:
 		copts = None
 
-	res, ret = Client( copts, sockfile, host, port )
+	res, ret = Client( copts, sockfile, host, port, codec, pool = pool )
 
 	# Postprocessing
 
@@ -195,11 +340,36 @@ def doServerCmd( copts, sockfile, host, port ):
 					with open( writeFile, "w" ) as f:
 						f.write( ret )
 				except Exception:
-					print( "0Error: Failed storing query result to file '{0}'".format( writeFile ) )
-					return -1
+					return False, "Error: Failed storing query result to file '{0}'".format( writeFile )
 
 	return res, ret
 
+def runShell( fin, parseLine, sockfile, host, port ):
+	'''Executes commands read line by line from fin over one connection to 
+	the server and prints one result line per command. Empty lines and lines
+	starting with '#' are skipped. parseLine converts a command line to the 
+	command parameters.'''
+	pool = ConnectionPool( 1 )
+	try:
+		for line in fin:
+			line = line.strip()
+			if not line or line[0] == '#':
+				continue
+			try:
+				cpars = parseLine( line )
+			except ( SystemExit, ValueError ):
+				print( "0Error: cannot parse command: " + line, flush = True )
+				continue
+			cpars.pop( defs.STREAM, None )
+			if not isServerCmd( cpars ) or cpars["cmd"] in ( defs.START_SERVER, defs.RESTART_SERVER ):
+				print( "0Error: command '{0}' is not available in shell mode.".format( 
+					clc( cpars["cmd"] ) ), flush = True )
+				continue
+			res, ret = doServerCmd( cpars, sockfile, host, port, pool = pool )
+			print( util.formatResult( res, ret ), flush = True )
+	finally:
+		pool.close()
+
 def main( *kwargs ):
 	'''main()'''
 	# pylint: disable=too-many-branches,too-many-statements,
@@ -248,6 +418,7 @@ def main( *kwargs ):
 	parser.add_argument( clp( defs.LOG_LEVEL ), default = 'WARNING', help = 'DEBUG, INFO, WARNING, ERROR, CRITICAL' )
 	parser.add_argument( clp( defs.LOG_TOPICS ), help = 'For debugging purposes.' )
 	parser.add_argument( clp( defs.SERVER_NAME ), help = 'The name of the server instance.' )
+	parser.add_argument( clp( defs.READY_FD ), type = int, help = "File descriptor to which the started server writes '1' when it accepts connections." )
 	parser.add_argument( clp( defs.HOST ), help = 'Run the server on an Internet socket with the specified hostname.' )
 	parser.add_argument( clp( defs.PORT ), help = 'Run the server on an Internet socket with the specified port.' )
 	parser.add_argument( clp( defs.ACCESS ), help = 'Access level for the server: secure, private, public_read or public.' )
@@ -265,6 +436,12 @@ def main( *kwargs ):
 	parser.add_argument( clp( defs.ATTRS ), "-a", action = CmdParam, help = "Token attributes." )
 	parser.add_argument( clp( defs.RECURS ), "-r", action = CmdSwitch, nargs = 0, help = "Apply the command recursively." )
 	parser.add_argument( clp( defs.SUM ), action = CmdSwitch, nargs = 0, help = "Sum up the token with the existing value." )
+	parser.add_argument( clp( defs.STREAM ), action = CmdSwitch, nargs = 0, help = "Receive the output in parts as it's produced (for 'ls')." )
+	parser.add_argument( clp( defs.NULL ), action = CmdSwitch, nargs = 0, help = "Output NUL-terminated NAME=VALUE pairs (for 'export')." )
+	parser.add_argument( clp( defs.LIMIT ), action = CmdParam, help = "Maximum number of tokens to output (for 'query' and 'find')." )
+	parser.add_argument( clp( defs.REGEX ), action = CmdSwitch, nargs = 0, help = "Patterns are regular expressions (for 'find')." )
+	parser.add_argument( clp( defs.COUNT ), action = CmdSwitch, nargs = 0, help = "Output only the number of matches (for 'find')." )
+	parser.add_argument( clp( defs.NOVALUES ), action = CmdSwitch, nargs = 0, help = "Output token names without values." )
 
 	args = parser.parse_args( *kwargs )
 
@@ -356,29 +533,6 @@ def main( *kwargs ):
 
 	if args.auto_start:
 		raise Exception("No autostart")
-		if not checkConnection( _sockfile, host, port ):
-			opts = [__file__, defs.START_SERVER]
-			if host:
-				opts.append( "--host" );
-				opts.append( host )
-			if port:
-				opts.append( "--port" );
-				opts.append( port )
-			if args.server_name:
-				opts.append( "--server-name" );
-				opts.append( args.server_name )
-			if args.access:
-				opts.append( "--access" );
-				opts.append( args.access )
-			if args.datafile:
-				opts.append( "--datafile" );
-				opts.append( args.datafile )
-			if args.log_level:
-				opts.append( "--log-level" );
-				opts.append( args.log_level )
-			log.info( "The server isn't running. Autostarting with arguments:%s" % ( str( opts ) ) )
-			subprocess.Popen( opts )
-			time.sleep( 2 )
 
 	if cmd == defs.START_SERVER:
 		# Setting up start configuration
@@ -394,6 +548,10 @@ def main( *kwargs ):
 			print( "Error: cannot create temporary file socket directory. Exiting." )
 			return -1
 
+		if util.isInstanceRunning( _sockfile ):
+			print( "Error: the server is already running." )
+			return 1
+
 		# Permission level
 
 		if args.access:
@@ -471,7 +629,9 @@ def main( *kwargs ):
 
 		log.info( "Starting server %s : %s, access: %s " % (( servername, host )[bool( host )], 
 								( _sockfile, port )[bool( host )], args.access ) )
-		return rgs.startRegistry( servername, _sockfile, host, port, acc, datafile, binsect )
+		import regd.rgs as rgs
+		return rgs.startRegistry( servername, _sockfile, host, port, acc, datafile, binsect,
+								args.ready_fd )
 
 	elif cmd == defs.STOP_SERVER:
 		res, _ = Client( { "cmd": defs.STOP_SERVER }, _sockfile, host, port )
@@ -479,6 +639,9 @@ def main( *kwargs ):
 			if not args.no_verbose:
 				util.log.error( "cmd 'stop': Cannot contact server." )
 			return -1
+		if not waitServerExit( _sockfile, host, port ):
+			util.log.error( "cmd 'stop': The server hasn't exited in {0} seconds.".format( STOP_TIMEOUT ) )
+			return -1
 
 	elif cmd == defs.RESTART_SERVER:
 		bresAcc, retAcc = Client( { "cmd": defs.REPORT, "params":[defs.ACCESS] }, _sockfile, host, port )
@@ -497,9 +660,40 @@ def main( *kwargs ):
 				"Server has been stopped and not restarted." )
 			return -1
 
-		time.sleep( 3 )
+		if not waitServerExit( _sockfile, host, port ):
+			log.error( "cmd 'restart': The server hasn't exited in {0} seconds.".format( STOP_TIMEOUT ) )
+			return -1
+
+		import regd.rgs as rgs
+		return rgs.startRegistry( servername, _sockfile, host, port, int( retAcc ), retDf,
+								readyFd = args.ready_fd )
 
-		return rgs.startRegistry( servername, _sockfile, host, port, int( retAcc ), retDf )
+	elif cmd == defs.LIST and cmdoptions.get( defs.STREAM ):
+		started = False
+		for res, ret in ClientStream( cmdoptions, _sockfile, host, port ):
+			if not res:
+				print( "0", ret )
+				return -1
+			if not started:
+				print( '1' )
+				started = True
+			util.printObject( ret )
+		if not started:
+			print( '1' )
+
+	elif cmd == defs.SHELL:
+		def parseLine( line ):
+			cmdoptions.clear()
+			lineargs = parser.parse_args( shlex.split( line ) )
+			cmdoptions["cmd"] = declc( lineargs.cmd )
+			cmdoptions["params"] = lineargs.params
+			return dict( cmdoptions )
+
+		if args.params and args.params[0] != '-':
+			with open( args.params[0] ) as f:
+				runShell( f, parseLine, _sockfile, host, port )
+		else:
+			runShell( sys.stdin, parseLine, _sockfile, host, port )
 
 	elif isServerCmd( cmdoptions ):
 		res, ret = doServerCmd( cmdoptions, _sockfile, host, port )
@@ -507,18 +701,47 @@ def main( *kwargs ):
 		# Postprocessing
 
 		if not res:
-			if ret[0] != '0':
+			if cmd == defs.EXPORT:
+				# The output of 'export' is meant for 'eval'
+				print( "0", ret, file = sys.stderr )
+			elif ret[0] != '0':
 				print( "0", ret )
 			else:
 				print( ret )
 			return -1
 
+		if cmd == defs.EXPORT:
+			if cmdoptions.get( defs.NULL ):
+				sys.stdout.write( ret )
+			elif ret:
+				print( ret if type( ret ) is str else "\n".join( ret ) )
+			return 0
+
 		print( '1' )
 		if ret:
 			util.printObject( ret )
 
 	# Local commands
 
+	elif cmd in defs.local_cmds:
+		import subprocess
+		if cmd == defs.TEST_CONFIGURE:
+			subprocess.call( ["python", tsthelp, "--test-configure"] )
+
+		elif cmd == defs.TEST_START:
+			print( "\nIt's recommended to shutdown all regd server instances before testing." )
+			ans = input( "\nPress 'Enter' to begin test, or 'q' to quit." )
+			if ans and ans in 'Qq':
+				return 0
+			print( "Setting up test, please wait..." )
+			subprocess.call( ["python", "-m", "unittest", "regd.testing.tests.currentTest"] )
+
+		elif cmd == defs.TEST_MULTIUSER_BEGIN:
+			subprocess.Popen( [tsthelp, "--test-multiuser-begin"] )
+
+		elif cmd == defs.TEST_MULTIUSER_END:
+			subprocess.Popen( [tsthelp, "--test-multiuser-end"] )
+
 	elif cmd == defs.SHOW_LOG:
 		with open( logfile, "r" ) as f:
 			ls = f.readlines()[-int( args.show_log ):]
@@ -527,23 +750,6 @@ def main( *kwargs ):
 	elif cmd == defs.VERS:
 		print( "Regd version on client: " + defs.__version__ )
 
-	elif cmd == defs.TEST_CONFIGURE:
-		subprocess.call( ["python", tsthelp, "--test-configure"] )
-
-	elif cmd == defs.TEST_START:
-		print( "\nIt's recommended to shutdown all regd server instances before testing." )
-		ans = input( "\nPress 'Enter' to begin test, or 'q' to quit." )
-		if ans and ans in 'Qq':
-			return 0
-		print( "Setting up test, please wait..." )
-		subprocess.call( ["python", "-m", "unittest", "regd.testing.tests.currentTest"] )
-
-	elif cmd == defs.TEST_MULTIUSER_BEGIN:
-		subprocess.Popen( [tsthelp, "--test-multiuser-begin"] )
-
-	elif cmd == defs.TEST_MULTIUSER_END:
-		subprocess.Popen( [tsthelp, "--test-multiuser-end"] )
-
 
 	return 0
 
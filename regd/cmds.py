@@ -15,6 +15,8 @@ __lastedited__ = "2016-07-27 07:09:24"
 
 import io, traceback
 from datetime import datetime
+from multiprocessing.connection import wait
+from types import GeneratorType
 from regd.appsm.app import IKException, ErrorCode
 import regd.defs as df
 import regd.util as util
@@ -115,24 +117,52 @@ class CmdProcessor:
 		return hnd( cmd )
 
 	def listenForMessages(self, func):
+		'''Serves tagged requests arriving on the connection or list of 
+		connections in self.conn. func is called when no request arrives for 30
+		seconds. Replies are ( request id, response, more ) tuples: a handler may 
+		return a generator of response frames, which are sent with more=True 
+		and followed by ( request id, None, False ).'''
+		conns = self.conn if isinstance( self.conn, list ) else [self.conn]
 		while self.cont:
-			if self.conn.poll(30):
+			ready = wait( conns, 30 )
+			if not ready:
+				func()
+				continue
+			for conn in ready:
 				try:
-					cmd = self.conn.recv()
+					rid, cmd, codec = conn.recv()
+					util.setCodec( codec )
 					try:
 						resp = self.processCmd( cmd )
 					except IKException as e:
 						resp = util.composeResponse( "0", "In listenForMessages - exception received: {0}. Continue listening...".format( e ) )
 						log.error( resp  )
-					self.conn.send( resp )
+					except Exception as e:
+						# A failed command must not stop serving the other ones
+						fh = io.StringIO()
+						traceback.print_exc( file=fh )
+						log.error( "In listenForMessages - exception in command {0}: {1}".format( 
+							cmd["cmd"], fh.getvalue() ) )
+						resp = util.composeResponse( "0", "Internal error in command {0}: {1}".format( 
+							cmd["cmd"], e ) )
+					if isinstance( resp, GeneratorType ):
+						for frame in resp:
+							conn.send( ( rid, frame, True ) )
+						resp = None
+					conn.send( ( rid, resp, False ) )
+					self.onReplied( cmd )
 				except Exception as e:
 					fh = io.StringIO()
 					traceback.print_exc( file=fh )
 					log.error( "In listenForMessages - fatal exception received: {0}. Quit listening...".format( fh.getvalue() ) )
 					raise
-			else:
-				func()
+				if not self.cont:
+					break
 	
+	def onReplied( self, cmd ):
+		'''Called in listenForMessages after the response to cmd has been sent.'''
+		pass
+
 	@classmethod
 	def registerGroupHandlers( cls, func ):
 		cmdNames = [x[0] for x in cls.cmdDefs]
@@ -12,16 +12,23 @@
 '''
 __lastedited__ = "2017-07-06 13:41:03"
 
-import os, subprocess as sp, time
+import os, time, threading, itertools, asyncio
+from collections import OrderedDict
 import regd.defs as defs, regd.cli as cli
 import regd.util as util
 from regd.util import log
-from regd.appsm.app import IKException, clp
+from regd.appsm.app import IKException, ErrorCode, clp
+from regd.defs import SESPATH
 
 rc = "regd"
 
-def regdcmd( cpars, addr = None, servername = None, host = None, port = None ):
-	'''Adapter for the Client() for using from other packages.'''
+# Commands after which the client cache needn't be checked for changes
+read_cmds = ( defs.GET_ITEM, defs.LIST, defs.IF_PATH_EXISTS, defs.GETATTR, defs.CHECK_SERVER,
+			defs.WATCH, defs.EXPORT, defs.QUERY, defs.FIND )
+
+def serverAddress( addr = None, servername = None, host = None, port = None ):
+	'''Returns the socket file, host and port of the server from the address in
+	the form "host:port" or "servername", or from the server name, host and port.'''
 	sockfile = None
 	if addr:
 		if addr.find( ":" ) != -1:
@@ -32,25 +39,105 @@ def regdcmd( cpars, addr = None, servername = None, host = None, port = None ):
 			servername = addr
 
 	if not host:
-		try:
-			atuser, servername = util.parse_server_name( servername )
-		except IKException as e:
-			print( e )
-			return e.code
-
+		atuser, servername = util.parse_server_name( servername )
 		if not servername:
 			servername = "regd"
 
 		_, sockfile = util.get_filesock_addr( atuser, servername )
 
-	res, ret = cli.doServerCmd( cpars, sockfile, host, port )
+	return sockfile, host, port
+
+def regdcmd( cpars, addr = None, servername = None, host = None, port = None, codec = None,
+			pool = None ):
+	'''Adapter for the Client() for using from other packages.'''
+	try:
+		sockfile, host, port = serverAddress( addr, servername, host, port )
+	except IKException as e:
+		print( e )
+		return e.code
+
+	res, ret = cli.doServerCmd( cpars, sockfile, host, port, codec, pool )
 	util.logcomm.debug( "regdcmd: res: {0} ; ret: {1}".format( res, ret ) )
 
 	return res, ret
 
+class TokenCache:
+	'''LRU cache of token values with per-entry time to live. Entries are keyed 
+	by the absolute token path. The cache is kept coherent with the server by the 
+	'watch' command: the paths changed on the server since the previous check are 
+	invalidated before an entry is used, at most once in syncInterval seconds.'''
+	def __init__( self, size, ttl = 60, syncInterval = 1.0 ):
+		self.size = size
+		self.ttl = ttl
+		self.syncInterval = syncInterval
+		# path -> ( value, expiry time )
+		self.items = OrderedDict()
+		# The server's change number at the last check
+		self.changeNum = None
+		self.lastSync = 0
+		self.lock = threading.Lock()
+
+	def get( self, path ):
+		'''Returns a pair: whether the path is cached, and the value.'''
+		with self.lock:
+			item = self.items.get( path )
+			if not item:
+				return False, None
+			if item[1] < time.monotonic():
+				del self.items[path]
+				return False, None
+			self.items.move_to_end( path )
+			return True, item[0]
+
+	def put( self, path, val, changeNum ):
+		'''Caches the value which was read when the last check returned changeNum.'''
+		with self.lock:
+			if changeNum != self.changeNum:
+				# The value may be older than the invalidations since then
+				return
+			self.items[path] = ( val, time.monotonic() + self.ttl )
+			self.items.move_to_end( path )
+			if len( self.items ) > self.size:
+				self.items.popitem( last = False )
+
+	def invalidate( self, path ):
+		'''Removes the path and all the paths under it.'''
+		with self.lock:
+			if path == "/":
+				self.items.clear()
+				return
+			self.items.pop( path, None )
+			prefix = path + "/"
+			for k in [x for x in self.items if x.startswith( prefix )]:
+				del self.items[k]
+
+	def update( self, changeNum, paths ):
+		'''Applies the response of the 'watch' command.'''
+		if self.changeNum is None:
+			paths = ["/"]
+		for path in paths:
+			self.invalidate( path )
+		with self.lock:
+			self.changeNum = changeNum
+			self.lastSync = time.monotonic()
+
+	def clear( self ):
+		with self.lock:
+			self.items.clear()
+			self.changeNum = None
+			self.lastSync = 0
+
 class RegdComm:
-	def __init__( self, servAddr = None, servername = None, host = None, port = None, datafile = None, acc = None ):
+	def __init__( self, servAddr = None, servername = None, host = None, port = None, datafile = None, acc = None,
+				codec = None, poolSize = 0, cacheSize = 0, cacheTtl = 60, cacheSync = 1.0 ):
 		self.servAddr = servAddr
+		# Wire codec: defs.CODEC_JSON (default) or defs.CODEC_BINARY
+		self.codec = codec
+		# Number of open connections reused by commands; poolSize = 0 - a new 
+		# connection for each command
+		self.pool = cli.ConnectionPool( poolSize ) if poolSize else None
+		# Cache of getToken() results; cacheSize = 0 - no cache
+		self.cache = TokenCache( cacheSize, cacheTtl, cacheSync ) if cacheSize else None
 		self.servName = servername
 		self.host = host
 		self.port = port
@@ -81,30 +168,61 @@ class RegdComm:
 				args.append( "--datafile" )
 				args.append( self.datafile )
 
-			sp.Popen( args )
-			time.sleep( 2 )
+			if not cli.startServerProcess( args ):
+				return False, "Server failed to start."
 			res = True
 			ret = "Server started successfully."
-		except sp.CalledProcessError as e:
+		except OSError as e:
 			res = False
-			ret = "{0} {1} {2} {3}".format( rc, defs.START_SERVER, "returned non-zero:", e.output )
-
-		if res:
-			res, _ = self.checkServer()
-			if not res:
-				return False, "Server failed to start."
+			ret = "{0} {1} {2} {3}".format( rc, defs.START_SERVER, "failed:", e )
 
 		return res, ret
 
 	def sendCmd( self, m, args = None, kwargs = None ):
 		util.addArgsToMap( m, args, kwargs )
+		cmds = ( m.get( "params" ) or [] ) if m["cmd"] == defs.BATCH else [m]
+		if self.cache and [x for x in cmds if x.get( "cmd" ) not in read_cmds]:
+			# Own changes must be seen by the next cached read
+			self.cache.lastSync = 0
+		return self._request( m )
+
+	def _request( self, m ):
+		'''Sends the command to the server and returns the result and the content
+		of the response.'''
 		return regdcmd( m, addr = self.servAddr, servername = self.servName,
-						host = self.host, port = self.port )
+						host = self.host, port = self.port, codec = self.codec, pool = self.pool )
+
+	def syncCache( self ):
+		'''Invalidates the cache entries changed on the server if the last check
+		is older than the cache's syncInterval. Returns False if the cache cannot 
+		be used.'''
+		cache = self.cache
+		if time.monotonic() - cache.lastSync < cache.syncInterval:
+			return True
+		m = { "cmd": defs.WATCH }
+		if cache.changeNum is not None:
+			m["params"] = [cache.changeNum]
+		res, ret = self.sendCmd( m )
+		if not res:
+			cache.clear()
+			return False
+		if type( ret ) is not list:
+			# Client() unwraps one-element lists
+			ret = [ret]
+		cache.update( ret[0], ret[1:] )
+		return True
+
+	def close( self ):
+		'''Closes the pooled connections.'''
+		if self.pool:
+			self.pool.close()
+		if self.cache:
+			self.cache.clear()
 
 	def checkServer( self ):
 		try:
 			res, ret = regdcmd( { "cmd": defs.CHECK_SERVER }, addr = self.servAddr, servername = self.servName,
-							host = self.host, 	port = self.port )
+							host = self.host, 	port = self.port, pool = self.pool )
 		except IKException as e:
 			res = False
 			ret = str( e )
@@ -123,7 +241,10 @@ class RegdComm:
 		try:
 			res, ret = regdcmd( { "cmd": defs.STOP_SERVER }, addr = self.servAddr, servername = self.servName,
 							host = self.host, 	port = self.port )
-			time.sleep( 2 )
+			if res is True:
+				sockfile, host, port = serverAddress( self.servAddr, self.servName, self.host, self.port )
+				if not cli.waitServerExit( sockfile, host, port ):
+					res, ret = False, "Server hasn't exited."
 		except IKException as e:
 			res = False
 			ret = str( e )
@@ -157,16 +278,55 @@ class RegdComm:
 		m = { "cmd": defs.LOAD_FILE, "params": [fname] }
 		return self.sendCmd( m, args, kwargs )
 
-	def addToken( self, nam, val, *args, **kwargs ):
+	@staticmethod
+	def _tokenStr( nam, val ):
 		if val:
-			token = "{0} = {1}".format( nam, val )
-		else:
-			token = nam
-		m = { "cmd": defs.ADD_TOKEN, "params": [token] }
+			return "{0} = {1}".format( nam, val )
+		return nam
+
+	@staticmethod
+	def _cachePath( nam ):
+		return nam if nam.startswith( "/" ) else SESPATH + "/" + nam
+
+	def addToken( self, nam, val, *args, **kwargs ):
+		m = { "cmd": defs.ADD_TOKEN, "params": [self._tokenStr( nam, val )] }
 		return self.sendCmd( m, args, kwargs )
 
+	def addMany( self, mapping, force = False, pers = False ):
+		'''Adds the tokens from the name -> value mapping in one request. Tokens
+		are added independently of each other. Returns the result (False if any of
+		the tokens was not added) and the dictionary of the error messages keyed by 
+		the names of the tokens which were not added.'''
+		cmds = []
+		for nam, val in mapping.items():
+			m = { "cmd": defs.ADD_TOKEN, "params": [self._tokenStr( nam, val )] }
+			if force:
+				m[defs.FORCE] = True
+			if pers:
+				m[defs.PERS] = True
+			cmds.append( m )
+		if not cmds:
+			return True, {}
+		res, ret = self.batch( cmds )
+		if not res:
+			ret = [['0', ret]] * len( cmds )
+		errors = { nam: r[1] for nam, r in zip( mapping, ret ) if r[0] != '1' }
+		return not errors, errors
+
 	def getToken( self, nam, *args, **kwargs ):
 		m = { "cmd": defs.GET_ITEM, "params": [nam] }
+		if self.cache and not args and set( kwargs ) <= { "default" } and self.syncCache():
+			path = self._cachePath( nam )
+			found, ret = self.cache.get( path )
+			if found:
+				return True, ret
+			changeNum = self.cache.changeNum
+			res, ret = self.sendCmd( m )
+			if res:
+				self.cache.put( path, ret, changeNum )
+			elif "default" in kwargs:
+				ret = kwargs["default"]
+			return res, ret
 		if "default" not in kwargs:
 			return self.sendCmd( m, args, kwargs )
 		else:
@@ -177,13 +337,72 @@ class RegdComm:
 				ret = defRet
 			return res, ret
 
+	def getMany( self, paths, *args, **kwargs ):
+		'''Gets the values of several tokens in one request. Returns the result 
+		(False if any of the tokens was not read), the dictionary of values keyed 
+		by path and the dictionary of the error messages keyed by the paths which
+		were not read. With the 'default' keyword argument the paths which were not 
+		read are also included in the values with this value.'''
+		hasDefault = "default" in kwargs
+		defRet = kwargs.pop( "default", None )
+		useCache = self.cache and not args and not kwargs and self.syncCache()
+		values = {}
+		errors = {}
+		todo = []
+		for nam in dict.fromkeys( paths ):
+			if useCache:
+				found, ret = self.cache.get( self._cachePath( nam ) )
+				if found:
+					values[nam] = ret
+					continue
+			todo.append( nam )
+		if not todo:
+			return True, values, errors
+
+		changeNum = self.cache.changeNum if useCache else None
+		cmds = []
+		for nam in todo:
+			m = { "cmd": defs.GET_ITEM, "params": [nam] }
+			util.addArgsToMap( m, args, kwargs )
+			cmds.append( m )
+		res, ret = self.batch( cmds )
+		if not res:
+			ret = [['0', ret]] * len( cmds )
+		for nam, r in zip( todo, ret ):
+			if r[0] == '1':
+				values[nam] = r[1]
+				if useCache:
+					self.cache.put( self._cachePath( nam ), r[1], changeNum )
+			else:
+				errors[nam] = r[1]
+				if hasDefault:
+					values[nam] = defRet
+		return not errors, values, errors
+
 	def getTokenSec( self, nam, *args, **kwargs ):
 		m = { "cmd": defs.GET_ITEM, "params": [nam] }
 		return self.sendCmd( m, args, kwargs )
 
+	def batch( self, cmds, *args, **kwargs ):
+		'''Sends a list of command dictionaries in one packet. Returns the result 
+		and the list of [result code, content] for each command.'''
+		m = { "cmd": defs.BATCH, "params": cmds }
+		res, ret = self.sendCmd( m, args, kwargs )
+		if res and len( cmds ) == 1:
+			# Client() unwraps one-element lists
+			ret = [ret]
+		return res, ret
+
+	def transaction( self, cmds, *args, **kwargs ):
+		'''Sends a list of add, rm, rmdir and mkdir command dictionaries, which 
+		are executed all or none.'''
+		m = { "cmd": defs.TRANSACTION, "params": cmds }
+		return self.sendCmd( m, args, kwargs )
+
 	def createSection( self, path ):
 		return regdcmd( { "cmd": defs.CREATE_SECTION, "params": path }, addr = self.servAddr,
-						servername = self.servName, host = self.host, port = self.port )
+						servername = self.servName, host = self.host, port = self.port, codec = self.codec,
+						pool = self.pool )
 
 	def rename( self, src, dst, *args, **kwargs ):
 		m = { "cmd": defs.RENAME, "params": [src, dst] }
@@ -193,3 +412,163 @@ class RegdComm:
 		s = "{0}".format( time.strftime( "%m-%d %H:%M:%S" ) )
 		return self.addToken( "/sav/log/" + logName + s, message, defs.SUM )
 
+
+class AsyncRegdComm:
+	'''asyncio counterpart of RegdComm. Commands are sent over one connection, 
+	which is opened on the first command and reopened after it's lost. Each 
+	packet is tagged with a request id, so any number of commands can be awaited 
+	concurrently: an asyncio mode server executes them concurrently, a process 
+	mode server in the order of arrival.'''
+	def __init__( self, servAddr = None, servername = None, host = None, port = None, 
+				codec = None, compress = None, timeout = 10 ):
+		self.servAddr = servAddr
+		self.servName = servername
+		self.host = host
+		self.port = port
+		# Wire codec: defs.CODEC_JSON (default) or defs.CODEC_BINARY
+		self.codec = codec
+		# Compression of large packets, by default on for IP-based servers
+		self.compress = compress
+		self.timeout = timeout
+		self.reader = None
+		self.writer = None
+		self.readTask = None
+		# Request id -> future of the response
+		self.pending = {}
+		self.rids = itertools.count( 1 )
+		self.lock = asyncio.Lock()
+
+	async def __aenter__( self ):
+		return self
+
+	async def __aexit__( self, exc_type, exc_val, exc_tb ):
+		await self.close()
+
+	async def connect( self ):
+		'''Opens the connection if it's not open.'''
+		async with self.lock:
+			if self.writer and not self.writer.is_closing():
+				return
+			sockfile, host, port = serverAddress( self.servAddr, self.servName, self.host, 
+												self.port )
+			try:
+				if host:
+					self.reader, self.writer = await asyncio.wait_for( 
+							asyncio.open_connection( host, int( port ) ), self.timeout )
+				else:
+					self.reader, self.writer = await asyncio.wait_for( 
+							asyncio.open_unix_connection( sockfile ), self.timeout )
+			except ( OSError, asyncio.TimeoutError ) as e:
+				raise IKException( ErrorCode.cannotConnectToServer, 
+						"sockfile: {0}; host: {1}; port: {2}".format( sockfile, host, port ), 
+						str( e ) )
+			self.readTask = asyncio.ensure_future( self._readResponses( self.reader ) )
+
+	async def _readResponses( self, reader ):
+		'''Resolves the futures of the pending requests with the responses.'''
+		err = "Connection is closed by server"
+		try:
+			while True:
+				try:
+					hdr = await reader.readexactly( 10 )
+				except asyncio.IncompleteReadError:
+					break
+				packlen, flag = util.packHeader( hdr )
+				data = util.unpackData( await reader.readexactly( packlen ), flag )
+				resp = util.parsePacket( data )
+				fut = self.pending.pop( resp.get( defs.REQUEST_ID ), None ) \
+								if type( resp ) is dict else None
+				if fut is None:
+					log.error( "AsyncRegdComm: response to unknown request: {0}".format( 
+													str( resp )[:100] ) )
+				elif not fut.done():
+					fut.set_result( resp["resp"] )
+		except Exception as e:
+			err = str( e )
+		finally:
+			# The requests which are still pending will not be answered
+			pending, self.pending = self.pending, {}
+			for fut in pending.values():
+				if not fut.done():
+					fut.set_exception( IKException( ErrorCode.clientConnectionError, moreInfo = err ) )
+			if self.reader is reader:
+				self.writer.close()
+
+	async def sendCmd( self, m, args = None, kwargs = None ):
+		'''Sends the command and returns the ( result, content ) pair like 
+		RegdComm.sendCmd.'''
+		util.addArgsToMap( m, args, kwargs )
+		# Streamed responses are not supported: the response comes in one packet
+		m.pop( defs.STREAM, None )
+		rid = next( self.rids )
+		m[defs.REQUEST_ID] = rid
+		bpack = util.createPacket( m, self.codec )
+		flag = None
+		if self.compress or ( self.compress is None and self.host ):
+			bpack, flag = util.compressPack( bpack )
+			flag = flag or util.HDR_ACCEPT_Z
+		try:
+			await self.connect()
+			fut = asyncio.get_event_loop().create_future()
+			self.pending[rid] = fut
+			self.writer.write( util.framePack( bpack, flag ) )
+			await self.writer.drain()
+			lres = await asyncio.wait_for( fut, self.timeout )
+		except ( IKException, OSError, asyncio.TimeoutError ) as e:
+			self.pending.pop( rid, None )
+			return False, [str( e ) or "Timeout"]
+		return util.unpackResponse( lres )
+
+	async def close( self ):
+		if self.writer:
+			self.writer.close()
+			try:
+				await self.writer.wait_closed()
+			except OSError:
+				pass
+		if self.readTask:
+			await asyncio.gather( self.readTask, return_exceptions = True )
+		self.reader = self.writer = self.readTask = None
+
+	async def listTokens( self, lres, path, *args, **kwargs ):
+		m = { "cmd": defs.LIST }
+		if path:
+			m["params"] = [path]
+		res, ret = await self.sendCmd( m, args, kwargs )
+
+		lres.extend( ret )
+		return res
+
+	async def loadFile( self, fname, *args, **kwargs ):
+		'''Loads tokens from a file. Unless the 'server_side' option is given, the 
+		file is read on the client side.'''
+		m = { "cmd": defs.LOAD_FILE, "params": [fname] }
+		if not kwargs.pop( defs.SERVER_SIDE, None ) and defs.SERVER_SIDE not in args:
+			if not os.path.exists( fname ):
+				return False, "File not found: " + fname
+			def readFile():
+				with open( fname ) as f:
+					return f.read()
+			m["params"] = [await asyncio.get_event_loop().run_in_executor( None, readFile )]
+			m[defs.FROM_PARS] = True
+		else:
+			args = tuple( x for x in args if x != defs.SERVER_SIDE )
+		return await self.sendCmd( m, args, kwargs )
+
+	async def addToken( self, nam, val, *args, **kwargs ):
+		if val:
+			token = "{0} = {1}".format( nam, val )
+		else:
+			token = nam
+		m = { "cmd": defs.ADD_TOKEN, "params": [token] }
+		return await self.sendCmd( m, args, kwargs )
+
+	async def getToken( self, nam, *args, **kwargs ):
+		m = { "cmd": defs.GET_ITEM, "params": [nam] }
+		if "default" not in kwargs:
+			return await self.sendCmd( m, args, kwargs )
+		defRet = kwargs.pop( "default" )
+		res, ret = await self.sendCmd( m, args, kwargs )
+		if not res:
+			ret = defRet
+		return res, ret
@@ -65,11 +65,20 @@ TEST_MULTIUSER_BEGIN = "test_multiuser_begin"
 TEST_MULTIUSER_END 	 = "test_multiuser_end"
 HELP 				 = "help"
 VERS				 = "version"
+SHELL				 = "shell"
+EXPORT				 = "export"
+QUERY				 = "query"
+FIND				 = "find"
+# Not available from the command line
+BATCH				 = "batch"
+TRANSACTION			 = "transaction"
+WATCH				 = "watch"
 
 # Regd options
 SERVER_NAME			 = "server_name"
 LOG_LEVEL			 = "log_level"
 LOG_TOPICS			 = "log_topics"
+READY_FD			 = "ready_fd"
 
 # Command options
 PORT				 = "port"
@@ -91,6 +100,18 @@ ATTRS				 = "attrs"
 BINARY				 = "binary"
 RECURS				 = "recursively"
 SUM					 = "sum"
+STREAM				 = "stream"
+NULL				 = "null"
+LIMIT				 = "limit"
+REGEX				 = "regex"
+COUNT				 = "count"
+
+# Protocol fields
+REQUEST_ID			 = "rid"
+
+# Wire codecs
+CODEC_JSON			 = "json"
+CODEC_BINARY		 = "binary"
 
 # Report ("what") options
 STAT				 = "stat"
@@ -100,20 +121,20 @@ REP_COMMANDS		 = "commands"
 
 # Command groups
 all_cmds = ( ADD_TOKEN, CHECK_SERVER, CLEAR_SESSION, COPY_FILE,
-			CREATE_SECTION, GETATTR, GET_ITEM, HELP,
-			IF_PATH_EXISTS, INFO, LIST, LOAD_FILE, LOAD_FILE_SEC, REMOVE_SECTION,
+			CREATE_SECTION, EXPORT, FIND, GETATTR, GET_ITEM, HELP,
+			IF_PATH_EXISTS, INFO, LIST, LOAD_FILE, LOAD_FILE_SEC, QUERY, REMOVE_SECTION,
 			REMOVE_TOKEN, REPORT, RESTART_SERVER, SETATTR, START_SERVER,
 			STOP_SERVER, TEST_CONFIGURE, TEST_MULTIUSER_BEGIN, TEST_MULTIUSER_END, TEST_START,
-			VERS )
-pubread_cmds = ( CHECK_SERVER, LIST, GET_ITEM, IF_PATH_EXISTS )
+			VERS, SHELL )
+pubread_cmds = ( CHECK_SERVER, LIST, GET_ITEM, IF_PATH_EXISTS, WATCH, EXPORT, QUERY, FIND )
 secure_cmds = ( START_SERVER, STOP_SERVER, RESTART_SERVER, REPORT,
 			LOAD_FILE_SEC )
 pers_opts = ( PERS )
-local_cmds = ( TEST_START, TEST_CONFIGURE, TEST_MULTIUSER_BEGIN, TEST_MULTIUSER_END )
+local_cmds = ( TEST_START, TEST_CONFIGURE, TEST_MULTIUSER_BEGIN, TEST_MULTIUSER_END, SHELL )
 # For executing these commands on server they must come with --server-side switch
 nonlocal_cmds = ( SHOW_LOG, VERS )
 cmd_opts = ( DEST, SESSION, PERS, ALL, TREE, NOVALUES, FORCE, SERVER_SIDE, FROM_PARS, ATTRS,
-			BINARY, RECURS, SUM )
+			BINARY, RECURS, SUM, STREAM, NULL, LIMIT, REGEX, COUNT )
 rep_opts = ( ACCESS, STAT, DATAFILE )
 
 # Parse token mode
@@ -134,3 +155,18 @@ dirMark = "//"
 # include <filePath> <relSectPath>
 dirInclude = dirMark + "include"
 dirAattributes = dirMark + "attributes"
+
+# Root sections of the token tree
+# persistent
+PERSNAME = "sav"
+# session
+SESNAME = "ses"
+# /bin
+BINNAME = "bin"
+# internal data
+SYSNAME = "_sys"
+
+PERSPATH = "/" + PERSNAME
+SESPATH = "/" + SESNAME
+BINPATH = "/" + BINNAME
+SYSPATH = "/" + SYSNAME
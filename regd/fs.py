@@ -13,8 +13,10 @@
 
 __lastedited__ = "2017-06-15 16:25:40"
 
-import sys, os, subprocess, shutil, io, time
-from multiprocessing import Process, Pipe, Lock
+import sys, os, subprocess, shutil, io, time, itertools, mmap, pickle, struct, queue, threading
+import re, shlex, fnmatch
+from multiprocessing import Process, Pipe, Lock, Semaphore, Array
+from collections import OrderedDict
 from datetime import datetime
 from socket import SHUT_RDWR, socketpair
 from regd.stor import getstor
@@ -25,6 +27,7 @@ from regd.appsm.app import IKException, ErrorCode, ROAttr
 from regd.cmds import CmdProcessor, CmdSwitcher, registerGroupHandler
 import regd.util as util
 import regd.defs as df
+from regd.defs import PERSNAME, SESNAME, BINNAME, SYSNAME, PERSPATH, SESPATH, BINPATH, SYSPATH
 import regd.tok as modtok
 
 # Class commands
@@ -33,24 +36,190 @@ FS_INFO		= "FS_INFO"
 FS_STOP		= "FS_STOP"
 FS_CHECK	= "FS_CHECK"
 
-# persistent
-PERSNAME = "sav"
-# session
-SESNAME = "ses"
-# /bin
-BINNAME = "bin"
-# internal data
-SYSNAME = "_sys"
-
-PERSPATH = "/" + PERSNAME
-SESPATH = "/" + SESNAME
-BINPATH = "/" + BINNAME
-SYSPATH = "/" + SYSNAME
-
 rootdirs = (SESPATH, PERSPATH, BINPATH, SYSPATH)
 serializable_roots = (PERSPATH, BINPATH)
 
-class FS( CmdProcessor ):
+# Default number of connections to storage
+STORAGE_CHANNELS = 8
+
+# Seconds to wait for the storage to start
+STORAGE_START_TIMEOUT = 30
+
+# Default size of the storage snapshot region in megabytes
+SNAPSHOT_SIZE = 16
+
+# Maximum number of frames of a streamed storage response waiting to be sent
+STREAM_QUEUE_FRAMES = 64
+
+# Commands which don't modify the storage tree
+read_cmds = ( df.IF_PATH_EXISTS, df.GETATTR, df.LIST, df.GET_ITEM, df.WATCH, df.EXPORT, 
+			df.QUERY, df.FIND, FS_INFO, FS_CHECK )
+
+# Connections to storage
+channels = None
+# Storage snapshot
+snapshot = None
+
+def shellName( nam ):
+	'''Converts a token name to a shell variable name.'''
+	nam = re.sub( "[^A-Za-z0-9_]", "_", nam )
+	return "_" + nam if nam[:1].isdigit() else nam
+
+def getLimit( cmd ):
+	'''Returns the number given with the 'limit' option of cmd or None if it's
+	not given.'''
+	if df.LIMIT not in cmd:
+		return None
+	try:
+		limit = int( cmd[df.LIMIT][0] )
+	except ValueError:
+		raise IKException( ErrorCode.unsupportedParameterValue, cmd[df.LIMIT][0],
+						"Limit must be a number" )
+	if limit < 0:
+		raise IKException( ErrorCode.unsupportedParameterValue, cmd[df.LIMIT][0],
+						"Limit must not be negative" )
+	return limit
+
+class FSReader:
+	'''Handlers of the commands which only read the storage tree in self.fs.
+	They are shared by the storage itself and by the snapshot readers.'''
+
+	def chPathExists( self, cmd ):
+		'''Return True if a token path exists'''
+		par = cmd["params"][0]
+		try:
+			self.fs.getItem( par )
+			return composeResponse()
+		except IKException as e:
+			if e.code == ErrorCode.objectNotExists:
+				return composeResponse( "0" )
+			else:
+				raise
+
+	def chGetAttr( self, cmd ):
+		'''Return item's attribute'''
+
+		"""Query for attributes of a storage item.
+		Syntax: GETATTR <itempath> [attrname]
+		Without 'attrname' returns 'st_stat' attributes like function 'getattr'.
+		With 'attrname' works like 'getxattr'.
+		"""
+		attrNames = None
+		par = cmd["params"][0]
+		if df.ATTRS in cmd:
+			attrNames = cmd[df.ATTRS]
+		m = self.fs.getItemAttr( par, attrNames )
+		return composeResponse( '1', m )
+
+	def chListItems( self, cmd ):
+		'''List items'''
+		par = cmd.get( "params", None )
+		swNovals = df.NOVALUES in cmd
+		swTree = df.TREE in cmd
+		swRecur = df.RECURS in cmd
+		if not par:
+			sect = self.fs['']
+		else:
+			item = par[0]
+			if item[0] != '/':
+				item = "{0}/{1}".format( PERSPATH if df.PERS in cmd else SESPATH, item )
+
+			sect = self.fs.getItem( item )
+
+		lines = sect.genItems( bTree = swTree, nIndent = 0, bNovals = swNovals,
+						relPath = None, bRecur = swRecur )
+		if df.STREAM in cmd:
+			# The listing is sent in frames as it's generated
+			return util.streamFrames( lines )
+
+		return composeResponse( '1', list( lines ) )
+
+	def chExport( self, cmd ):
+		'''Export section tokens as shell variables'''
+		item = cmd["params"][0]
+		if not item:
+			raise IKException( ErrorCode.unsupportedParameterValue, item, "Section name is empty" )
+		if item[0] != '/':
+			item = "{0}/{1}".format( PERSPATH if df.PERS in cmd else SESPATH, item )
+		sect = self.fs.getItem( item )
+		if not isinstance( sect, stor.Stor ):
+			raise IKException( ErrorCode.unsupportedParameterValue, item, "Not a section." )
+
+		pairs = sect.genTokens( bRecur = df.RECURS in cmd )
+		if df.NULL in cmd:
+			return composeResponse( '1', "".join( "{0}={1}\0".format( nam, val ) 
+												for nam, val in pairs ) )
+		return composeResponse( '1', ["export {0}={1}".format( shellName( nam ), 
+								shlex.quote( val ) ) for nam, val in pairs] )
+
+	def chFind( self, cmd ):
+		'''Find tokens by a glob or regex pattern of their paths and optionally 
+		of their values'''
+		par = cmd["params"]
+		if len( par ) > 2:
+			raise IKException( ErrorCode.unrecognizedSyntax, " ".join( par ), "Too many parameters" )
+		if not par[0]:
+			raise IKException( ErrorCode.unsupportedParameterValue, par[0], "Path pattern is empty" )
+		limit = getLimit( cmd )
+		home = PERSPATH if df.PERS in cmd else SESPATH
+		try:
+			if df.REGEX in cmd:
+				# Regexes are searched in the full paths of the tokens under home
+				patts = [re.compile( x ).search for x in par]
+				root = home
+			else:
+				pathPatt = par[0] if par[0][0] == '/' else home + "/" + par[0]
+				patts = [re.compile( fnmatch.translate( x ) ).match for x in [pathPatt] + par[1:]]
+				# Only the section named by the literal part of the pattern is searched
+				root = re.split( "[*?[]", pathPatt, 1 )[0].rpartition( "/" )[0] or "/"
+		except re.error as e:
+			raise IKException( ErrorCode.unsupportedParameterValue, " ".join( par ), 
+							"Wrong pattern: {0}".format( e ) )
+		try:
+			sect = self.fs.getItem( root )
+		except IKException as e:
+			if e.code != ErrorCode.objectNotExists:
+				raise
+			sect = None
+
+		matches = []
+		cnt = 0
+		if isinstance( sect, stor.Stor ) and limit != 0:
+			# The iterator is created directly: sect may be shared by the threads
+			# reading the snapshot, and enumerate() keeps the mode in the section
+			for _, tok in stor.Stor.StorIter( sect, stor.EnumMode.tokensAll ):
+				path = tok.pathName()
+				if not patts[0]( path ) or ( len( patts ) > 1 and not patts[1]( str( tok ) ) ):
+					continue
+				cnt += 1
+				if df.COUNT not in cmd:
+					matches.append( path if df.NOVALUES in cmd else 
+								"{0}={1}".format( path.replace( "=", "\\=" ), tok ) )
+				if cnt == limit:
+					break
+
+		if df.COUNT in cmd:
+			return composeResponse( '1', str( cnt ) )
+		return composeResponse( '1', matches )
+
+	def _getItemFeeder( self, cmd ):
+		swPers = df.PERS in cmd
+		for i in cmd["params"]:
+			if i[0] != '/':
+				ret = "{0}/{1}".format( PERSPATH if swPers else SESPATH, i )
+			else:
+				ret = i
+			yield ret
+
+	def chGetItem( self, cmd ):
+		'''Get item'''
+		lres = []
+		for i in self._getItemFeeder( cmd ):
+			lres.append( self.fs.getItem( i ).value() )
+
+		return composeResponse( '1', lres if len(lres) != 1 else lres[0] )
+
+class FS( FSReader, CmdProcessor ):
 	'''Regd server storage'''
 	
 	# Read-only fields
@@ -62,8 +231,11 @@ class FS( CmdProcessor ):
 	( df.IF_PATH_EXISTS, "1", None, None, "chPathExists" ),
 	( df.GETATTR, "1", {df.ATTRS}, None, "chGetAttr" ),
 	( df.SETATTR, "1", {df.ATTRS}, None, "chSetAttr" ),
-	( df.LIST, "?", None, { df.TREE, df.NOVALUES, df.RECURS }, "chListItems" ),
+	( df.LIST, "?", None, { df.TREE, df.NOVALUES, df.RECURS, df.STREAM }, "chListItems" ),
 	( df.GET_ITEM, "1+", None, {df.PERS, "internal"}, "chGetItem" ),
+	( df.EXPORT, "1", None, {df.PERS, df.RECURS, df.NULL}, "chExport" ),
+	( df.QUERY, "1+", None, {df.PERS, df.NOVALUES, df.LIMIT}, "chQuery" ),
+	( df.FIND, "1+", None, {df.PERS, df.NOVALUES, df.LIMIT, df.REGEX, df.COUNT}, "chFind" ),
 	( df.ADD_TOKEN, "1+", None, { df.FORCE, df.PERS, df.DEST, df.ATTRS, df.BINARY, df.SUM, "internal" }, "chAddToken" ),
 	( df.LOAD_FILE, "1+", None, { df.FORCE, df.PERS, df.DEST, df.ATTRS, df.FROM_PARS }, "chLoadFile" ),
 	( df.COPY_FILE, "2", None, { df.FORCE, df.PERS, df.DEST, df.ATTRS, df.BINARY }, "chCopyFile" ),
@@ -75,19 +247,29 @@ class FS( CmdProcessor ):
 	( df.CLEAR_SESSION, "0", None, None, "chClearSessionTokens" ),
 	( FS_INFO, "?", None, None, "chFsInfo" ),
 	( FS_STOP, "0", None, None, "chFsStop" ),
-	( FS_CHECK, "0", None, None, "chFsCheck" )
+	( FS_CHECK, "0", None, None, "chFsCheck" ),
+	( df.BATCH, "1+", None, None, "chBatch" ),
+	( df.TRANSACTION, "1+", None, None, "chTransaction" ),
+	( df.WATCH, "?", None, None, "chWatch" )
 	)
 
-	def __init__(self, conn, acc, datafile, binsecfile=None ):
+	# Commands which can be included in a batch
+	batchCmds = tuple( x[0] for x in cmdDefs if x[0] not in ( FS_INFO, FS_STOP, FS_CHECK, df.BATCH ) )
+	# Commands which can be included in a transaction
+	txCmds = ( df.ADD_TOKEN, df.REMOVE_TOKEN, df.REMOVE_SECTION, df.CREATE_SECTION )
+
+	def __init__(self, conn, acc, datafile, binsecfile=None, snap=None ):
 		super( FS, self ).__init__( conn )
 		
 		self.acc = acc
+		self.snap = snap
 		self.datafile = datafile
 		self.binsecfile = binsecfile
 		self.info = {}
 		self.cont = True
 		
 		self.fs 		= getstor( rootStor=None, mode=0o555 )
+		self.fs.makeIndex()
 		
 		self.tokens 	= getstor( rootStor=None, mode=0o777 )
 		self.bintokens 	= getstor( rootStor = None, mode=0o777)
@@ -282,17 +464,20 @@ class FS( CmdProcessor ):
 			subprocess.call( [exefile.val, val], shell=False )
 	
 	@staticmethod
-	def start_loop( conn, sigConn, acc, datafile, binsectfile ):
+	def start_loop( conns, sigConn, acc, datafile, binsectfile, snap, ready ):
 		'''Create FS instance and start loop'''
 		util.setLog("DEBUG")
-		fs = FS( conn, acc, datafile, binsectfile )
+		fs = FS( conns, acc, datafile, binsectfile, snap )
+		ready.send( True )
+		ready.close()
 		log.info( "Starting listening for messages..." )
 		try:
 			fs.listenForMessages( fs.serialize )
 		except Exception as e:
 			log.error( "Exception received: {0}".format( e ) )
 			#fs.conn.shutdown(SHUT_RDWR)
-		conn.close()
+		for conn in conns:
+			conn.close()
 		sigConn.send( "Exception in storage".encode() )
 		sigConn.shutdown( SHUT_RDWR )
 		sigConn.close()
@@ -300,6 +485,24 @@ class FS( CmdProcessor ):
 		log.info( "Ended listening for messages. Quitting..." )
 		return 0
 		
+	def processCmd( self, cmd ):
+		'''Process a command and register a change of the tree for the snapshot 
+		readers.'''
+		internal = "internal" in cmd
+		# Internal commands only update /_sys, which is never read from snapshot
+		# and isn't watched by clients
+		stor.logChanges = not internal
+		try:
+			return super( FS, self ).processCmd( cmd )
+		finally:
+			stor.logChanges = True
+			if self.snap and cmd["cmd"] not in read_cmds and not internal:
+				self.snap.bump()
+
+	def onReplied( self, cmd ):
+		if self.snap:
+			self.snap.publish( self.fs )
+
 	def loop( self ):
 		self.cont = True
 		while self.cont:
@@ -311,14 +514,10 @@ class FS( CmdProcessor ):
 			self.quitCond.wait( 30 )
 
 	def chFsInfo( self, cmd ):
-		path = cmd.get("params")
-		if not path:
-			return util.printMap( self.info, 0 )
-		else:
-			path = path[0]
-			item = self.getItem( path )
-			m = item.stat()
-			return util.printMap( m, 0 )
+		'''Report the statistics of a section or of the whole tree.'''
+		path = cmd.get( "params" )
+		item = self.fs.getItem( path[0] ) if path else self.fs
+		return composeResponse( '1', util.printMap( item.stat(), 0 ) )
 
 	def chFsStop( self, cmd ):
 		self.cont = False
@@ -334,33 +533,6 @@ class FS( CmdProcessor ):
 
 		return composeResponse( '1', resp )
 
-	def chPathExists( self, cmd ):
-		'''Return True if a token path exists'''
-		par = cmd["params"][0]
-		try:
-			self.fs.getItem( par )
-			return composeResponse()
-		except IKException as e:
-			if e.code == ErrorCode.objectNotExists:
-				return composeResponse( "0" )
-			else:
-				raise
-
-	def chGetAttr( self, cmd ):
-		'''Return item's attribute'''
-
-		"""Query for attributes of a storage item.
-		Syntax: GETATTR <itempath> [attrname]
-		Without 'attrname' returns 'st_stat' attributes like function 'getattr'.
-		With 'attrname' works like 'getxattr'.
-		"""
-		attrNames = None
-		par = cmd["params"][0]
-		if df.ATTRS in cmd:
-			attrNames = cmd[df.ATTRS]
-		m = self.fs.getItemAttr( par, attrNames )
-		return composeResponse( '1', m )
-
 	def chSetAttr( self, cmd ):
 		'''Set an item's attribute'''
 		
@@ -381,27 +553,6 @@ class FS( CmdProcessor ):
 
 		return composeResponse()
 
-	def chListItems( self, cmd ):
-		'''List items'''
-		par = cmd.get( "params", None )
-		swNovals = df.NOVALUES in cmd
-		swTree = df.TREE in cmd
-		swRecur = df.RECURS in cmd
-		lres = []
-		if not par:
-			self.fs[''].listItems( lres = lres, bTree = swTree, nIndent = 0, bNovals = swNovals,
-							relPath = None, bRecur = swRecur )
-		else:
-			item = par[0]
-			if item[0] != '/':
-				item = "{0}/{1}".format( PERSPATH if df.PERS in cmd else SESPATH, item )
-
-			sect = self.fs.getItem( item )
-			sect.listItems( lres = lres, bTree = swTree, nIndent = 0, bNovals = swNovals,
-						relPath = None, bRecur = swRecur )
-
-		return composeResponse( '1', lres )
-
 	def _getAddOptions( self, cmd ):
 		par = cmd["params"]
 		if not par:
@@ -434,45 +585,51 @@ class FS( CmdProcessor ):
 		'''Add item'''
 		dest, addMode, attrs = self._getAddOptions( cmd )
 		cnt = 0
-		#with self.lock_seriz:
-		for tok in cmd["params"]:
-			if (dest and dest.startswith( BINPATH ) ) or \
-					tok.startswith( BINPATH ):
-				self.handleBinToken( dest, tok, cmd )
-				continue
-
-			# Without --dest or --pers options tokens with relative path
-			# are always added to session tokens
-			if not dest and tok[0] != '/':
-				dest = SESPATH
-
-			binaryVal = None
-			if df.BINARY in cmd:
-				if not cmd[df.BINARY] or len( cmd[df.BINARY] ) < cnt + 1:
-					raise IKException( ErrorCode.unknownDataFormat, tok )
-				binaryVal = cmd[df.BINARY][cnt]
-				if not attrs:
-					attrs = {}
-				attrs[stor.SItem.persPathAttrName] = df.BINARY
-				cnt += 1
+		# Tokens are added all or none. /bin tokens are commands to run rather than
+		# items to store, so they are run only when all the other tokens are added.
+		bintoks = []
+		with stor.Transaction():
+			for tok in cmd["params"]:
+				if (dest and dest.startswith( BINPATH ) ) or \
+						tok.startswith( BINPATH ):
+					bintoks.append( ( dest, tok ) )
+					continue
 
-			if dest:
-				tok=joinPath(dest, tok)
+				# Without --dest or --pers options tokens with relative path
+				# are always added to session tokens
+				if not dest and tok[0] != '/':
+					dest = SESPATH
+
+				binaryVal = None
+				if df.BINARY in cmd:
+					if not cmd[df.BINARY] or len( cmd[df.BINARY] ) < cnt + 1:
+						raise IKException( ErrorCode.unknownDataFormat, tok )
+					binaryVal = cmd[df.BINARY][cnt]
+					if not attrs:
+						attrs = {}
+					attrs[stor.SItem.persPathAttrName] = df.BINARY
+					cnt += 1
+
+				if dest:
+					tok=joinPath(dest, tok)
 			
-			if binaryVal:
-				tk = None
-				pt = tok
-			else:
-				tk = tok
-				pt = None
+				if binaryVal:
+					tk = None
+					pt = tok
+				else:
+					tk = tok
+					pt = None
 				 
-			if not self._isPathValid( tok=tk, path=pt, cmd=cmd ):
-				raise IKException( ErrorCode.unsupportedParameterValue, tok[:50], "Path is not valid." )
+				if not self._isPathValid( tok=tk, path=pt, cmd=cmd ):
+					raise IKException( ErrorCode.unsupportedParameterValue, tok[:50], "Path is not valid." )
 
-			sec = self.fs.addItem( tok=tok, addMode=addMode, 
-									binaryVal=binaryVal, attrs = attrs )
+				sec = self.fs.addItem( tok=tok, addMode=addMode, 
+										binaryVal=binaryVal, attrs = attrs )
 
-			if sec: sec.markChanged()
+				if sec: sec.markChanged()
+
+		for bdest, tok in bintoks:
+			self.handleBinToken( bdest, tok, cmd )
 
 		return composeResponse( )
 
@@ -492,6 +649,8 @@ class FS( CmdProcessor ):
 		else:
 			for file in cmd["params"]:
 				fh = io.BytesIO( file.encode() )
+				# Included files are looked up relative to the server's directory
+				fh.name = "<params>"
 				self.fs.readFromFile( fh=fh, dest=dest, addMode=addMode )
 
 		return composeResponse()
@@ -530,21 +689,10 @@ class FS( CmdProcessor ):
 
 		return composeResponse( '1', ret )
 
-	def _getItemFeeder( self, cmd ):
-		swPers = df.PERS in cmd
-		for i in cmd["params"]:
-			if i[0] != '/':
-				ret = "{0}/{1}".format( PERSPATH if swPers else SESPATH, i )
-			else:
-				ret = i
-			yield ret
-
 	def chGetItem( self, cmd ):
 		'''Get item'''
-		feeder = self._getItemFeeder( cmd )
-		
 		if self.acc == df.PL_SECURE:
-			nam = feeder.__next__()
+			nam = next( self._getItemFeeder( cmd ) )
 			try:
 				ret = self.fs.getItem( nam ).value()
 				return composeResponse( '1', ret )
@@ -562,39 +710,60 @@ class FS( CmdProcessor ):
 
 			return composeResponse( '1', self.fs.getItem( nam ).value() )
 
-		lres = []
-		for i in feeder:
-			lres.append( self.fs.getItem( i ).value() )
+		return super( FS, self ).chGetItem( cmd )
+
+	def chQuery( self, cmd ):
+		'''Return the tokens whose paths start with a prefix or are in a range. The
+		query is served from the sorted path index, which only the storage has.'''
+		if not all( cmd["params"] ):
+			raise IKException( ErrorCode.unsupportedParameterValue, " ".join( cmd["params"] ), 
+							"Path is empty" )
+		paths = list( self._getItemFeeder( cmd ) )
+		if len( paths ) > 2:
+			raise IKException( ErrorCode.unrecognizedSyntax, " ".join( cmd["params"] ), 
+							"Too many parameters" )
+		limit = getLimit( cmd )
+		if len( paths ) == 1:
+			# "a/b*" and "a/b" are the same prefix
+			pairs = self.fs.index.query( paths[0].rstrip( "*" ), prefix = True, limit = limit )
+		else:
+			pairs = self.fs.index.query( paths[0], paths[1], limit = limit )
 
-		return composeResponse( '1', lres if len(lres) != 1 else lres[0] )
+		if df.NOVALUES in cmd:
+			return composeResponse( '1', [path for path, _ in pairs] )
+		return composeResponse( '1', ["{0}={1}".format( path.replace( "=", "\\=" ), tok )
+									for path, tok in pairs] )
 
 	def chRemoveToken( self, cmd ):
 		'''Remove token'''
 		feeder = self._getItemFeeder( cmd )
-		for i in feeder:
-			self.fs.removeItem( i ).markChanged()
+		with stor.Transaction():
+			for i in feeder:
+				self.fs.removeItem( i ).markChanged()
 
 		return composeResponse( )
 
 	def chRemoveSection( self, cmd ):
 		'''Remove section'''
 		feeder = self._getItemFeeder( cmd )
-		for i in feeder:
-			self.fs.removeItem( i ).markChanged()
+		with stor.Transaction():
+			for i in feeder:
+				self.fs.removeItem( i ).markChanged()
 
 		return composeResponse( )
 
 	def chCreateSection( self, cmd ):
 		'''Create section'''
 		feeder = self._getItemFeeder( cmd )
-		for i in feeder:
-			if not self._isPathValid( path=i, cmd=cmd ):
-				raise IKException( ErrorCode.unsupportedParameterValue, i, "Path is not valid" )
-			sec = self.fs.addItem( i )
-			if df.ATTRS in cmd:
-				sec.setAttrs( cmd[df.ATTRS] )
-				sec.readFromFile( updateFromStorage = True )
-			sec.markChanged()
+		with stor.Transaction():
+			for i in feeder:
+				if not self._isPathValid( path=i, cmd=cmd ):
+					raise IKException( ErrorCode.unsupportedParameterValue, i, "Path is not valid" )
+				sec = self.fs.addItem( i )
+				if df.ATTRS in cmd:
+					sec.setAttrs( cmd[df.ATTRS] )
+					sec.readFromFile( updateFromStorage = True )
+				sec.markChanged()
 
 		return composeResponse( )
 
@@ -617,40 +786,430 @@ class FS( CmdProcessor ):
 		self.read_sec_file( file )
 		return composeResponse( )
 
+	def chBatch( self, cmd ):
+		'''Execute a list of commands'''
+		
+		"""Each parameter is a command dictionary. The commands are executed in order
+		and independently of each other. Returns a list with the response to each 
+		command: [result code, content]."""
+		lres = []
+		for sub in cmd["params"]:
+			try:
+				if not isinstance( sub, dict ) or sub.get( "cmd" ) not in self.batchCmds or \
+						"internal" in sub or df.STREAM in sub:
+					raise IKException( ErrorCode.unrecognizedSyntax, 
+							str( sub.get( "cmd" ) if isinstance( sub, dict ) else sub )[:50],
+							"Command cannot be used in batch" )
+				resp = self.processCmd( sub )
+			except IKException as e:
+				resp = composeResponse( '0', str( e ) )
+			lres.append( resp )
+
+		# Responses are already serialized, so they are joined without re-parsing
+		return util.composeListResponse( '1', lres )
+
+	def chTransaction( self, cmd ):
+		'''Execute a list of commands atomically'''
+		
+		"""Each parameter is a command dictionary of one of txCmds. Either all the
+		commands succeed, or the storage is left as it was and the error of the 
+		failed command is returned."""
+		for sub in cmd["params"]:
+			if not isinstance( sub, dict ) or sub.get( "cmd" ) not in self.txCmds or \
+					"internal" in sub:
+				raise IKException( ErrorCode.unrecognizedSyntax, 
+						str( sub.get( "cmd" ) if isinstance( sub, dict ) else sub )[:50],
+						"Command cannot be used in transaction" )
+			if sub["cmd"] == df.ADD_TOKEN and ( 
+					[x for x in sub.get( "params", [] ) if x.startswith( BINPATH )] or
+					( sub.get( df.DEST ) and sub[df.DEST][0].startswith( BINPATH ) ) ):
+				raise IKException( ErrorCode.unsupportedParameterValue, BINPATH,
+						"Tokens in this section cannot be used in transaction" )
+
+		n = 0
+		try:
+			with stor.Transaction():
+				for n, sub in enumerate( cmd["params"] ):
+					self.processCmd( sub )
+		except IKException as e:
+			return composeResponse( '0', "Transaction is cancelled. Command {0} failed: {1}".format( 
+																				n + 1, e ) )
+
+		return composeResponse( )
+
+	def chWatch( self, cmd ):
+		'''Report changed paths'''
+		
+		"""Returns the current change number, followed by the paths of the items 
+		which have been set or deleted after the change number in the parameter. 
+		If these changes are not known anymore, the path is '/'."""
+		if not cmd.get( "params" ):
+			return composeResponse( '1', [stor.changeNum] )
+		try:
+			num = int( cmd["params"][0] )
+		except ValueError:
+			raise IKException( ErrorCode.unsupportedParameterValue, cmd["params"][0], 
+							"Change number must be an integer" )
+		paths = stor.changesSince( num )
+		if paths is None:
+			paths = ["/"]
+		return composeResponse( '1', [stor.changeNum] + paths )
+
 	def chClearSessionTokens( self, cmd ):
 		'''Clear session tokens'''
 		self.clearTokensSec( )
 		self.clearSessionTokens( )
 		return composeResponse()
 
+class StorageChannels:
+	'''Pool of connections to the storage process. A connection carries one 
+	request at a time and connection handlers take any free one, so that several 
+	storage requests can be outstanding at once. Requests are tagged with ids, so 
+	that a late reply to a timed out request is not taken for the reply to the next 
+	one.'''
+
+	# Indexes in the shared stat array
+	REQUESTS, WAITED, WAIT_TIME, QUEUED, MAX_QUEUED = range( 5 )
+
+	def __init__( self, num ):
+		self.here = []
+		self.there = []
+		self.locks = []
+		for _ in range( num ):
+			connHere, connThere = Pipe( True )
+			self.here.append( connHere )
+			self.there.append( connThere )
+			self.locks.append( Lock() )
+		self.free = Semaphore( num )
+		self.stat = Array( 'd', 5 )
+		self.rids = itertools.count( 1 )
+
+	def _take( self, timeout ):
+		'''Returns the index of a free channel.'''
+		st = self.stat
+		with st.get_lock():
+			st[self.REQUESTS] += 1
+			st[self.QUEUED] += 1
+			if st[self.QUEUED] > st[self.MAX_QUEUED]:
+				st[self.MAX_QUEUED] = st[self.QUEUED]
+
+		if not self.free.acquire( False ):
+			tm = time.time()
+			ok = self.free.acquire( True, timeout )
+			with st.get_lock():
+				st[self.WAITED] += 1
+				st[self.WAIT_TIME] += time.time() - tm
+				if not ok:
+					st[self.QUEUED] -= 1
+			if not ok:
+				raise IKException( ErrorCode.operationFailed, 
+								"Failed to acquire the lock for connecting to storage." )
+
+		n = len( self.locks )
+		start = os.getpid() % n
+		for i in range( n ):
+			k = ( start + i ) % n
+			if self.locks[k].acquire( False ):
+				return k
+
+		raise IKException( ErrorCode.programError, "No free storage channel." )
+
+	def _release( self, k ):
+		self.locks[k].release()
+		self.free.release()
+		with self.stat.get_lock():
+			self.stat[self.QUEUED] -= 1
+
+	def send( self, cmd, timeout = 15 ):
+		'''Sends a command to storage and returns the reply.'''
+		k = self._take( 5 )
+		try:
+			conn = self.here[k]
+			rid = ( os.getpid(), next( self.rids ) )
+			log.debug( "Sending..." )
+			conn.send( ( rid, cmd, util.getCodec() ) )
+			log.debug( "Sent. Receiving..." )
+			tmEnd = time.time() + timeout
+			while True:
+				if not conn.poll( max( 0, tmEnd - time.time() ) ):
+					log.debug( "Nothing to receive" )
+					return composeResponse("0", "Socket timed out or no data to receive.")
+				rrid, ret, more = conn.recv()
+				if rrid == rid:
+					if more:
+						# The channel is released by the stream
+						ret = StorageStream( self, k, rid, ret, timeout )
+						k = None
+					return ret
+				log.debug( "Discarding a late reply to request {0}".format( rrid ) )
+		finally:
+			if k is not None:
+				self._release( k )
+
+	def stats( self ):
+		'''Returns the lock-wait and queue-depth statistics.'''
+		with self.stat.get_lock():
+			st = self.stat[:]
+		m = OrderedDict()
+		m["Storage channels"] = len( self.locks )
+		m["Storage requests"] = int( st[self.REQUESTS] )
+		m["Storage requests waited for a channel"] = int( st[self.WAITED] )
+		m["Storage lock wait total (s)"] = round( st[self.WAIT_TIME], 3 )
+		m["Storage lock wait average (ms)"] = round( 1000 * st[self.WAIT_TIME] / st[self.WAITED], 3 ) \
+											if st[self.WAITED] else 0
+		m["Storage queue depth"] = int( st[self.QUEUED] )
+		m["Storage queue depth max"] = int( st[self.MAX_QUEUED] )
+		return m
+
+class Snapshot:
+	'''Read-only copy of the storage tree in shared memory. The storage process is
+	the only writer: it pickles the tree into the region, with the update guarded 
+	by a sequence number which is odd while the update is in progress. Every 
+	modifying command increments the write counter before its response is sent, 
+	and readers use the snapshot only if it was taken at the current value of the 
+	write counter, so a read never misses a write which has already been answered.
+	A reader finding the snapshot out of date asks the storage to publish a new one
+	and sends its command to storage. Pickling a large tree takes the storage a 
+	considerable time, so a new snapshot is published only after the tree has not 
+	changed for QUIET seconds or for ten times the duration of the last publishing, 
+	whichever is longer: while tokens are written as often as they are read, reads 
+	are served by storage. Unpickling is also slow, so readers load a newly 
+	published tree in a separate thread and send their commands to storage until
+	it's loaded.'''
+
+	# Minimum time in seconds without writes before a new snapshot is published
+	QUIET = 0.1
+
+	# Header fields: update sequence number, write counter at which the published 
+	# tree was taken, current write counter, length of the pickled tree, flag 
+	# showing that readers wait for a new snapshot.
+	SEQ, VERSION, WRITES, LENGTH, WANTED = range( 5 )
+	field = struct.Struct( "=Q" )
+	hdrsize = 5 * field.size
+
+	def __init__( self, size ):
+		self.size = size
+		self.mm = mmap.mmap( -1, self.hdrsize + size )
+		self._set( self.WRITES, 1 )
+		# Storage side: the write counter at which the last publishing was tried,
+		# the time of the last write and the required time without writes
+		self.tried = 0
+		self.lastWrite = 0
+		self.quiet = self.QUIET
+		# Reader side: the last unpickled tree and its version, and the thread 
+		# loading the newly published tree
+		self.cache = ( 0, None )
+		self.loader = None
+		self.lock = threading.Lock()
+
+	def _get( self, fld ):
+		return self.field.unpack_from( self.mm, fld * self.field.size )[0]
+
+	def _set( self, fld, val ):
+		self.field.pack_into( self.mm, fld * self.field.size, val )
+
+	def bump( self ):
+		'''Registers a change of the tree.'''
+		self._set( self.WRITES, self._get( self.WRITES ) + 1 )
+		self.lastWrite = time.monotonic()
+
+	def publish( self, tree ):
+		'''Publishes the tree, if it has changed since the last publishing, 
+		readers are waiting for it and it has not changed for the required time.
+		Otherwise the request of readers is kept until the next call.'''
+		writes = self._get( self.WRITES )
+		if not self._get( self.WANTED ) or writes == self.tried:
+			return
+		start = time.monotonic()
+		if start - self.lastWrite < self.quiet:
+			return
+		self._set( self.WANTED, 0 )
+		self.tried = writes
+		data = pickle.dumps( tree, pickle.HIGHEST_PROTOCOL )
+		self.quiet = max( self.QUIET, 10 * ( time.monotonic() - start ) )
+		if len( data ) > self.size:
+			log.warning( "Storage snapshot needs {0} bytes, which exceeds snapshot_size. "
+						"Reads are served by storage.".format( len( data ) ) )
+			return
+		seq = self._get( self.SEQ )
+		self._set( self.SEQ, seq + 1 )
+		self.mm[self.hdrsize:self.hdrsize + len( data )] = data
+		self._set( self.LENGTH, len( data ) )
+		self._set( self.VERSION, writes )
+		self._set( self.SEQ, seq + 2 )
+
+	def get( self ):
+		'''Returns the current tree or None if the snapshot is out of date or 
+		hasn't been loaded yet.'''
+		ver = self._get( self.VERSION )
+		if ver != self._get( self.WRITES ):
+			self._set( self.WANTED, 1 )
+			return None
+		cver, tree = self.cache
+		if cver == ver:
+			return tree
+		with self.lock:
+			if not self.loader or not self.loader.is_alive():
+				self.loader = threading.Thread( target = self.load, daemon = True )
+				self.loader.start()
+		return None
+
+	def load( self ):
+		'''Unpickles the published tree into the cache.'''
+		for _ in range( 3 ):
+			seq = self._get( self.SEQ )
+			if seq & 1:
+				continue
+			ver = self._get( self.VERSION )
+			length = self._get( self.LENGTH )
+			data = self.mm[self.hdrsize:self.hdrsize + length]
+			if self._get( self.SEQ ) != seq:
+				continue
+			self.cache = ( ver, pickle.loads( data ) )
+			return
+
+class FSView( FSReader ):
+	'''Serves read commands from a storage snapshot tree.'''
+	handlers = { df.IF_PATH_EXISTS: FSReader.chPathExists, df.GETATTR: FSReader.chGetAttr,
+				df.LIST: FSReader.chListItems, df.GET_ITEM: FSReader.chGetItem,
+				df.EXPORT: FSReader.chExport, df.FIND: FSReader.chFind }
+
+	def __init__( self, tree ):
+		self.fs = tree
+
+	@staticmethod
+	def handleCmd( snap, cmd ):
+		'''Returns the response to cmd or None if cmd must be sent to storage.'''
+		hnd = FSView.handlers.get( cmd["cmd"] )
+		if not hnd or "internal" in cmd or df.STREAM in cmd:
+			return None
+		# /_sys is updated with internal commands, which don't change the snapshot
+		# version, so it and the root listing are always read from storage.
+		params = cmd.get( "params" )
+		if not params or [x for x in params if not x.strip( "/" ) or x.startswith( SYSPATH )]:
+			return None
+		tree = snap.get()
+		if tree is None:
+			return None
+		try:
+			return hnd( FSView( tree ), cmd )
+		except IKException:
+			# Errors are reported by storage
+			return None
+
+class StorageStream:
+	'''Iterator over the frames of a streamed storage response. The frames are
+	pulled from the storage channel by a separate thread as soon as they arrive,
+	so that the storage process, which serves one request at a time, isn't held
+	up by a slow client. At most STREAM_QUEUE_FRAMES frames are kept: if the
+	client doesn't take a frame from the full queue in timeout seconds, the rest
+	of the response is discarded and the stream ends with an error. The channel 
+	is released after the last frame.'''
+	def __init__( self, channels, k, rid, first, timeout ):
+		self.channels = channels
+		self.k = k
+		self.rid = rid
+		self.timeout = timeout
+		self.closed = False
+		self.overflow = False
+		self.frames = queue.Queue( STREAM_QUEUE_FRAMES )
+		self.frames.put( first )
+		self.puller = threading.Thread( target = self._pull, daemon = True )
+		self.puller.start()
+
+	def __iter__( self ):
+		return self
+
+	def _pull( self ):
+		conn = self.channels.here[self.k]
+		try:
+			while True:
+				if not conn.poll( self.timeout ):
+					raise IKException( ErrorCode.operationFailed, moreInfo = "Storage stream timed out." )
+				rid, frame, more = conn.recv()
+				if rid != self.rid:
+					continue
+				if not more:
+					break
+				if self.closed or self.overflow:
+					continue
+				try:
+					self.frames.put( frame, timeout = self.timeout )
+				except queue.Full:
+					log.error( "Client doesn't read the streamed response. The rest of it is discarded." )
+					self.overflow = True
+		except IKException as e:
+			log.error( str( e ) )
+		finally:
+			self.channels._release( self.k )
+			if self.overflow:
+				# The unsent frames are dropped to make room for the end mark
+				self._discard()
+			self.frames.put( None )
+
+	def __next__( self ):
+		frame = None if self.closed else self.frames.get()
+		if frame is None:
+			if self.overflow and not self.closed:
+				self.closed = True
+				return composeResponse( '0', "Streamed response is discarded: the client is too slow." )
+			self.closed = True
+			raise StopIteration
+		return frame
+
+	def close( self ):
+		'''Discards the frames which are not read yet and waits until the
+		channel is released.'''
+		self.closed = True
+		self._discard()
+		self.puller.join()
+
+	def _discard( self ):
+		try:
+			while True:
+				self.frames.get_nowait()
+		except queue.Empty:
+			pass
+
 def startStorage( acc, datafile, binsectfile ):
 	'''Starts storage in new process'''
-	connHere, connThere = Pipe( True )
+	global channels, snapshot
 	sigHere, sigThere = socketpair()
 	sigHere.setblocking( False )
 	sigThere.setblocking( False )
 	os.set_inheritable( sigThere.fileno(), True )
-	util.connLock = Lock()
+
+	d = {}
+	app.read_conf( d )
+	numChannels = STORAGE_CHANNELS
+	if "storage_channels" in d:
+		try:
+			numChannels = max( 1, int( d["storage_channels"] ) )
+		except ValueError:
+			log.warning( "storage_channels option must be a number: '%s'." % ( d["storage_channels"] ) )
+	channels = StorageChannels( numChannels )
+
+	snapSize = SNAPSHOT_SIZE
+	if "snapshot_size" in d:
+		try:
+			snapSize = max( 0, int( d["snapshot_size"] ) )
+		except ValueError:
+			log.warning( "snapshot_size option must be a number: '%s'." % ( d["snapshot_size"] ) )
+	# Secure tokens are read from the encrypted file on the first request, so in 
+	# secure mode all reads go to storage.
+	if snapSize and acc != df.PL_SECURE:
+		snapshot = Snapshot( snapSize * 1024 * 1024 )
 
 	def sendMsgToStorage( cmd ):
 		'''Forwarder of messages to storage'''
 		log.debug("In sendMsgToStorage - cmd: {0}".format( cmd ) )
+		if snapshot:
+			ret = FSView.handleCmd( snapshot, cmd )
+			if ret is not None:
+				return ret
 		try:
-			if not util.connLock.acquire(True, 5):
-				raise IKException( ErrorCode.operationFailed, 
-								"Failed to acquire the lock for connecting to storage." )
-			
-			log.debug( "Sending..." )
-			connHere.send( cmd )
-			log.debug( "Sent. Receiving..." )
-			if connHere.poll( 15 ):
-				ret = connHere.recv()
-				log.debug("In sendMsgToStorage - ret: {0}".format( ret ) )
-			else:
-				ret = composeResponse("0", "Socket timed out or no data to receive.")
-				log.debug( "Nothing to receive" )
-					
-			util.connLock.release()
+			ret = channels.send( cmd )
+			log.debug("In sendMsgToStorage - ret: {0}".format( ret ) )
 		except Exception as e:
 			ret = composeResponse( "0", str( e ) )
 			log.error("In sendMsgToStorage exception received: {0}".format( ret ) )
@@ -662,15 +1221,22 @@ def startStorage( acc, datafile, binsectfile ):
 	log.info( "Starting storage process..." )
 	# Timeout for sending from fs back to connectionHandler
 	#connThere.settimeout( 5 )
-	p = Process( target=FS.start_loop, args=(connThere, sigThere, acc, datafile, binsectfile), 
-			name="Regd Storage" )
+	readyHere, readyThere = Pipe( False )
+	p = Process( target=FS.start_loop, args=(channels.there, sigThere, acc, datafile, binsectfile, snapshot,
+			readyThere), name="Regd Storage" )
 	p.start()
-	time.sleep( 1 )
-	if p.is_alive():
+	readyThere.close()
+	# Waiting till the storage has read the data files
+	try:
+		ready = readyHere.poll( STORAGE_START_TIMEOUT ) and readyHere.recv()
+	except EOFError:
+		# Storage has exited
+		ready = False
+	readyHere.close()
+	if ready:
 		log.info( "Storage started OK." )
 	else:
 		log.info( "Failed to start storage." )
 		raise IKException( ErrorCode.operationFailed, "Failed to start storage."  )
 
-	return connHere, sigHere
-
+	return channels, sigHere
@@ -95,26 +95,33 @@ class Info( CmdProcessor ):
 		par = cmd["params"][0]
 		retCode = '1'
 		if par == df.ACCESS:
-			resp = "{0}".format( self.srv.acc )
+			# accLevel is "<name> (<octal mode>)"
+			accl = getShared( "accLevel" )
+			resp = "{0}".format( int( accl.rpartition( "(" )[2].rstrip( ")" ), 8 ) )
 		elif par == df.REP_STORAGE:
-			path = None
-			if len( cmd["params"] ) > 1:
-				if len( cmd["params"] == 2 ):
-					path = cmd["params"][1]
-				else:
-					raise IKException( ErrorCode.unrecognizedSyntax, " ".join( cmd["params"] ) )
-			resp = self.fs.stat( path )
+			if len( cmd["params"] ) > 2:
+				raise IKException( ErrorCode.unrecognizedSyntax, " ".join( cmd["params"] ) )
+			# The counters are kept by the storage
+			bresp = CmdSwitcher.switchCmd( { "cmd" : fs.FS_INFO, "params" : cmd["params"][1:] } )
+			retCode, resp = util.parsePacket( bresp )[:2]
 		elif par == df.REP_SERVER:
 			# TODO:
 			bs = getShared( "bytesSent" )
 			br = getShared( "bytesReceived" )
 			resp = "Bytes sent: {0}\n".format( bs )
 			resp += "Bytes received: {0}\n".format( br )
+			zfrom = int( getShared( "bytesCompressedFrom" ) )
+			zto = int( getShared( "bytesCompressedTo" ) )
+			resp += "Compressed responses: {0} bytes to {1} bytes (ratio: {2})\n".format( 
+						zfrom, zto, round( zfrom / zto, 2 ) if zto else "-" )
+			if fs.channels:
+				for k, v in fs.channels.stats().items():
+					resp += "{0}: {1}\n".format( k, v )
 		elif par == df.REP_COMMANDS:
 			resp = util.printMap( self.info["cmd"], 0)
 			pass
 		elif par == df.DATAFILE:
-			resp = self.fs.datafile
+			resp = getShared( "dataFile" )
 		else:
 			retCode = '0'
 			resp = "Unrecognized command parameter: " + par
@@ -31,7 +31,8 @@ class RegdFS( LoggingMixIn, Operations ):
 	def __init__( self, servaddr, mountpoint ):
 		self.servaddr = servaddr
 		self.mountpoint = mountpoint
-		self.rcom = RegdComm( servaddr )
+		# File contents are sent as native bytes
+		self.rcom = RegdComm( servaddr, codec = defs.CODEC_BINARY )
 		self.fd = 0
 
 	def rcmd( self, path, cmd, data = None ):
@@ -40,7 +41,7 @@ class RegdFS( LoggingMixIn, Operations ):
 		/host:NNNN/ - IP based servers
 		'''
 		addr, _, _ = path[1:].partition( "/" )
-		return comm.regdcmd( { "cmd": cmd, "params": data }, addr )
+		return comm.regdcmd( { "cmd": cmd, "params": data }, addr, codec = defs.CODEC_BINARY )
 
 	def chmod( self, path, mode ):
 		self.rcmd( path, "chmod", str( mode ) )
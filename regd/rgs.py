@@ -13,12 +13,13 @@
 
 __lastedited__ = "2016-06-16 13:43:06"
 
-import signal
+import os, signal
 import regd.serv as serv
 import regd.info as info
 import regd.cmds as cmds
 import regd.fs as fs
 import regd.defs as defs
+import regd.util as util
 from regd.util import log
 from regd.appsm.app import IKException, ErrorCode, sigHandler, ROAttr, glSignal
 
@@ -39,8 +40,22 @@ class Registry():
 # to False and condition notifying.  
 
 def startRegistry( servername, sockfile = None, host = None, port = None, acc = defs.PL_PRIVATE, 
-		datafile = None, binsecfile = None ):
-	srv = connStor = None
+		datafile = None, binsecfile = None, readyFd = None ):
+	'''Starts storage and server and runs the server loop. If readyFd is given, 
+	b'1' is written to it when the server accepts connections, or b'0' if the 
+	start fails.'''
+	srv = None
+	
+	def notifyLauncher( ok ):
+		nonlocal readyFd
+		if readyFd is None:
+			return
+		try:
+			os.write( readyFd, b'1' if ok else b'0' )
+			os.close( readyFd )
+		except OSError:
+			pass
+		readyFd = None
 	
 	def shutdown():
 		log.info("Registry is shutting down...")
@@ -60,17 +75,27 @@ def startRegistry( servername, sockfile = None, host = None, port = None, acc =
 	sigHandler.push( signal.SIGALRM, signal_handler )
 	
 	try:				
+		# Check for the previous instance. The lock is taken before the storage
+		# is started, so that it's held by all the processes of the instance.
+		try:
+			lockFd = util.lockInstance( sockfile )
+		except OSError as e:
+			log.error( "Cannot create the instance lock file: {0}".format( e ) )
+			return
+		if lockFd is None:
+			log.warning( "Server is already running: {0} is locked.".format( sockfile + ".lock" ) )
+			return
 		# Storage
 		log.debug( "Creating storage")
-		connStor, sigStor = fs.startStorage( acc, datafile, binsecfile )
+		_, sigStor = fs.startStorage( acc, datafile, binsecfile )
 		# Server
 		log.debug( "Creating server instance")
-		srv = serv.RegdServer( servername, sockfile, host, port, acc )
+		srv = serv.RegdServer( servername, sockfile, host, port, acc, lockFd )
 		# Info
 		log.debug( "Creating info")
 		info.Info( )
 		log.debug( "Starting server")
-		srv.start_loop( sigStor )
+		srv.start_loop( sigStor, lambda: notifyLauncher( True ) )
 	except Exception as e:
 		log.error( "Failed to start server: {0}".format( e ) )
 	else:
@@ -78,4 +103,7 @@ def startRegistry( servername, sockfile = None, host = None, port = None, acc =
 		# Wait till notification on df.SERVER_STOP 
 		#glSignal.wait()
 		shutdown()
+		srv.close()
 		log.info( "Exiting." )
+	finally:
+		notifyLauncher( False )
@@ -10,9 +10,12 @@
 ********************************************************************'''
 __lastedited__ = "2018-11-08 04:09:44"
 
-import sys, time, subprocess, os, pwd, signal, socket, struct, datetime, selectors
+import sys, time, subprocess, os, pwd, signal, socket, struct, datetime, selectors, select, shlex
 import multiprocessing as mp
+from collections import deque
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import ipaddress, shutil
 import regd.defs as defs
 import regd.util as util
@@ -23,11 +26,70 @@ import regd.appsm.app as app
 import regd.tok as modtok
 from regd.cmds import CmdSwitcher, CmdProcessor
 import regd.info as info
+import regd.fs as fs
 
 srv = None
 
 SRV_INFO = "SRV_INFO"
 
+# Default number of connection handler workers
+HANDLER_WORKERS = 4
+
+# Default number of seconds an idle client connection is kept open
+KEEPALIVE_TIMEOUT = 30
+
+# Maximal length of a command line of the text protocol
+TEXT_LINE_MAX = 1 << 20
+
+# Short switches of the text protocol
+TEXT_SWITCHES = { "-t": defs.TREE, "-f": defs.FORCE, "-r": defs.RECURS }
+
+# Server modes
+PROCESS_MODE = "process"
+ASYNCIO_MODE = "asyncio"
+
+class OutputQueue:
+	'''Responses of a connection waiting to be sent by a connection handler 
+	worker. A response is an iterator of packets, which is advanced only as the
+	connection takes the data, so a streamed response isn't read ahead of a slow
+	client.'''
+	def __init__( self ):
+		self.resps = deque()
+		self.view = None
+		# Whether the connection is closed once the queue is sent
+		self.closing = False
+
+	def __bool__( self ):
+		return bool( self.resps )
+
+	def add( self, resp ):
+		self.resps.append( iter( resp ) )
+
+	def send( self, sock ):
+		'''Sends the queued data without blocking. Returns True if all of it has
+		been sent.'''
+		while self.resps:
+			if not self.view:
+				try:
+					self.view = memoryview( next( self.resps[0] ) )
+				except StopIteration:
+					self.resps.popleft()
+				continue
+			try:
+				n = sock.send( self.view )
+			except BlockingIOError:
+				return False
+			self.view = self.view[n:]
+		return True
+
+	def close( self ):
+		'''Discards the queued responses.'''
+		for resp in self.resps:
+			if hasattr( resp, "close" ):
+				resp.close()
+		self.resps.clear()
+		self.view = None
+
 class RegdServer( CmdProcessor ):
 	'''Regd server.'''
 
@@ -43,7 +105,7 @@ class RegdServer( CmdProcessor ):
 	port 		= ROAttr( "port", str() )
 	acc 		= ROAttr( "acc", int() )
 
-	def __init__( self, servername, sockfile, host, port, acc ):
+	def __init__( self, servername, sockfile, host, port, acc, lockFd = None ):
 		super( RegdServer, self).__init__()
 		self.servername = servername
 		self.sockfile = sockfile
@@ -53,9 +115,23 @@ class RegdServer( CmdProcessor ):
 		self.sock = None
 		self.sigsock_r = None
 		self.sigsock_w = None
+		# Instance lock file, held by all the processes of this instance. It's 
+		# taken before the storage process is started ( see util.lockInstance ).
+		self.lockFd = lockFd
 		self.sel = None
 		self.info = {}
 		self.disposed = False
+		# Pool of connection handler processes
+		self.numWorkers = HANDLER_WORKERS
+		self.workers = []
+		self.mode = PROCESS_MODE
+		# Minimal size of compressed responses
+		self.compressThreshold = util.COMPRESS_THRESHOLD
+		# Idle time after which client connections are closed
+		self.keepAlive = KEEPALIVE_TIMEOUT
+		# Text protocol listener: socket file name or port number
+		self.textAddr = None
+		self.textSock = None
 
 		# Trusted
 		self.trustedUserids = []
@@ -84,11 +160,56 @@ class RegdServer( CmdProcessor ):
 					except:
 						continue
 					self.trustedUserids.append( uid )
-					
+
+		if "handler_workers" in d:
+			try:
+				self.numWorkers = max( 0, int( d["handler_workers"] ) )
+			except ValueError:
+				log.warning( "handler_workers option must be a number: '%s'." % ( d["handler_workers"] ) )
+
+		if "compress_threshold" in d:
+			try:
+				self.compressThreshold = max( 0, int( d["compress_threshold"] ) )
+			except ValueError:
+				log.warning( "compress_threshold option must be a number: '%s'." % ( d["compress_threshold"] ) )
+
+		if "max_packet_size" in d:
+			try:
+				util.MAX_PACKET_LEN = max( 1, int( d["max_packet_size"] ) ) * 2**20
+			except ValueError:
+				log.warning( "max_packet_size option must be a number: '%s'." % ( d["max_packet_size"] ) )
+
+		if "keepalive_timeout" in d:
+			try:
+				self.keepAlive = max( 0, int( d["keepalive_timeout"] ) )
+			except ValueError:
+				log.warning( "keepalive_timeout option must be a number: '%s'." % ( d["keepalive_timeout"] ) )
+
+		if d.get( "text_listener", "no" ).lower() in ( "yes", "true", "on", "1" ):
+			if not host:
+				self.textAddr = self.sockfile + ".text"
+			elif d.get( "text_port" ):
+				self.textAddr = d["text_port"]
+			else:
+				self.textAddr = str( int( port ) + 1 )
+
+		if "server_mode" in d:
+			if d["server_mode"] in ( PROCESS_MODE, ASYNCIO_MODE ):
+				self.mode = d["server_mode"]
+			else:
+				log.warning( "Unknown server_mode: '%s'. Using '%s'." % ( d["server_mode"], self.mode ) )
+
+		if self.mode == PROCESS_MODE and not self.numWorkers:
+			# A handler forked for one connection would unpickle the storage snapshot
+			# for a single command, which costs more than a round trip to storage.
+			fs.snapshot = None
+
 		RegdServer.registerGroupHandlers( self.processCmd )
 
 		info.setShared( "accLevel","{0} ({1})".format( defs.PL_NAMES[self.acc], oct(self.acc) ) )
 		info.setShared( "sockFile", self.sockfile )
+		info.setShared( "bytesCompressedFrom", 0 )
+		info.setShared( "bytesCompressedTo", 0 )
 
 	def __del__( self ):
 		# close() is better to be called earlier in order for closing routines not be
@@ -102,49 +223,25 @@ class RegdServer( CmdProcessor ):
 			log.debug("Already closed.")
 			return
 		self.disposed = True
-		if os.path.exists( str( self.sockfile ) ):
-			log.info( "Stopping server: unlinking socket file..." )
-			os.unlink( self.sockfile )
+		if self.textSock:
+			self.textSock.close()
+			if not self.host and os.path.exists( self.textAddr ):
+				os.unlink( self.textAddr )
+		# The socket file is removed only by the instance which has created it (not
+		# by an instance which has found another one running).
+		if self.sock:
+			self.sock.close()
+			if os.path.exists( str( self.sockfile ) ):
+				log.info( "Stopping server: unlinking socket file..." )
+				os.unlink( self.sockfile )
 		log.debug("Closed OK.")
 
-	def start_loop( self, sigStor ):
-		'''Start loop.'''
-
-		# Check for the previous instance
+	def start_loop( self, sigStor, onReady = None ):
+		'''Start loop. onReady is called when the server is accepting connections.'''
 
 		if not self.host and os.path.exists( self.sockfile ):
-			log.info( "Socket file for a server with name already exists. Checking for the server process." )
-			'''Socket file may remain after an unclean exit. Check if another server is running.'''
-			try:
-				# If the server is restarted, give the previous instance time to exit cleanly.
-				time.sleep( 2 )
-				if self.servername and self.servername != "regd":
-					s = "ps -ef | grep '{0}(/cli.py)? start .*{1} {2}' | grep -v grep".format( 
-												app.APPNAME,
-												app.clp( defs.SERVER_NAME ),
-												self.servername )
-				else:
-					s = "ps -ef | grep -E '{0}(/cli.py)? start' | grep -v '{1}' | grep -v grep".format( 
-												app.APPNAME,
-												app.clc( defs.SERVER_NAME ) )
-
-
-				res = subprocess.check_output( s, shell = True ).decode( 'utf-8' )
-
-			except subprocess.CalledProcessError as e:
-				if e.returncode != 1:
-					log.error( "Check for already running server instance failed: {0} ".format( e.output ) )
-					return -1
-				else:
-					res = ""
-
-			if len( res ):
-				# TODO
-				if res.count( "\n" ) > 2:
-					'''Server is already running.'''
-					log.warning( "Server is already running:\n{0}".format( res ) )
-					return 1
-			log.info( "Server process is not found. Unlinking the existing socket file." )
+			# Socket file may remain after an unclean exit
+			log.info( "Unlinking the socket file left by the previous instance." )
 			try:
 				os.unlink( self.sockfile )
 			except OSError:
@@ -174,11 +271,27 @@ class RegdServer( CmdProcessor ):
 				self.sock.bind( self.sockfile )
 				os.chmod( self.sockfile, mode = 0o777 )
 
-		except OSError as e:
+			if self.textAddr:
+				if self.host:
+					self.textSock = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+					self.textSock.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+					self.textSock.bind( ( self.host, int( self.textAddr ) ) )
+				else:
+					if os.path.exists( self.textAddr ):
+						os.unlink( self.textAddr )
+					self.textSock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+					self.textSock.bind( self.textAddr )
+					os.chmod( self.textAddr, mode = 0o777 )
+				self.textSock.listen( socket.SOMAXCONN )
+				self.textSock.setblocking( False )
+				info.setShared( "textListener", self.textAddr )
+				log.info( "Text protocol listener: {0}".format( self.textAddr ) )
+
+		except ( OSError, ValueError ) as e:
 			log.error( "Cannot create or bind socket: %s" % ( e ) )
 			return -1
 
-		self.sock.listen( 1 )
+		self.sock.listen( socket.SOMAXCONN if self.numWorkers else 1 )
 		self.sock.settimeout( 30 )
 		self.sel = selectors.DefaultSelector()
 		self.sigsock_r, self.sigsock_w = socket.socketpair()
@@ -187,7 +300,21 @@ class RegdServer( CmdProcessor ):
 		os.set_inheritable( self.sigsock_w.fileno(), True )
 		self.sock.setblocking( False )
 		signal.set_wakeup_fd( self.sigsock_w.fileno() )
-		self.sel.register( self.sock, selectors.EVENT_READ, self.accept )
+		# Connections are queued from now on
+		if onReady:
+			onReady()
+		if self.mode == ASYNCIO_MODE:
+			log.info( "Starting asyncio server loop." )
+			self.aloop( sigStor )
+			return
+		if self.numWorkers:
+			# Connections are accepted by the workers
+			log.info( "Starting {0} connection handler workers.".format( self.numWorkers ) )
+			self.startWorkers()
+		else:
+			self.sel.register( self.sock, selectors.EVENT_READ, self.accept )
+			if self.textSock:
+				self.sel.register( self.textSock, selectors.EVENT_READ, self.accept )
 		self.sel.register( self.sigsock_r, selectors.EVENT_READ, self.stop )
 		self.sel.register( sigStor, selectors.EVENT_READ, self.stop )
 		self.loop( self.sock, )
@@ -201,7 +328,10 @@ class RegdServer( CmdProcessor ):
 			for key, mask in events:
 				callback = key.data
 				callback(key.fileobj, mask)
-			
+
+			if self.workers and app.glCont:
+				self.checkWorkers()
+
 			if 0 : # not os.path.exists( self.sockfile ):
 				log.error( "Socket file {0} is gone. Exiting.".format( self.sockfile ) )
 				#exit( 1 )
@@ -216,9 +346,127 @@ class RegdServer( CmdProcessor ):
 			log.error( "Exception occured: ", e )
 			return
 
-		mp.Process( target = self.handle_connection, name = "RegdConnectionHandler",
-							args = ( connection, client_address, util.connLock ) ).start()
-							
+		handler = self.handle_text_connection if sock is self.textSock else self.handle_connection
+		mp.Process( target = handler, name = "RegdConnectionHandler",
+							args = ( connection, client_address ) ).start()
+
+	def startWorkers( self ):
+		'''Start connection handler workers up to the pool size.'''
+		while len( self.workers ) < self.numWorkers:
+			p = mp.Process( target = self.worker_loop, name = "RegdConnectionHandler",
+							args = ( self.sock, self.textSock ) )
+			p.daemon = True
+			p.start()
+			self.workers.append( p )
+
+	def checkWorkers( self ):
+		'''Replace workers which have exited.'''
+		alive = [p for p in self.workers if p.is_alive()]
+		if len( alive ) != len( self.workers ):
+			log.warning( "{0} connection handler worker(s) exited. Restarting.".format(
+											len( self.workers ) - len( alive ) ) )
+			self.workers = alive
+			self.startWorkers()
+
+	def stopWorkers( self ):
+		'''Terminate connection handler workers and the handlers of the open
+		connections started for each connection.'''
+		handlers = [p for p in mp.active_children() if p.name == "RegdConnectionHandler"]
+		for p in handlers:
+			p.terminate()
+		for p in handlers:
+			p.join( 1 )
+		self.workers = []
+
+	def worker_loop( self, sock, textSock = None ):
+		'''Connection handler worker. Takes connections from the listening
+		sockets and handles them in this process until terminated. Connections
+		are kept open between packets, and the worker serves the packets from 
+		all its open connections in the order of arrival. The data of each 
+		connection are read as they arrive, and a command is executed only when
+		its packet is complete, so a slow client doesn't hold up the others.
+		Responses are sent as the connections take them; a connection isn't read
+		until its previous responses have been sent.'''
+		self._handlerSignals()
+		ppid = os.getppid()
+		sel = selectors.DefaultSelector()
+		sel.register( sock, selectors.EVENT_READ )
+		if textSock:
+			sel.register( textSock, selectors.EVENT_READ )
+		# Text protocol connections are kept open even if keepAlive is 0
+		idle = self.keepAlive or KEEPALIVE_TIMEOUT
+		# Open client connections: connection -> [client address, uid, last use time,
+		# received incomplete line or packet, whether the connection uses text protocol,
+		# unsent responses]
+		conns = {}
+
+		def drop( connection ):
+			sel.unregister( connection )
+			conns.pop( connection )[5].close()
+			self._closeConnection( connection )
+
+		while os.getppid() == ppid:
+			events = sel.select( min( 30, idle ) if conns else 30 )
+			for key, mask in events:
+				if key.fileobj not in ( sock, textSock ):
+					connection = key.fileobj
+					client_address, uid, _, buf, text, out = conns[connection]
+					if mask & selectors.EVENT_READ:
+						if text:
+							cont = self.handle_text( connection, client_address, uid, buf, out )
+						else:
+							cont = self.handle_packets( connection, client_address, uid, buf, out )
+						out.closing = not cont
+					try:
+						sent = out.send( connection )
+					except OSError as e:
+						if not isinstance( e, ( ConnectionResetError, BrokenPipeError ) ):
+							log.error( "Socket error: {0}\nClient address: {1}\n".format( 
+										e, client_address ) )
+						drop( connection )
+						continue
+					if sent and out.closing:
+						drop( connection )
+						continue
+					conns[connection][2] = time.monotonic()
+					wanted = selectors.EVENT_READ if sent else selectors.EVENT_WRITE
+					if key.events != wanted:
+						sel.modify( connection, wanted )
+					continue
+				try:
+					connection, client_address = key.fileobj.accept()
+				except BlockingIOError:
+					# The connection has been taken by another worker
+					continue
+				except OSError as e:
+					log.error( "Exception occured: {0}".format( e ) )
+					continue
+
+				try:
+					uid = self._getPeerUid( connection, client_address )
+				except OSError as e:
+					log.error( "Exception occured: {0}".format( e ) )
+					self._closeConnection( connection )
+					continue
+				connection.setblocking( False )
+				text = key.fileobj is textSock
+				conns[connection] = [client_address, uid, time.monotonic(), 
+									bytearray() if text else util.PacketReader(), text,
+									OutputQueue()]
+				sel.register( connection, selectors.EVENT_READ )
+
+			# Closing idle connections
+			tm = time.monotonic() - idle
+			for connection in [x for x, v in conns.items() if v[2] < tm]:
+				drop( connection )
+
+	def _handlerSignals( self ):
+		'''Signal setup of connection handler processes. Stopping is coordinated 
+		by the server process, which terminates the handlers.'''
+		signal.set_wakeup_fd( -1 )
+		signal.signal( signal.SIGTERM, signal.SIG_DFL )
+		signal.signal( signal.SIGINT, signal.SIG_IGN )
+
 	def stop(self, sock, mask):
 		'''Regd stop handler. The program is normally stopped only through this.
 		It's called when the sigsocket receives input ( including notification 
@@ -229,7 +477,7 @@ class RegdServer( CmdProcessor ):
 			app.glSignal.acquire()
 			app.glSignal.notify()
 			app.glSignal.release()
-		self.close()
+		self.stopWorkers()
 			
 	def chSrvInfo( self, cmd ):
 		path = cmd.get("params")
@@ -242,12 +490,52 @@ class RegdServer( CmdProcessor ):
 			return util.printMap( m, 0 )
 
 	def handle_connection( self, *args ):
-		'''Exceptions-catcher wrapper'''
+		'''Handles the packets from a connection until it's closed by client or
+		stays idle for keepAlive seconds.'''
 		connection = args[0]
 		client_address = args[1]
-		storage_lock = args[2]
+		self._handlerSignals()
+		try:
+			uid = self._getPeerUid( connection, client_address )
+			while self.handle_packet( connection, client_address, uid ):
+				if not self.keepAlive:
+					break
+				r, _, _ = select.select( [connection], [], [], self.keepAlive )
+				if not r:
+					break
+		except OSError as e:
+			log.error( "Exception in connection handler: %s" % ( e ) )
+		finally:
+			self._closeConnection( connection )
+
+	def handle_packets( self, connection, client_address, uid, reader, out ):
+		'''Reads the available data from a non-blocking connection and answers 
+		the complete packets in it. reader ( util.PacketReader ) keeps the incomplete
+		last packet between the calls. The responses are queued in out ( OutputQueue ),
+		and reading stops at a response which has to wait. Returns False if the 
+		connection has been closed by client or must be closed.'''
 		try:
-			self._handle_connection( connection, client_address, storage_lock )
+			while not out:
+				if not reader.receive( connection ):
+					return True
+				if not self.handle_packet( connection, client_address, uid, reader.take(), out ) \
+						or not self.keepAlive:
+					return False
+			return True
+		except ( EOFError, ConnectionResetError ):
+			return False
+		except IKException as e:
+			log.error( ( "Exception while handling connection."
+						"Client: %s ; Exception: %s" ) % ( client_address, e ) )
+		except OSError as e:
+			log.error( "Socket error: {0}\nClient address: {1}\n".format( e, client_address ) )
+		return False
+
+	def handle_packet( self, connection, client_address, uid, packet = None, out = None ):
+		'''Exceptions-catcher wrapper. Returns False if the connection must be 
+		closed.'''
+		try:
+			return self._handle_packet( connection, client_address, uid, packet, out )
 		except IKException as e:
 			log.error( ( "Exception while handling connection."
 						"Client: %s ; Exception: %s" ) % ( client_address, e ) )
@@ -255,33 +543,280 @@ class RegdServer( CmdProcessor ):
 		except Exception as e:
 			log.error( "Exception in connection handler: %s" % ( e ) )
 			self.sigsock_w.send("stop".encode())
+		return False
 
-		finally:
+	def _closeConnection( self, connection ):
+		try:
 			connection.shutdown( socket.SHUT_RDWR )
-			connection.close()
-
-	def _handle_connection( self, connection, client_address, storage_lock ):
-		'''Connection handler'''
-		if not self.host:
-			creds = connection.getsockopt( socket.SOL_SOCKET, socket.SO_PEERCRED,
-									struct.calcsize( "3i" ) )
-			pid, uid, gid = struct.unpack( "3i", creds )
-			log.debug( "new connection: pid: {0}; uid: {1}; gid: {2}".format( pid, uid, gid ) )
+		except OSError:
+			# Already closed by client
+			pass
+		connection.close()
+
+	def _handle_packet( self, connection, client_address, uid, packet = None, out = None ):
+		'''Reads one command packet from the connection, unless its data and 
+		header flag are given in packet, and sends the response. If out 
+		( OutputQueue ) is given, the response is queued in it instead. Returns 
+		False if the connection has been closed by client or must be closed.'''
+		if out is None:
+			connection.settimeout( 5 )
+
+		if packet:
+			data, flag = packet
 		else:
-			log.debug( "new connection: client address: %s" % ( str( client_address ) ) )
+			try:
+				if not connection.recv( 1, socket.MSG_PEEK ):
+					# Connection is closed by client
+					return False
+			except ConnectionResetError:
+				return False
+			except OSError as e:
+				raise IKException( ErrorCode.clientConnectionError, moreInfo = str( e ) )
+
+			data, flag = util.recvPacket( connection )
+		bytesReceived = len( data ) + 10
+		data = util.unpackData( data, flag )
+
+		log.debug( "data: %s" % ( bytes( data[:1000] ) ) )
+		util.setCodec( util.packetCodec( data ) )
 
-		connection.settimeout( 5 )
+		cmd = None
+		perm = False
+		rid = None
+		try:
+			dcmd = self._parseCmd( data )
+			cmd = dcmd["cmd"]
+			# Tagged packets are answered in the order of arrival
+			rid = dcmd.pop( defs.REQUEST_ID, None )
+		except Exception as e:
+			bresp = composeResponse( "0", "Exception while parsing the command: " + str( e ) )
+		else:
+			bresp, perm = self._processCmd( dcmd, uid, client_address )
 
-		data = bytearray()
-		util.recvPack( connection, data )
-		bytesReceived = len( data )
+		stop = cmd == defs.STOP_SERVER and perm
+		packs = self._respPacks( bresp, flag, rid, bytesReceived, stop )
+		if out is not None:
+			out.add( packs )
+			return not stop
+		try:
+			for pack in packs:
+				connection.sendall( pack )
+		except OSError as er:
+			log.error( "Socket error {0}: {1}\nClient address: {2}\n".format( 
+							er.errno, er.strerror, client_address ) )
+			return False
+		finally:
+			packs.close()
 
-		log.debug( "data: %s" % ( data[:1000] ) )
-		data = data[10:]  # .decode( 'utf-8' )
+		return not stop
 
-		bresp = bytearray()
+	def _respPacks( self, bresp, flag, rid, bytesReceived, stop ):
+		'''Generates the packets of the response to a command packet. The bytes 
+		are counted, and the server is stopped if requested, after the last packet 
+		has been sent.'''
+		# A streamed response is sent as a sequence of packets
+		frames = [bresp] if type( bresp ) is bytes else bresp
+		bytesSent = zFrom = zTo = 0
+		try:
+			for frame in frames:
+				if rid is not None:
+					frame = util.tagResponse( rid, frame )
+				frame, zflag, rawlen = self._compressResp( frame, flag )
+				pack = util.framePack( frame, zflag )
+				yield pack
+				bytesSent += len( pack )
+				if rawlen:
+					zFrom += rawlen
+					zTo += len( frame )
+		finally:
+			if frames is bresp:
+				bresp.close()
+		self._countBytes( bytesReceived, bytesSent, zFrom, zTo )
+		if stop:
+			self.sigsock_w.send("stop".encode())
+
+	def handle_text_connection( self, connection, client_address ):
+		'''Handles the command lines from a text protocol connection until it's 
+		closed by client or stays idle for keepAlive seconds.'''
+		buf = bytearray()
+		self._handlerSignals()
+		try:
+			uid = self._getPeerUid( connection, client_address )
+			while True:
+				r, _, _ = select.select( [connection], [], [], self.keepAlive or KEEPALIVE_TIMEOUT )
+				if not r or not self.handle_text( connection, client_address, uid, buf ):
+					break
+		except OSError as e:
+			log.error( "Exception in connection handler: %s" % ( e ) )
+		finally:
+			self._closeConnection( connection )
+
+	def handle_text( self, connection, client_address, uid, buf, out = None ):
+		'''Exceptions-catcher wrapper. Returns False if the connection must be 
+		closed.'''
+		try:
+			return self._handle_text( connection, client_address, uid, buf, out )
+		except Exception as e:
+			log.error( ( "Exception while handling connection."
+						"Client: %s ; Exception: %s" ) % ( client_address, e ) )
+		return False
+
+	def _handle_text( self, connection, client_address, uid, buf, out = None ):
+		'''Reads the available data from a text protocol connection and answers
+		the complete command lines in it. buf keeps the incomplete last line between
+		the calls. If out ( OutputQueue ) is given, the responses are queued in it. 
+		Returns False if the connection has been closed by client or must be closed.'''
+		if out is None:
+			connection.settimeout( 5 )
+		try:
+			data = connection.recv( 65536 )
+		except ConnectionResetError:
+			return False
+		if not data:
+			# The last line may come without a newline
+			if buf:
+				resp, stop = self._processTextCmd( bytes( buf ), uid, client_address )
+				self._sendText( connection, resp, stop, out )
+			return False
+		buf += data
+		pos = buf.rfind( b"\n" )
+		if pos < 0:
+			return len( buf ) <= TEXT_LINE_MAX
+		lines = bytes( buf[:pos] ).split( b"\n" )
+		del buf[:pos + 1]
+		for line in lines:
+			resp, stop = self._processTextCmd( line, uid, client_address )
+			self._sendText( connection, resp, stop, out )
+			if stop:
+				return False
+		return True
+
+	def _sendText( self, connection, resp, stop, out ):
+		'''Sends or queues in out the response line of the text protocol. The 
+		server is stopped if requested, after the response has been sent.'''
+		lines = self._textLines( resp, stop )
+		if out is not None:
+			out.add( lines )
+			return
+		for line in lines:
+			connection.sendall( line )
+
+	def _textLines( self, resp, stop ):
+		if resp:
+			yield resp
+		if stop:
+			self.sigsock_w.send("stop".encode())
+
+	def _processTextCmd( self, line, uid, client_address ):
+		'''Executes a text protocol command line. Returns the response line (None
+		for empty lines) and True if the server must be stopped after sending it.'''
+		line = line.decode( "utf-8", "replace" ).strip()
+		if not line:
+			return None, False
 		cmd = None
 		perm = False
+		try:
+			dcmd = self._parseTextCmd( line )
+			cmd = dcmd["cmd"]
+		except Exception as e:
+			res, ret = False, "Exception while parsing the command: " + str( e )
+		else:
+			bresp, perm = self._processCmd( dcmd, uid, client_address, defs.CODEC_JSON )
+			res, ret = util.unpackResponse( util.parsePacket( bresp ) )
+		resp = ( util.formatResult( res, ret ) + "\n" ).encode( "utf-8" )
+		self._countBytes( len( line ) + 1, len( resp ) )
+		return resp, cmd == defs.STOP_SERVER and perm
+
+	def _parseTextCmd( self, line ):
+		'''Parses a command line of the text protocol. The line has the form of 
+		the regd command line: the command name followed by parameters and 
+		'--option' or '--option=value' words. Words are quoted as in shell.'''
+		words = shlex.split( line )
+		dcmd = { "cmd": app.declc( words[0].lower() ), "params": [] }
+		for w in words[1:]:
+			if w in TEXT_SWITCHES:
+				dcmd[TEXT_SWITCHES[w]] = True
+				continue
+			if not w.startswith( "--" ):
+				dcmd["params"].append( w )
+				continue
+			opt, eq, val = w[2:].partition( "=" )
+			opt = app.declc( opt )
+			if opt in ( "cmd", "params", "internal" ):
+				raise Exception( "Unrecognized syntax." )
+			if eq:
+				dcmd.setdefault( opt, [] ).append( val )
+			else:
+				dcmd[opt] = True
+		# Packet-only commands and options
+		if dcmd["cmd"] in ( defs.BATCH, defs.TRANSACTION ):
+			raise Exception( "Unrecognized syntax." )
+		dcmd.pop( defs.STREAM, None )
+		log.debug( "text command received: {0}".format( dcmd["cmd"] ) )
+		return dcmd
+
+	def _getPeerUid( self, connection, client_address ):
+		'''Returns the user id of the client on a file socket server.'''
+		if self.host:
+			log.debug( "new connection: client address: %s" % ( str( client_address ) ) )
+			return None
+		creds = connection.getsockopt( socket.SOL_SOCKET, socket.SO_PEERCRED,
+								struct.calcsize( "3i" ) )
+		pid, uid, gid = struct.unpack( "3i", creds )
+		log.debug( "new connection: pid: {0}; uid: {1}; gid: {2}".format( pid, uid, gid ) )
+		return uid
+
+	def _parseCmd( self, data ):
+		'''Parses the command packet received from client.'''
+		dcmd = util.parsePacket( data )
+		# 'internal' switch is only used within regd server
+		if "internal" in dcmd:
+			raise Exception("Unrecognized syntax.")
+		log.debug( "command received: {0}".format( dcmd["cmd"] ) )
+		return dcmd
+
+	def _checkPerm( self, cmd, uid, client_address ):
+		'''Checks whether the client is permitted to execute the command.'''
+		perm = False
+		if self.host:
+			# IP-based server
+			if not self.trustedIps:
+				perm = True
+			else :
+				try:
+					clientIp = ipaddress.IPv4Address( client_address[0] )
+				except ValueError:
+					log.error( "Client IP address format is not recognized." )
+				else:
+					for i in self.trustedIps:
+						if clientIp in i:
+							perm = True
+							log.debug( "Client IP is trusted." )
+							break
+					if not perm:
+						log.error( "Client IP is NOT trusted : '%s : %s" %
+								( client_address[0], client_address[1] ) )
+		else:
+			# File socket server
+			if self.useruid == uid:
+				perm = True
+			elif uid in self.trustedUserids:
+				perm = True
+			elif cmd not in defs.secure_cmds:
+				if self.acc == defs.PL_PUBLIC:
+					perm = True
+				elif self.acc == defs.PL_PUBLIC_READ:
+					if cmd in defs.pubread_cmds:
+						perm = True
+		log.debug( "perm: {0}".format( perm ) )
+		return perm
+
+	def _processCmd( self, dcmd, uid, client_address, codec = None ):
+		'''Checks permission and executes the command. Returns the response and 
+		the permission flag.'''
+		if codec:
+			# Commands received by the asyncio loop are executed in executor threads
+			util.setCodec( codec )
 		# dcmd - command dictionary. Contains three fields:
 		# cmd - command name, received from client
 		# params - command parameters, received from client
@@ -290,73 +825,208 @@ class RegdServer( CmdProcessor ):
 		# command semantics: if it's 0 - this means a general program error, e.g.
 		# non-existing command name. It's meant to be handled by the server before
 		# sending response to the client.
-		
-		try:
-			dcmd = util.parsePacket( data )
-			# 'internal' switch is only used within regd server
-			if "internal" in dcmd:
-				raise Exception("Unrecognized syntax.")
-			cmd = dcmd["cmd"]
-			log.debug( "command received: {0}".format( cmd ) )
-		except Exception as e:
-			bresp = composeResponse( "0", "Exception while parsing the command: " + str( e ) )
+		cmd = dcmd["cmd"]
+		if cmd in ( defs.BATCH, defs.TRANSACTION ):
+			# Batch and transaction are permitted when each of their commands is
+			subs = dcmd.get( "params" ) or []
+			perm = all( self._checkPerm( x.get( "cmd" ) if isinstance( x, dict ) else None, 
+									uid, client_address ) for x in subs )
 		else:
-			# Check permission and persistency
-			
+			perm = self._checkPerm( cmd, uid, client_address )
+		if not perm:
+			return composeResponse( "0", str( IKException( ErrorCode.permissionDenied, cmd ) ) ), perm
+		#elif not self.datafile and defs.PERS in cmd:
+		#	bresp = composeResponse( "0", str( IKException( ErrorCode.operationFailed, None, "Persistent tokens are not enabled." ) ) )
+
+		return CmdSwitcher.handleCmd( dcmd ), perm
+
+	def _compressResp( self, bresp, flag ):
+		'''Compresses the response if the client accepts it. Returns the response, 
+		the header flag and the length before compression if compressed.'''
+		if flag not in ( util.HDR_ACCEPT_Z, util.HDR_Z ):
+			return bresp, None, None
+		rawlen = len( bresp )
+		bresp, zflag = util.compressPack( bresp, self.compressThreshold )
+		return bresp, zflag, ( rawlen if zflag else None )
+
+	def _countBytes( self, bytesReceived, bytesSent, bytesUncompressed = None, 
+					bytesCompressed = None ):
+		info.setShared( "bytesReceived", bytesReceived, defs.SUM )
+		info.setShared( "bytesSent", bytesSent, defs.SUM )
+		if bytesUncompressed:
+			if bytesCompressed is None:
+				bytesCompressed = bytesSent - 10
+			info.setShared( "bytesCompressedFrom", bytesUncompressed, defs.SUM )
+			info.setShared( "bytesCompressedTo", bytesCompressed, defs.SUM )
+
+	def aloop( self, sigStor ):
+		'''Asyncio server loop. Client connections are kept open and can carry
+		any number of command packets. Packets tagged with a request id are
+		processed concurrently and their responses are tagged with the same id;
+		untagged packets are processed in the order of arrival.'''
+		self.aio = asyncio.new_event_loop()
+		asyncio.set_event_loop( self.aio )
+		self.executor = ThreadPoolExecutor( max( 1, self.numWorkers ) )
+		self.sock.setblocking( False )
+		if self.host:
+			srv = asyncio.start_server( self.ahandle_connection, sock = self.sock )
+		else:
+			srv = asyncio.start_unix_server( self.ahandle_connection, sock = self.sock )
+		server = self.aio.run_until_complete( srv )
+		servers = [server]
+		if self.textSock:
 			if self.host:
-				# IP-based server
-				if not self.trustedIps:
-					perm = True
-				else :
-					try:
-						clientIp = ipaddress.IPv4Address( client_address[0] )
-					except ValueError:
-						log.error( "Client IP address format is not recognized." )
-					else:
-						for i in self.trustedIps:
-							if clientIp in i:
-								perm = True
-								log.debug( "Client IP is trusted." )
-								break
-						if not perm:
-							log.error( "Client IP is NOT trusted : '%s : %s" %
-									( client_address[0], client_address[1] ) )
+				srv = asyncio.start_server( self.ahandle_text, sock = self.textSock, 
+										limit = TEXT_LINE_MAX )
 			else:
-				# File socket server
-				if self.useruid == uid:
-					perm = True
-				elif uid in self.trustedUserids:
-					perm = True
-				elif cmd not in defs.secure_cmds:
-					if self.acc == defs.PL_PUBLIC:
-						perm = True
-					elif self.acc == defs.PL_PUBLIC_READ:
-						if cmd in defs.pubread_cmds:
-							perm = True
-			log.debug( "perm: {0}".format( perm ) )
-			if not perm:
-				bresp = composeResponse( "0", str( IKException( ErrorCode.permissionDenied, cmd ) ) )
-			#elif not self.datafile and defs.PERS in cmd:
-			#	bresp = composeResponse( "0", str( IKException( ErrorCode.operationFailed, None, "Persistent tokens are not enabled." ) ) )
-		
-		if not len( bresp ):
-			util.connLock = storage_lock
-			bresp = CmdSwitcher.handleCmd( dcmd )
+				srv = asyncio.start_unix_server( self.ahandle_text, sock = self.textSock,
+										limit = TEXT_LINE_MAX )
+			servers.append( self.aio.run_until_complete( srv ) )
+
+		def onStop( sock ):
+			self.stop( sock, None )
+			self.aio.stop()
 
+		self.aio.add_reader( self.sigsock_r, onStop, self.sigsock_r )
+		self.aio.add_reader( sigStor, onStop, sigStor )
 		try:
-			bytesSent = util.sendPack( connection, bresp )
-		except OSError as er:
-			log.error( "Socket error {0}: {1}\nClient address: {2}\n".format( 
-							er.errno, er.strerror, client_address ) )
-		else: 
-			if type( bytesSent ) is int:
-				info.setShared( "bytesReceived", bytesReceived, defs.SUM )
-				info.setShared( "bytesSent", bytesSent, defs.SUM )
+			self.aio.run_forever()
+		finally:
+			self.aio.remove_reader( self.sigsock_r )
+			self.aio.remove_reader( sigStor )
+			for server in servers:
+				server.close()
+			# Closing client connections
+			pending = asyncio.all_tasks( self.aio )
+			for t in pending:
+				t.cancel()
+			self.aio.run_until_complete( asyncio.gather( *pending, return_exceptions = True ) )
+			for server in servers:
+				self.aio.run_until_complete( server.wait_closed() )
+			self.executor.shutdown( wait = True )
+			self.aio.close()
 
-		if cmd == defs.STOP_SERVER and perm:
-			self.sigsock_w.send("stop".encode())
+	async def ahandle_connection( self, reader, writer ):
+		'''Exceptions-catcher wrapper'''
+		client_address = writer.get_extra_info( "peername" )
+		try:
+			await self._ahandle_connection( reader, writer, client_address )
+		except asyncio.CancelledError:
+			# Server is stopping
+			pass
+		except IKException as e:
+			log.error( ( "Exception while handling connection."
+						"Client: %s ; Exception: %s" ) % ( client_address, e ) )
+		except Exception as e:
+			log.error( "Exception in connection handler: %s" % ( e ) )
+		finally:
+			writer.close()
+
+	async def _ahandle_connection( self, reader, writer, client_address ):
+		'''Persistent connection handler'''
+		uid = self._getPeerUid( writer.get_extra_info( "socket" ), client_address )
+		wlock = asyncio.Lock()
+		tasks = set()
+
+		async def send( bresp, rid, bytesReceived, flag ):
+			if rid is not None:
+				bresp = util.tagResponse( rid, bresp )
+			if flag:
+				bresp, zflag, rawlen = await self.aio.run_in_executor( self.executor,
+											self._compressResp, bresp, flag )
+			else:
+				zflag = rawlen = None
+			pack = util.framePack( bresp, zflag )
+			async with wlock:
+				writer.write( pack )
+				await writer.drain()
+			self.aio.run_in_executor( self.executor, self._countBytes, bytesReceived, len( pack ), 
+									rawlen )
+
+		async def respond( dcmd, rid, bytesReceived, codec, flag ):
+			bresp, perm = await self.aio.run_in_executor( self.executor,
+									self._processCmd, dcmd, uid, client_address, codec )
+			stream = None
+			if type( bresp ) is not bytes:
+				# Streamed response: frames are read from storage one by one
+				stream = bresp
+				bresp = await self.aio.run_in_executor( self.executor, next, stream, None )
+			try:
+				while bresp is not None:
+					await send( bresp, rid, bytesReceived, flag )
+					bytesReceived = 0
+					if not stream:
+						break
+					bresp = await self.aio.run_in_executor( self.executor, next, stream, None )
+			except ConnectionError as e:
+				# Responses to tagged packets are sent from separate tasks
+				log.error( "Connection error: {0}\nClient address: {1}\n".format( e, client_address ) )
+			finally:
+				if stream:
+					await self.aio.run_in_executor( self.executor, stream.close )
+			if dcmd["cmd"] == defs.STOP_SERVER and perm:
+				self.sigsock_w.send("stop".encode())
+
+		try:
+			while True:
+				try:
+					hdr = await reader.readexactly( 10 )
+				except asyncio.IncompleteReadError as e:
+					if e.partial:
+						raise IKException( ErrorCode.clientConnectionError, moreInfo = "Incomplete packet" )
+					# Connection is closed by client
+					break
+				packlen, flag = util.packHeader( hdr )
+				data = await reader.readexactly( packlen )
+				rid = None
+				try:
+					data = util.unpackData( data, flag )
+					util.setCodec( util.packetCodec( data ) )
+					dcmd = self._parseCmd( data )
+					rid = dcmd.pop( defs.REQUEST_ID, None )
+				except Exception as e:
+					bresp = composeResponse( "0", "Exception while parsing the command: " + str( e ) )
+					async with wlock:
+						writer.write( util.framePack( bresp ) )
+						await writer.drain()
+					continue
+
+				if rid is None:
+					await respond( dcmd, None, packlen + 10, util.getCodec(), flag )
+				else:
+					t = self.aio.create_task( respond( dcmd, rid, packlen + 10, util.getCodec(), flag ) )
+					tasks.add( t )
+					t.add_done_callback( tasks.discard )
+		finally:
+			if tasks:
+				await asyncio.wait( tasks )
 
-		return
+	async def ahandle_text( self, reader, writer ):
+		'''Text protocol connection handler. Command lines are executed one after
+		another.'''
+		client_address = writer.get_extra_info( "peername" )
+		try:
+			uid = self._getPeerUid( writer.get_extra_info( "socket" ), client_address )
+			while True:
+				line = await reader.readline()
+				if not line:
+					break
+				resp, stop = await self.aio.run_in_executor( self.executor,
+									self._processTextCmd, line, uid, client_address )
+				if resp:
+					writer.write( resp )
+					await writer.drain()
+				if stop:
+					self.sigsock_w.send("stop".encode())
+					break
+		except asyncio.CancelledError:
+			# Server is stopping
+			pass
+		except Exception as e:
+			log.error( ( "Exception while handling connection."
+						"Client: %s ; Exception: %s" ) % ( client_address, e ) )
+		finally:
+			writer.close()
 
 	def handleBinToken(self, dest, tok, optmap):
 		if dest:
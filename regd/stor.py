@@ -23,6 +23,8 @@ from regd.defs import dirInclude
 from regd.tok import parse_token, stripOne
 from regd.util import logsr
 from collections import deque, OrderedDict
+from bisect import bisect_left
+from types import MappingProxyType
 
 from errno import ENOENT
 from stat import S_IFDIR, S_IFLNK, S_IFREG
@@ -41,10 +43,36 @@ reDataDirect = re.compile( DATADIRECTPATT )
 reTok = re.compile( TOKENPATT, re.DOTALL )
 reMlTok = re.compile( MULTILINETOKENPATT )
 reEmpty = re.compile( "^\r?\n?$" )
+# Path strings which parse_token would change: escapes, values, spaces next to 
+# separators, empty names and trailing slashes
+reNonCanonPath = re.compile( r"[\\=]| /|/ |//|./$" )
 
 changed = []
 lock_changed = threading.Lock()
 treeLoad = False
+# Active transaction
+transaction = None
+# Paths of the recently set and deleted items: ( change number, path )
+changeLog = deque( maxlen = 10000 )
+changeNum = 0
+logChanges = True
+
+def logChange( path ):
+	'''Records the path of a changed item in changeLog.'''
+	global changeNum
+	if treeLoad or not logChanges:
+		return
+	changeNum += 1
+	changeLog.append( ( changeNum, path ) )
+
+def changesSince( num ):
+	'''Returns the paths changed after the change number num, or None if 
+	the changes are not in changeLog anymore.'''
+	if num > changeNum or ( changeLog and changeLog[0][0] > num + 1 ):
+		return None
+	if num == changeNum:
+		return []
+	return list( OrderedDict.fromkeys( x[1] for x in changeLog if x[0] > num ) )
 
 class EnumMode( Enum ):
 	both		 = 1
@@ -54,21 +82,58 @@ class EnumMode( Enum ):
 	tokensAll	 = 5
 	sectionsAll	 = 6
 
+# Owner of the items created without explicit uid and gid
+procUid = os.getuid()
+procGid = os.getgid()
+
 class st_struct:
-	'''stat struct'''
+	'''stat struct. Items created without explicit times share one instance 
+	(see sharedSt), so it must not be modified in place.'''
+	__slots__ = ( "st_mode", "st_uid", "st_gid", "st_ctime", "st_mtime", "st_atime", "st_nlink" )
+
 	def __init__( self, mode = None, uid = None, gid = None, ctime = None, mtime = None, atime = None,
 				nlink = None ):
 		nowtm = time.time()
 		self.st_mode = mode if mode else 0o644
-		self.st_uid = uid if uid else os.getuid()
-		self.st_gid = gid if gid else os.getgid()
+		self.st_uid = uid if uid else procUid
+		self.st_gid = gid if gid else procGid
 		self.st_ctime = ctime if ctime else nowtm
 		self.st_mtime = mtime if mtime else nowtm
 		self.st_atime = atime if atime else nowtm
 		self.st_nlink = nlink if nlink else 1
 
+	def copy( self, **kwargs ):
+		'''Returns a copy with the fields in kwargs replaced.'''
+		st = st_struct.__new__( st_struct )
+		for k in st_struct.__slots__:
+			setattr( st, k, kwargs.get( k, getattr( self, k ) ) )
+		return st
+
+# Stat structs shared by the items created in the same second with the same 
+# mode and owner: ( mode, uid, gid, nlink, second ) -> st_struct
+stCache = {}
+ST_CACHE_MAX = 64
+
+def sharedSt( mode = None, uid = None, gid = None, nlink = None ):
+	'''Returns the shared stat struct for an item created now.'''
+	nowtm = time.time()
+	key = ( mode, uid, gid, nlink, int( nowtm ) )
+	st = stCache.get( key )
+	if st is None:
+		if len( stCache ) >= ST_CACHE_MAX:
+			stCache.clear()
+		st = stCache[key] = st_struct( mode, uid, gid, nowtm, nowtm, nowtm, nlink )
+	return st
+
+# Attributes of the items without extended attributes
+noAttrs = MappingProxyType( {} )
+
 class SItem:
-	'''Storage item'''
+	'''Storage item. Tokens are the bulk of the storage, so SVal keeps its fields 
+	in __slots__, shares the stat struct with the items created along with it and
+	creates the attribute dict only when the first attribute is set.'''
+	__slots__ = ()
+
 	class Attrs( Enum ):
 		persPath 	 = 0  # Persistent storage path
 		encoding	 = 1
@@ -77,16 +142,38 @@ class SItem:
 	# stor.SItem.Attrs.persPath.name => stor.SItem.persPathAttrName
 	persPathAttrName = Attrs.persPath.name
 
-	def __init__( self, itype, rootStor, mode = None, uid = None, gid = None, ctime = None, mtime = None, atime = None,
+	def __init__( self, rootStor, mode = None, uid = None, gid = None, ctime = None, mtime = None, atime = None,
 				nlink = None, name = '', attrs = None ):
 		self.name = name
 		self.rootStor = rootStor
-		self.itype = itype
-		self.st = st_struct( mode, uid, gid, ctime, mtime, atime, nlink )
-		self.attrs = attrs if attrs else {}
+		if ctime or mtime or atime:
+			self.st = st_struct( mode, uid, gid, ctime, mtime, atime, nlink )
+		else:
+			self.st = sharedSt( mode, uid, gid, nlink )
+		self.attrs = attrs
 		self.storageRef = None
 		self.changed = False
 		return super( SItem, self ).__init__()
+
+	@property
+	def attrs( self ):
+		'''Extended attributes. Read-only if the item has none, use setAttr.'''
+		return self._attrs if self._attrs is not None else noAttrs
+
+	@attrs.setter
+	def attrs( self, attrs ):
+		self._attrs = attrs if attrs else None
+
+	def _setAttr( self, attrName, attrVal ):
+		if self._attrs is None:
+			self._attrs = {}
+		self._attrs[attrName] = attrVal
+
+	def setMode( self, mode ):
+		'''Sets permission bits. The stat struct can be shared, so it is replaced.'''
+		if type( mode ) is str:
+			mode = int( mode, 8 )
+		self.st = self.st.copy( st_mode = mode )
 	
 	def value(self):
 		raise NotImplementedError()
@@ -101,16 +188,16 @@ class SItem:
 				'st_atime':int( self.st.st_atime ), 'st_mtime':int( self.st.st_mtime ) }
 			return ret
 		if attrName == "Extended":
-			return self.attrs
+			return dict( self.attrs )
 		elif attrName not in self.attrs:
 			return None
 		return self.attrs[attrName]
 
 	def setAttr( self, attrName, attrVal ):
 		if attrName == 'st_mode':
-			self.st_mode = attrVal
+			self.setMode( attrVal )
 		else:
-			self.attrs[attrName] = attrVal
+			self._setAttr( attrName, attrVal )
 			if attrName == SItem.persPathAttrName:
 				self.setStorageRef( self )
 
@@ -120,9 +207,9 @@ class SItem:
 			k = k.strip()
 			v = v.strip()
 			if k == 'st_mode':
-				self.st_mode = v
+				self.setMode( v )
 			else:
-				self.attrs[k] = v
+				self._setAttr( k, v )
 				if k == SItem.Attrs.persPath.name:
 					self.setStorageRef( self )
 		return self
@@ -142,6 +229,9 @@ class SItem:
 	def markChanged( self ):
 		if treeLoad:
 			return
+		if transaction:
+			transaction.marked[id( self )] = self
+			return
 		self.changed = True
 		if self.storageRef != None and self.storageRef != self:
 			self.storageRef.markChanged()
@@ -245,12 +335,15 @@ class SItem:
 
 class SVal( SItem ):
 	'''Storage value container.'''
+	__slots__ = ( "val", "stor", "name", "rootStor", "st", "_attrs", "storageRef", "changed" )
+	itype = S_IFREG
+
 	def __init__( self, rootStor, val = None, mode = None, uid = None, gid = None, ctime = None, mtime = None, atime = None,
 				nlink = None, name = '', attrs = None ):
 		self.val = val
 		# Reference to the containing stor
 		self.stor = None
-		return super( SVal, self ).__init__( S_IFREG, rootStor, mode, uid, gid, ctime, mtime, atime,
+		return super( SVal, self ).__init__( rootStor, mode, uid, gid, ctime, mtime, atime,
 										nlink, name = name, attrs = attrs )
 
 	def __str__( self ):
@@ -364,7 +457,7 @@ class SVal( SItem ):
 				path, _ = parse_token( tok, bVal=defs.no )
 				val = binaryVal
 			self.name = path[-1]
-			self.attrs = attrs if attrs else {}
+			self.attrs = attrs
 			self.val = val
 			logsr.debug( "SVal.ser() reads token: {0}={1}".format( path[-1], val ) )
 			return 1
@@ -410,11 +503,30 @@ class SVal( SItem ):
 
 class Stor( SItem, dict ):
 	'''Section'''
+	itype = S_IFDIR
+	# PathIndex of the tree the section belongs to
+	index = None
+
 	def __init__( self, rootStor, name = '', mode = None, uid = None, gid = None, ctime = None, mtime = None, atime = None,
 				nlink = None ):
 		self.path = ''
 		self.enumMode = None
-		return super( Stor, self ).__init__( S_IFDIR, rootStor, mode, uid, gid, ctime, mtime, atime,
+		# Containing section
+		self.parent = None
+		# Numbers of the tokens and sections in the section itself
+		self.nTokens = 0
+		self.nSections = 0
+		# Counters of the whole subtree: tokens, sections, bytes of the token names
+		# and values, maximum name and value lengths. maxStale is set when an item
+		# of the maximum length is removed, so the maximums must be recomputed.
+		self.tokensAll = 0
+		self.sectionsAll = 0
+		self.keyBytes = 0
+		self.valBytes = 0
+		self.maxKey = 0
+		self.maxVal = 0
+		self.maxStale = False
+		return super( Stor, self ).__init__( rootStor, mode, uid, gid, ctime, mtime, atime,
 										nlink, name = name )
 
 	def __getitem1__( self, key ):
@@ -456,10 +568,104 @@ class Stor( SItem, dict ):
 		if val.storageRef is None:
 			val.setStorageRef( self.storageRef )
 
+		if transaction:
+			transaction.record( self, key )
+		path = self.pathName().rstrip( "/" ) + "/" + key
+		logChange( path )
+		self.relink( key, dict.get( self, key ), val, path )
 		return super( Stor, self ).__setitem__( key, val )
 
 	def __delitem__( self, key ):
+		if transaction:
+			transaction.record( self, key )
+		path = self.pathName().rstrip( "/" ) + "/" + key
+		logChange( path )
+		self.relink( key, dict.get( self, key ), None, path )
 		return super( Stor, self ).__delitem__( key )
+
+	def clear( self ):
+		if hasattr( self, "name" ):
+			logChange( self.pathName() )
+		if self.index is not None:
+			prefix = self.pathName().rstrip( "/" ) + "/"
+			for k, v in self.items():
+				self.index.discard( prefix + k, v )
+		for v in self.values():
+			if isinstance( v, Stor ) and v.parent is self:
+				v.parent = None
+		self.count( -self.tokensAll, -self.sectionsAll, -self.keyBytes, -self.valBytes, self.maxKey, 
+				self.maxVal, self.maxStale )
+		self.nTokens = self.nSections = 0
+		self.maxKey = self.maxVal = 0
+		self.maxStale = False
+		return super( Stor, self ).clear()
+
+	def relink( self, key, old, new, path = None ):
+		'''Updates the path index and the counters when the item at key is 
+		replaced. old is None if the key is added, new is None if it's removed.'''
+		if path is None:
+			path = self.pathName().rstrip( "/" ) + "/" + key
+		for item, sign in ( ( old, -1 ), ( new, 1 ) ):
+			if item is None:
+				continue
+			if self.index is not None:
+				if sign < 0:
+					self.index.discard( path, item )
+				else:
+					self.index.add( path, item )
+			if isinstance( item, Stor ):
+				if sign < 0:
+					if item.parent is self:
+						item.parent = None
+				else:
+					item.parent = self
+				self.nSections += sign
+				self.count( sign * item.tokensAll, sign * ( item.sectionsAll + 1 ),
+						sign * item.keyBytes, sign * item.valBytes, item.maxKey, item.maxVal,
+						item.maxStale )
+			else:
+				self.nTokens += sign
+				size = item.getsize()
+				self.count( sign, 0, sign * len( key ), sign * size, len( key ), size )
+
+	def count( self, dTokens, dSections, dKeyBytes, dValBytes, keyLen, valLen, stale = False ):
+		'''Adds the deltas to the subtree counters of the section and its ancestors. 
+		keyLen and valLen are the maximum lengths of the added or removed items.'''
+		sec = self
+		while sec is not None:
+			sec.tokensAll += dTokens
+			sec.sectionsAll += dSections
+			sec.keyBytes += dKeyBytes
+			sec.valBytes += dValBytes
+			if stale or ( dTokens < 0 and ( keyLen >= sec.maxKey or valLen >= sec.maxVal ) ):
+				sec.maxStale = True
+			elif dTokens > 0:
+				if keyLen > sec.maxKey:
+					sec.maxKey = keyLen
+				if valLen > sec.maxVal:
+					sec.maxVal = valLen
+			sec = sec.parent
+
+	def maxLengths( self ):
+		'''Returns the maximum name and value lengths of the subtree's tokens. Only
+		the subtrees where the longest token has been removed are scanned.'''
+		if self.maxStale:
+			self.maxKey = self.maxVal = 0
+			for k, v in self.items():
+				if isinstance( v, Stor ):
+					mk, mv = v.maxLengths()
+				else:
+					mk, mv = len( k ), v.getsize()
+				self.maxKey = max( self.maxKey, mk )
+				self.maxVal = max( self.maxVal, mv )
+			self.maxStale = False
+		return self.maxKey, self.maxVal
+
+	def __getstate__( self ):
+		# The index is not pickled with snapshots
+		state = self.__dict__.copy()
+		state.pop( "index", None )
+		return state
 	
 	'''def __setstate__(self, state):
 		oldf = self.__setitem__
@@ -506,6 +712,9 @@ class Stor( SItem, dict ):
 			self.cd = stor  # current dict
 			self.tp = type( stor )  # section type
 
+		def __iter__( self ):
+			return self
+
 		def __next__( self ):
 			while 1:
 				try:
@@ -566,29 +775,19 @@ class Stor( SItem, dict ):
 		# 	return self.name
 
 	def numItems( self, itemType = EnumMode.both ):
-		cnt = None
 		if itemType == EnumMode.both:
-			cnt = len( self )
-		elif itemType in ( EnumMode.tokens, EnumMode.tokensAll ):
-			cnt = 0
-			for k in self.keys():
-				if type( self[k] ) != type( self ):
-					cnt += 1
-				elif itemType == EnumMode.tokensAll:
-					cnt += self[k].numItems( EnumMode.tokensAll )
-
-		elif itemType in ( EnumMode.sections, EnumMode.sectionsAll ):
-			cnt = 0
-			for k in self.keys():
-				if type( self[k] ) == type( self ):
-					cnt += 1
-					if itemType == EnumMode.sectionsAll:
-						cnt += self[k].numItems( EnumMode.sectionsAll )
+			return len( self )
+		elif itemType == EnumMode.tokens:
+			return self.nTokens
+		elif itemType == EnumMode.tokensAll:
+			return self.tokensAll
+		elif itemType == EnumMode.sections:
+			return self.nSections
+		elif itemType == EnumMode.sectionsAll:
+			return self.sectionsAll
 		elif itemType == EnumMode.all:
-			cnt = self.numItems( EnumMode.tokensAll ) + self.numItems( EnumMode.sectionsAll )
-		else:
-			raise IKException()
-		return cnt
+			return self.tokensAll + self.sectionsAll
+		raise IKException()
 
 	def getItemAttr( self, path, attrName = None ):
 		item = self.getItem( path )
@@ -669,10 +868,23 @@ class Stor( SItem, dict ):
 		return self
 		# self.markChanged()
 		
+	def makeIndex( self ):
+		'''Makes the section the root of an indexed tree. Full path strings are
+		then looked up by getItem with one hash lookup.'''
+		self.index = PathIndex( self )
+		for k, v in self.items():
+			self.index.add( self.pathName().rstrip( "/" ) + "/" + k, v )
+
 	def getItem(self, path):
 		'''Return a token or section with the given path.'''
 		
 		if type( path ) is str:
+			if self.index is not None and self.index.root is self and \
+					not reNonCanonPath.search( path ):
+				item = self.index.get( path )
+				if item is None:
+					raise IKException( ErrorCode.objectNotExists, path, "Item doesn't exist" )
+				return item
 			lpath, _ = parse_token( path, bVal = defs.auto )
 			return self.getItem( lpath )
 		else:
@@ -690,6 +902,8 @@ class Stor( SItem, dict ):
 	def removeItem( self, tok ):
 		path, _ = parse_token( tok , bVal = defs.auto )
 		if len( path ) == 1: 
+			if path[0] not in self.keys():
+				raise IKException( ErrorCode.objectNotExists, path[0], "Item doesn't exist" )
 			if not ( self.isWritable() and self[path[0]].isWritable() ) :
 				raise IKException( ErrorCode.permissionDenied, tok, "Item is read-only")
 			del self[path[0]]
@@ -712,6 +926,10 @@ class Stor( SItem, dict ):
 		if lres == None:
 			return
 
+		lres.extend( self.genItems( bTree, nIndent, bNovals, relPath, bRecur ) )
+
+	def genItems( self, bTree = False, nIndent = 0, bNovals = True, relPath = None, bRecur = True ):
+		'''Generator of the lines of listItems output.'''
 		pathPrinted = False if bRecur else True
 
 		if bTree:
@@ -722,15 +940,15 @@ class Stor( SItem, dict ):
 						line = "{0}- {1}".format( ' ' * nIndent, nam )
 					else:
 						line = "{0}- {1}  : {2}".format( ' ' * nIndent, nam, val )
-					lres.append( line )
+					yield line
 
 			# Then sections
 			for nam, val in self.items():
 				if type( val ) == type( self ):
 					line = "{0}[{1}]:".format( ' ' * nIndent, nam )
-					lres.append( line )
+					yield line
 					if bRecur:
-						val.listItems( lres = lres, bTree = bTree, nIndent = nIndent + 4,
+						yield from val.genItems( bTree = bTree, nIndent = nIndent + 4,
 									bNovals = bNovals, relPath = relPath, bRecur = bRecur )
 
 		else:
@@ -745,12 +963,12 @@ class Stor( SItem, dict ):
 			for nam, val in self.items():
 				if type( val ) != type( self ):
 					if not pathPrinted:
-						lres.append( "" )
+						yield ""
 						if relPath:
 							if relPath != '.':
-								lres.append( "[" + relPath + "]" )
+								yield "[" + relPath + "]"
 						else:
-							lres.append( "[" + self.pathName() + "]" )
+							yield "[" + self.pathName() + "]"
 						pathPrinted = True
 
 					if bNovals:
@@ -758,14 +976,26 @@ class Stor( SItem, dict ):
 					else:
 						nam = nam.replace( "=", "\\=" )
 						line = "{0} = {1}".format( nam, val )
-					lres.append( line )
+					yield line
 			# res.append("")
 			for nam, val in self.items():
 				if type( val ) == type( self ):
 					if bRecur:
-						val.listItems( lres, bTree, 0, bNovals, relPath, bRecur )
+						yield from val.genItems( bTree, 0, bNovals, relPath, bRecur )
 					else:
-						lres.append( "[" + val.name + "]" )
+						yield "[" + val.name + "]"
+
+	def genTokens( self, relPath = None, bRecur = True ):
+		'''Generator of ( name, value ) pairs of the section's tokens. Values are
+		strings: binary values are decoded as in SVal.__str__. With bRecur the 
+		tokens of subsections follow, with names relative to this section.'''
+		for nam, val in self.items():
+			if type( val ) != type( self ):
+				yield ( relPath + "/" + nam if relPath else nam ), str( val )
+		if bRecur:
+			for nam, val in self.items():
+				if type( val ) == type( self ):
+					yield from val.genTokens( relPath + "/" + nam if relPath else nam, bRecur )
 
 	def getTokensList( self, lres ):
 		for n, v in self.items():
@@ -932,28 +1162,184 @@ class Stor( SItem, dict ):
 
 	def stat( self ):
 		m = OrderedDict()
-		m['num_of_sections'] = self.numItems( EnumMode.sectionsAll )
-		m['num_of_tokens'] = self.numItems( EnumMode.tokensAll )
-		m['max_key_length'] = 0
-		m['max_value_length'] = 0
+		m['num_of_sections'] = self.sectionsAll
+		m['num_of_tokens'] = self.tokensAll
+		m['max_key_length'], m['max_value_length'] = self.maxLengths()
 		m['avg_key_length'] = 0
 		m['avg_value_length'] = 0
-		m['total_size_bytes'] = 0
-		self.enumerate( EnumMode.tokensAll )
-		for nam, val in self:
-			if len( nam ) > m['max_key_length']:
-				m['max_key_length'] = len( nam )
-			if len( val ) > m['max_value_length']:
-				m['max_value_length'] = len( val )
-			m['avg_key_length'] += len( nam )
-			m['avg_value_length'] += len( val )
-			m['total_size_bytes'] += sys.getsizeof( val ) + sys.getsizeof( nam )
-
-		if m['num_of_tokens']:
-			m['avg_key_length'] = round( m['avg_key_length'] / m['num_of_tokens'], 2 )
-			m['avg_value_length'] = round( m['avg_value_length'] / m['num_of_tokens'], 2 )
+		m['total_size_bytes'] = self.keyBytes + self.valBytes
+		if self.tokensAll:
+			m['avg_key_length'] = round( self.keyBytes / self.tokensAll, 2 )
+			m['avg_value_length'] = round( self.valBytes / self.tokensAll, 2 )
 		return m
 
+class SortedKeys:
+	'''Sorted set of strings. The keys are kept in sorted chunks of at most 
+	2 * CHUNK keys, so that adding or removing a key moves only the references 
+	in one chunk. maxes contains the last key of every chunk.'''
+	CHUNK = 512
+
+	def __init__( self ):
+		self.chunks = []
+		self.maxes = []
+		self.size = 0
+
+	def __len__( self ):
+		return self.size
+
+	def add( self, key ):
+		i = bisect_left( self.maxes, key )
+		if i == len( self.maxes ):
+			if not self.chunks:
+				self.chunks.append( [] )
+				self.maxes.append( key )
+			i = len( self.maxes ) - 1
+			chunk = self.chunks[i]
+			chunk.append( key )
+			self.maxes[i] = key
+		else:
+			chunk = self.chunks[i]
+			j = bisect_left( chunk, key )
+			if chunk[j] == key:
+				return
+			chunk.insert( j, key )
+		self.size += 1
+		if len( chunk ) > 2 * self.CHUNK:
+			self.chunks[i:i + 1] = [chunk[:self.CHUNK], chunk[self.CHUNK:]]
+			self.maxes[i:i + 1] = [chunk[self.CHUNK - 1], chunk[-1]]
+
+	def discard( self, key ):
+		i = bisect_left( self.maxes, key )
+		if i == len( self.maxes ):
+			return
+		chunk = self.chunks[i]
+		j = bisect_left( chunk, key )
+		if chunk[j] != key:
+			return
+		del chunk[j]
+		self.size -= 1
+		if chunk:
+			self.maxes[i] = chunk[-1]
+		else:
+			del self.chunks[i]
+			del self.maxes[i]
+
+	def irange( self, start, stop = None ):
+		'''Generator of the keys from start up to, but not including, stop.'''
+		i = bisect_left( self.maxes, start )
+		j = bisect_left( self.chunks[i], start ) if i < len( self.chunks ) else 0
+		while i < len( self.chunks ):
+			for key in self.chunks[i][j:]:
+				if stop is not None and key >= stop:
+					return
+				yield key
+			i += 1
+			j = 0
+
+class PathIndex( dict ):
+	'''Map of the full path names of the items of a tree to the items. The root
+	section and all sections attached under it refer to the index and keep it 
+	up to date when their keys are set, deleted or cleared. The token paths are
+	also kept sorted in tokenPaths for prefix and range queries.'''
+	def __init__( self, root ):
+		self.root = root
+		self.tokenPaths = SortedKeys()
+
+	def add( self, path, item ):
+		'''Adds an item with its subtree.'''
+		self[path] = item
+		if not isinstance( item, Stor ):
+			self.tokenPaths.add( path )
+		else:
+			item.index = self
+			for k, v in item.items():
+				self.add( path + "/" + k, v )
+
+	def discard( self, path, item ):
+		'''Removes an item with its subtree.'''
+		if self.get( path ) is item:
+			del self[path]
+			if not isinstance( item, Stor ):
+				self.tokenPaths.discard( path )
+		if isinstance( item, Stor ):
+			if item.index is self:
+				item.index = None
+			for k, v in item.items():
+				self.discard( path + "/" + k, v )
+
+	def query( self, start, stop = None, prefix = False, limit = None ):
+		'''Returns the list of ( path, token ) pairs of the tokens whose paths
+		start with start, if prefix is True, or are in the range from start up 
+		to stop.'''
+		ret = []
+		if limit is not None and limit <= 0:
+			return ret
+		for path in self.tokenPaths.irange( start, stop ):
+			if prefix and not path.startswith( start ):
+				break
+			ret.append( ( path, self[path] ) )
+			if len( ret ) == limit:
+				break
+		return ret
+
+class Transaction:
+	'''All-or-nothing group of changes in storage. While a transaction is active,
+	Stor records the previous content of every key which is set or deleted, and 
+	markChanged calls are collected. If the block exits normally, the collected 
+	items are marked as changed, once for each backing storage. If it exits with 
+	an exception, the recorded changes are undone in reverse order. A transaction 
+	started within another one joins the outer one.'''
+	
+	# Marks a key which was absent before the change
+	missing = object()
+
+	def __init__( self ):
+		self.journal = []
+		self.marked = {}
+		self.joined = False
+
+	def __enter__( self ):
+		global transaction
+		if transaction:
+			self.joined = True
+		else:
+			transaction = self
+		return self
+
+	def __exit__( self, exc_type, exc_val, exc_tb ):
+		global transaction
+		if self.joined:
+			return False
+		transaction = None
+		if exc_type:
+			self.rollback()
+		else:
+			self.commit()
+		return False
+
+	def record( self, stor, key ):
+		self.journal.append( ( stor, key, dict.get( stor, key, Transaction.missing ) ) )
+
+	def rollback( self ):
+		for stor, key, val in reversed( self.journal ):
+			cur = dict.pop( stor, key, None )
+			if val is not Transaction.missing:
+				dict.__setitem__( stor, key, val )
+			stor.relink( key, cur, None if val is Transaction.missing else val )
+		self.journal = []
+		self.marked = {}
+
+	def commit( self ):
+		refs = {}
+		for item in self.marked.values():
+			item.changed = True
+			ref = item.storageRef if item.storageRef is not None else item
+			refs[id( ref )] = ref
+		for ref in refs.values():
+			ref.markChanged()
+		self.journal = []
+		self.marked = {}
+
 def getstor( rootStor, name = '', mode = 0o755, gid = None, uid = None ):
 	return Stor( rootStor = rootStor, name = name, mode = mode, gid = gid, uid = uid )
 
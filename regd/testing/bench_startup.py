@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+'''********************************************************************
+*	Package:       tests
+*
+*	Module:        bench_startup.py
+*
+*	Created:	   2026-Oct-18 08:10:00 PM
+*
+*	Abstract:	   Benchmark of the command line client's import time.
+*
+*********************************************************************'''
+
+import sys, subprocess as sp, argparse, statistics
+
+# Modules which must not be imported by client commands
+SERVER_MODULES = ( "regd.rgs", "regd.serv", "regd.fs", "regd.stor", "regd.info", "regd.cmds",
+				"multiprocessing", "ipaddress" )
+
+CLIENT_IMPORT = "import regd.cli"
+SERVER_IMPORT = "import regd.cli, regd.rgs"
+
+PROBE = '''
+import sys, time
+t = time.perf_counter()
+{0}
+t = time.perf_counter() - t
+print( t )
+print( " ".join( m for m in {1} if m in sys.modules ) )
+'''
+
+def measure( stmt, runs ):
+	'''Runs stmt in fresh interpreters. Returns the import times in milliseconds
+	and the server modules loaded by stmt.'''
+	times = []
+	loaded = ""
+	for _ in range( runs ):
+		out = sp.check_output( [sys.executable, "-c", PROBE.format( stmt, SERVER_MODULES )],
+							universal_newlines = True )
+		t, _, loaded = out.partition( "\n" )
+		times.append( float( t ) * 1000 )
+	return times, loaded.split()
+
+def main( *kwargs ):
+	parser = argparse.ArgumentParser( description = "Import time of the regd client." )
+	parser.add_argument( "--runs", type = int, default = 20, help = "Number of interpreter runs." )
+	parser.add_argument( "--max-ms", type = float, help = "Fail if the client import median exceeds it." )
+	args = parser.parse_args( *kwargs )
+
+	ret = 0
+	for name, stmt in ( ( "client", CLIENT_IMPORT ), ( "server", SERVER_IMPORT ) ):
+		times, loaded = measure( stmt, args.runs )
+		print( "{0:<8} median: {1:7.1f} ms   min: {2:7.1f} ms".format( name,
+								statistics.median( times ), min( times ) ) )
+		if name == "client":
+			if loaded:
+				print( "Server modules imported by the client: " + ", ".join( loaded ) )
+				ret = 1
+			if args.max_ms and statistics.median( times ) > args.max_ms:
+				print( "Client import time exceeds {0} ms".format( args.max_ms ) )
+				ret = 1
+	return ret
+
+if __name__ == "__main__":
+	sys.exit( main( sys.argv[1:] ) )
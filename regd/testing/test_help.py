@@ -24,7 +24,7 @@ import regd.defs as defs
 import regd.stor as stor
 import regd.util as util
 import regd.tok as tok
-import regd.app as app
+import regd.appsm.app as app
 
 log = None
 tstconf = None
@@ -559,7 +559,8 @@ def filesocket_finish( snames = None ):
 	if snames:
 		ls = snames
 	else:
-		ls = sids
+		# No servers have been started if only the storage tests have run
+		ls = sids or []
 	for i in ls:
 		try:
 			if i:
@@ -12,11 +12,19 @@
 *********************************************************************'''
 __lastedited__ = "2016-01-26 11:27:51"
 
-import unittest, sys, os, pwd, logging, re, time
+import unittest, sys, os, pwd, logging, re, time, threading, random, fnmatch, socket, tempfile
 from configparser import ConfigParser
+from collections import deque
 from regd.testing import test_help as th
 import regd.defs as defs
 import regd.tok as tok
+import regd.util as util
+import regd.fs as fs
+import regd.stor as stor
+import regd.comm as comm
+import regd.cli as cli
+import regd.serv as serv
+from regd.appsm.app import IKException
 test_basic = False
 test_network = False
 test_multiuser = False
@@ -90,6 +98,16 @@ class globInit():
 		currentTest = unittest.TestSuite()
 		currentTest.addTest( TokensTest() )
 		currentTest.addTest( FilesTest() )
+		currentTest.addTest( SnapshotTest() )
+		currentTest.addTest( BatchTest() )
+		currentTest.addTest( TransactionTest() )
+		currentTest.addTest( CodecTest() )
+		currentTest.addTest( ConnectionTest() )
+		currentTest.addTest( StreamTest() )
+		currentTest.addTest( TreeIndexTest() )
+		currentTest.addTest( QueryTest() )
+		currentTest.addTest( FindTest() )
+		currentTest.addTest( CacheTest() )
 
 		testtype = cp["general"].get( "test_type", "1" )
 
@@ -175,6 +193,739 @@ class PrintDot:
 			print( ".", end = '', flush = True )
 		self.cnt += 1
 
+class StorageTest( unittest.TestCase ):
+	'''Base class of the tests which execute commands on a storage instance in
+	the test process.'''
+
+	def __init__( self, methodName = 'runTest' ):
+		self.longMessage = False
+		super( StorageTest, self ).__init__( "runTest" )
+
+	def newStorage( self, snap = None ):
+		self.stg = fs.FS( None, defs.PL_PRIVATE, None, snap = snap )
+		return self.stg
+
+	def doCmd( self, cmd, *params, opts = None ):
+		'''Executes a storage command as listenForMessages does. Returns the result
+		code and the data of the response, or the generator of the frames of a 
+		streamed response.'''
+		m = { "cmd": cmd, "params": list( params ) }
+		if opts:
+			m.update( opts )
+		resp = self.stg.processCmd( m )
+		self.stg.onReplied( m )
+		if not isinstance( resp, ( bytes, bytearray ) ):
+			return resp
+		return tuple( util.parsePacket( resp )[:2] )
+
+	def publish( self, snap ):
+		'''Publishes the storage tree to snap and waits until it's loaded.'''
+		snap.get()
+		time.sleep( snap.quiet )
+		snap.publish( self.stg.fs )
+		snap.get()
+		if snap.loader:
+			snap.loader.join()
+
+class SnapshotTest( StorageTest ):
+	'''Checking that reads from the storage snapshot never miss a write.'''
+
+	def readView( self, snap, cmd, *params ):
+		bresp = fs.FSView.handleCmd( snap, { "cmd": cmd, "params": list( params ) } )
+		return None if bresp is None else tuple( util.parsePacket( bresp )[:2] )
+
+	def testConsistency( self ):
+		snap = fs.Snapshot( 2**20 )
+		self.newStorage( snap )
+		self.doCmd( defs.ADD_TOKEN, "a/b=1", "a/c=2" )
+		# Written just now: the tree isn't published yet, and reads go to storage
+		self.assertIsNone( self.readView( snap, defs.GET_ITEM, "a/b" ) )
+		self.doCmd( defs.GET_ITEM, "a/b" )
+		self.assertIsNone( snap.get(), "Snapshot published right after a write." )
+
+		time.sleep( snap.quiet )
+		snap.publish( self.stg.fs )
+		# The published tree is loaded in the background
+		self.assertIsNone( self.readView( snap, defs.GET_ITEM, "a/b" ) )
+		snap.loader.join()
+		self.assertEqual( self.readView( snap, defs.GET_ITEM, "a/b" ), ( '1', '1' ) )
+		self.assertEqual( self.readView( snap, defs.LIST, "a" ), self.doCmd( defs.LIST, "a" ) )
+
+		for val in ( "3", "4" ):
+			self.doCmd( defs.ADD_TOKEN, "a/b=" + val, opts = { defs.FORCE: True } )
+			self.assertIsNone( self.readView( snap, defs.GET_ITEM, "a/b" ),
+							"Snapshot read returned the value before a write." )
+			self.assertEqual( self.doCmd( defs.GET_ITEM, "a/b" ), ( '1', val ) )
+			self.publish( snap )
+			self.assertEqual( self.readView( snap, defs.GET_ITEM, "a/b" ), ( '1', val ) )
+
+		# Internal commands don't change the snapshot version
+		self.doCmd( defs.ADD_TOKEN, "/_sys/tst=1", opts = { "internal": True } )
+		self.assertIsNotNone( snap.get() )
+		self.doCmd( defs.REMOVE_TOKEN, "a/c" )
+		self.assertIsNone( snap.get() )
+
+	def testTooSmall( self ):
+		snap = fs.Snapshot( 16 )
+		self.newStorage( snap )
+		self.doCmd( defs.ADD_TOKEN, "a/b=1" )
+		self.publish( snap )
+		self.assertIsNone( self.readView( snap, defs.GET_ITEM, "a/b" ) )
+
+	def runTest( self ):
+		log.info( "\nStarting testing storage snapshot." )
+		self.testConsistency()
+		self.testTooSmall()
+
+class BatchTest( StorageTest ):
+	'''Checking that the commands of a batch are executed independently and 
+	answered in order.'''
+
+	def testBatch( self ):
+		self.newStorage()
+		subs = [{ "cmd": defs.ADD_TOKEN, "params": ["a/b=1"] },
+				{ "cmd": defs.GET_ITEM, "params": ["a/b"] },
+				{ "cmd": defs.GET_ITEM, "params": ["a/missing"] },
+				{ "cmd": defs.ADD_TOKEN, "params": ["a/c=2"] },
+				{ "cmd": defs.LIST, "params": ["a"], defs.STREAM: True },
+				{ "cmd": defs.BATCH, "params": [] },
+				{ "cmd": defs.ADD_TOKEN, "params": ["/_sys/tst=1"], "internal": True },
+				"a/d=3"]
+		res, ret = self.doCmd( defs.BATCH, *subs )
+		self.assertEqual( res, '1' )
+		self.assertEqual( [x[0] for x in ret], ['1', '1', '0', '1', '0', '0', '0', '0'] )
+		self.assertEqual( ret[1][1], '1' )
+		# A failed command doesn't stop the batch
+		self.assertEqual( self.doCmd( defs.GET_ITEM, "a/c" ), ( '1', '2' ) )
+
+	def testBinaryCodec( self ):
+		self.newStorage()
+		self.doCmd( defs.ADD_TOKEN, "a/b=1" )
+		util.setCodec( defs.CODEC_BINARY )
+		try:
+			res, ret = self.doCmd( defs.BATCH, { "cmd": defs.GET_ITEM, "params": ["a/b"] },
+										{ "cmd": defs.GET_ITEM, "params": ["a/missing"] } )
+		finally:
+			util.setCodec( defs.CODEC_JSON )
+		self.assertEqual( res, '1' )
+		self.assertEqual( ret[0], ['1', '1'] )
+		self.assertEqual( ret[1][0], '0' )
+
+	def runTest( self ):
+		log.info( "\nStarting testing batches." )
+		self.testBatch()
+		self.testBinaryCodec()
+
+class TransactionTest( StorageTest ):
+	'''Checking that a transaction is applied completely or not at all.'''
+
+	def listAll( self ):
+		# Rollback may change the order of the keys in a section
+		return sorted( self.doCmd( defs.FIND, "/*" )[1] )
+
+	def testRollback( self ):
+		self.newStorage()
+		self.doCmd( defs.ADD_TOKEN, "a/b=1", "a/c=2", "s/t/u=3" )
+		before = self.listAll()
+		res, ret = self.doCmd( defs.TRANSACTION,
+						{ "cmd": defs.ADD_TOKEN, "params": ["a/b=9", "a/n=4"], defs.FORCE: True },
+						{ "cmd": defs.REMOVE_TOKEN, "params": ["a/c"] },
+						{ "cmd": defs.REMOVE_SECTION, "params": ["s"] },
+						{ "cmd": defs.CREATE_SECTION, "params": ["new/sec"] },
+						# Fails: the token exists
+						{ "cmd": defs.ADD_TOKEN, "params": ["a/b=5"] } )
+		self.assertEqual( res, '0' )
+		self.assertIn( "Command 5 failed", ret )
+		self.assertEqual( self.listAll(), before, "Transaction wasn't rolled back." )
+		self.assertEqual( self.doCmd( defs.GET_ITEM, "s/t/u" ), ( '1', '3' ) )
+		self.assertRaises( IKException, self.stg.fs.getItem, "/ses/new" )
+
+	def testCommit( self ):
+		self.newStorage()
+		self.doCmd( defs.ADD_TOKEN, "a/b=1", "a/c=2" )
+		res, _ = self.doCmd( defs.TRANSACTION,
+						{ "cmd": defs.ADD_TOKEN, "params": ["a/b=9"], defs.FORCE: True },
+						{ "cmd": defs.REMOVE_TOKEN, "params": ["a/c"] } )
+		self.assertEqual( res, '1' )
+		self.assertEqual( self.doCmd( defs.GET_ITEM, "a/b" ), ( '1', '9' ) )
+		self.assertRaises( IKException, self.doCmd, defs.GET_ITEM, "a/c" )
+
+	def testNotAllowed( self ):
+		self.newStorage()
+		self.assertRaises( IKException, self.doCmd, defs.TRANSACTION,
+						{ "cmd": defs.ADD_TOKEN, "params": ["a/b=1"] },
+						{ "cmd": defs.GET_ITEM, "params": ["a/b"] } )
+		self.assertRaises( IKException, self.doCmd, defs.GET_ITEM, "a/b" )
+
+	def runTest( self ):
+		log.info( "\nStarting testing transactions." )
+		self.testRollback()
+		self.testCommit()
+		self.testNotAllowed()
+
+class CodecTest( unittest.TestCase ):
+	'''Checking that packets survive encoding, framing, compression and decoding 
+	unchanged.'''
+
+	cmd = { "cmd": defs.ADD_TOKEN, "params": ["a/b=1", "\u0444\u0430\u0439\u043b=\u2713", "x=" + "y" * 5000],
+			defs.FORCE: True, "n": -2**40, "big": 2**70, "f": 0.25, "none": None, "no": False,
+			"nested": [[], {}, ["s", 1, [None]]], "\udcff": "\udcfe" }
+
+	def __init__( self, methodName = 'runTest' ):
+		self.longMessage = False
+		super( CodecTest, self ).__init__( "runTest" )
+
+	def transfer( self, pack, threshold ):
+		'''Frames pack as a packet, delivers it in parts and returns the decoded
+		packet data.'''
+		data, flag = util.compressPack( pack, threshold )
+		frame = util.framePack( data, flag )
+		reader = util.PacketReader()
+		src, dst = socket.socketpair()
+		dst.setblocking( False )
+		try:
+			for i in range( 0, len( frame ), 1000 ):
+				self.assertFalse( reader.receive( dst ) )
+				src.sendall( frame[i:i + 1000] )
+			self.assertTrue( reader.receive( dst ) )
+			data, rflag = reader.take()
+			self.assertEqual( rflag, flag )
+			self.assertFalse( reader.receive( dst ), "Data left after the packet." )
+		finally:
+			src.close()
+			dst.close()
+		return util.parsePacket( util.unpackData( data, rflag ) )
+
+	def testRoundTrip( self ):
+		for codec in ( defs.CODEC_JSON, defs.CODEC_BINARY ):
+			pack = util.createPacket( self.cmd, codec )
+			self.assertEqual( util.packetCodec( pack ), codec )
+			# Uncompressed and compressed with the 'z' header flag
+			for threshold in ( 0, 100 ):
+				self.assertEqual( self.transfer( pack, threshold ), self.cmd,
+								"Packet changed with codec {0}.".format( codec ) )
+		self.assertEqual( util.compressPack( pack, 100 )[1], util.HDR_Z )
+
+		pack = util.encode( ["1", [b"\x00\xff", bytearray( b"z" )]], defs.CODEC_BINARY )
+		self.assertEqual( self.transfer( pack, 0 ), ["1", [b"\x00\xff", b"z"]] )
+
+	def testBadData( self ):
+		pack = util.createPacket( self.cmd, defs.CODEC_BINARY )
+		self.assertRaises( IKException, util.parsePacket, pack + b"N" )
+		self.assertRaises( IKException, util.parsePacket, pack[:-3] )
+		self.assertRaises( IKException, util.parsePacket, util.BIN_MARKER + b"?" )
+
+		z, flag = util.compressPack( pack, 100 )
+		self.assertRaises( IKException, util.unpackData, z[:-4], flag )
+		self.assertRaises( IKException, util.unpackData, b"not zlib", flag )
+		maxLen = util.MAX_PACKET_LEN
+		util.MAX_PACKET_LEN = len( pack ) - 1
+		try:
+			self.assertRaises( IKException, util.unpackData, z, flag )
+			src, dst = socket.socketpair()
+			try:
+				src.sendall( util.framePack( pack ) )
+				self.assertRaises( IKException, util.PacketReader().receive, dst )
+			finally:
+				src.close()
+				dst.close()
+		finally:
+			util.MAX_PACKET_LEN = maxLen
+
+	def runTest( self ):
+		log.info( "\nStarting testing wire codecs." )
+		self.testRoundTrip()
+		self.testBadData()
+
+class EchoServer( serv.RegdServer ):
+	'''Server whose commands return their parameters, for testing the handling 
+	of connections without storage.'''
+	def __init__( self, keepAlive ):
+		self.keepAlive = keepAlive
+		self.compressThreshold = util.COMPRESS_THRESHOLD
+		self.disposed = True
+
+	def _processCmd( self, dcmd, uid, client_address, codec = None ):
+		return util.composeResponse( '1', dcmd["params"] ), False
+
+	def _countBytes( self, *args ):
+		pass
+
+class ConnectionTest( unittest.TestCase ):
+	'''Checking that connection handler workers take packets in any parts.'''
+
+	def __init__( self, methodName = 'runTest' ):
+		self.longMessage = False
+		super( ConnectionTest, self ).__init__( "runTest" )
+
+	def setUp( self ):
+		self.client, self.conn = socket.socketpair()
+		self.client.settimeout( 5 )
+		self.conn.setblocking( False )
+		self.reader = util.PacketReader()
+		self.out = serv.OutputQueue()
+
+	def tearDown( self ):
+		self.client.close()
+		self.conn.close()
+
+	def handle( self, srv ):
+		'''Handles the received data as a worker does.'''
+		cont = srv.handle_packets( self.conn, None, None, self.reader, self.out )
+		self.assertTrue( self.out.send( self.conn ) )
+		return cont
+
+	def pack( self, *params ):
+		return util.framePack( util.createPacket( { "cmd": defs.GET_ITEM, "params": list( params ) } ) )
+
+	def response( self ):
+		data, flag = util.recvPacket( self.client )
+		return util.unpackResponse( util.parsePacket( util.unpackData( data, flag ) ) )
+
+	def testByteByByte( self ):
+		srv = EchoServer( 30 )
+		pack = self.pack( "a/b" )
+		for i in range( len( pack ) - 1 ):
+			self.client.send( pack[i:i + 1] )
+			self.assertTrue( self.handle( srv ) )
+			self.assertFalse( self.out )
+		self.client.send( pack[-1:] )
+		self.assertTrue( self.handle( srv ) )
+		self.assertEqual( self.response(), ( True, "a/b" ) )
+
+	def testJoined( self ):
+		srv = EchoServer( 30 )
+		self.client.sendall( self.pack( "1" ) + self.pack( "2" ) + self.pack( "3" )[:-1] )
+		for _ in range( 3 ):
+			self.assertTrue( self.handle( srv ) )
+		self.assertEqual( [self.response() for _ in range( 2 )], [( True, "1" ), ( True, "2" )] )
+		self.client.sendall( self.pack( "3" )[-1:] )
+		self.assertTrue( self.handle( srv ) )
+		self.assertEqual( self.response(), ( True, "3" ) )
+		# Closed by client between packets and inside a packet
+		self.client.sendall( self.pack( "4" )[:5] )
+		self.client.shutdown( socket.SHUT_WR )
+		self.assertFalse( self.handle( srv ) )
+
+	def testClosedByServer( self ):
+		# With keepAlive 0 a connection is closed after the first packet
+		srv = EchoServer( 0 )
+		self.client.sendall( self.pack( "1" ) )
+		self.assertFalse( self.handle( srv ) )
+		self.assertEqual( self.response(), ( True, "1" ) )
+		srv._closeConnection( self.conn )
+		self.assertEqual( self.client.recv( 1 ), b"" )
+
+		# The pool replaces the connection closed by the server
+		with tempfile.TemporaryDirectory() as tmpdir:
+			sockfile = os.path.join( tmpdir, "sock" )
+			listener = socket.socket( socket.AF_UNIX )
+			try:
+				listener.bind( sockfile )
+				listener.listen( 1 )
+				pool = cli.ConnectionPool( 1 )
+				pool.put( self.client, sockfile )
+				sock, reused = pool.get( sockfile )
+				self.assertFalse( reused, "Connection closed by server is reused." )
+				self.assertIsNot( sock, self.client )
+				sock.close()
+			finally:
+				listener.close()
+
+	def runTest( self ):
+		log.info( "\nStarting testing connection buffering." )
+		for test in ( self.testByteByByte, self.testJoined, self.testClosedByServer ):
+			self.setUp()
+			try:
+				test()
+			finally:
+				self.tearDown()
+
+class StreamTest( StorageTest ):
+	'''Checking that a streamed listing arrives complete and in order.'''
+
+	numTokens = 3500
+	listCmd = { "cmd": defs.LIST, "params": [], defs.RECURS: True }
+
+	def addTokens( self, send ):
+		send( { "cmd": defs.ADD_TOKEN, "params": ["s{0}/k{1}={1}".format( i % 7, i ) 
+												for i in range( self.numTokens )] } )
+
+	def checkFrames( self, frames, whole ):
+		self.assertGreater( len( frames ), self.numTokens // util.STREAM_FRAME_LINES )
+		self.assertEqual( frames[-1], ['1', []], "Stream didn't end with an empty frame." )
+		for res, lines in frames:
+			self.assertEqual( res, '1' )
+			self.assertLessEqual( len( lines ), util.STREAM_FRAME_LINES )
+		self.assertEqual( [x for _, lines in frames for x in lines], whole )
+
+	def testFrames( self ):
+		self.newStorage()
+		self.addTokens( self.stg.processCmd )
+		_, whole = self.doCmd( defs.LIST, opts = { defs.RECURS: True } )
+		frames = self.doCmd( defs.LIST, opts = { defs.RECURS: True, defs.STREAM: True } )
+		self.checkFrames( [util.parsePacket( x ) for x in frames], whole )
+
+	def testChannels( self ):
+		chans = fs.StorageChannels( 2 )
+		self.stg = fs.FS( chans.there, defs.PL_PRIVATE, None )
+		storage = threading.Thread( target = self.stg.listenForMessages, args = ( lambda: None, ),
+								daemon = True )
+		storage.start()
+		try:
+			self.addTokens( chans.send )
+			whole = util.parsePacket( chans.send( self.listCmd ) )[1]
+			stream = chans.send( dict( self.listCmd, **{ defs.STREAM: True } ) )
+			self.assertIsInstance( stream, fs.StorageStream )
+			frames = [util.parsePacket( x ) for x in stream]
+			stream.close()
+			self.checkFrames( frames, whole )
+
+			# A client which doesn't read the frames gets an error instead of the rest
+			queueFrames = fs.STREAM_QUEUE_FRAMES
+			fs.STREAM_QUEUE_FRAMES = 1
+			try:
+				stream = chans.send( dict( self.listCmd, **{ defs.STREAM: True } ), timeout = 0.2 )
+				self.assertEqual( util.parsePacket( next( stream ) )[0], '1' )
+				time.sleep( 0.5 )
+				frames = [util.parsePacket( x ) for x in stream]
+				stream.close()
+			finally:
+				fs.STREAM_QUEUE_FRAMES = queueFrames
+			self.assertEqual( frames[-1][0], '0' )
+
+			# Both channels are free after the streams
+			for _ in range( 2 ):
+				self.assertTrue( chans.free.acquire( False ) )
+			for _ in range( 2 ):
+				chans.free.release()
+		finally:
+			chans.send( { "cmd": fs.FS_STOP } )
+			storage.join( 5 )
+
+	def runTest( self ):
+		log.info( "\nStarting testing streamed responses." )
+		self.testFrames()
+		self.testChannels()
+
+class TreeIndexTest( StorageTest ):
+	'''Checking the data kept up to date along with the storage tree against a 
+	scan of the tree after random changes.'''
+
+	def walk( self, sec, path, items ):
+		'''Collects the items of the subtree of sec by their full paths.'''
+		for k, v in sec.items():
+			p = path.rstrip( "/" ) + "/" + k
+			items[p] = v
+			if isinstance( v, stor.Stor ):
+				self.walk( v, p, items )
+		return items
+
+	def checkIndex( self ):
+		items = self.walk( self.stg.fs, "", {} )
+		index = self.stg.fs.index
+		self.assertEqual( sorted( index ), sorted( items ) )
+		for p, item in items.items():
+			self.assertIs( index[p], item, "Index refers to a wrong item: " + p )
+			if isinstance( item, stor.Stor ):
+				self.assertIs( item.index, index, "Section isn't linked to the index: " + p )
+			self.assertIs( self.stg.fs.getItem( p ), item )
+		self.assertEqual( list( index.tokenPaths.irange( "" ) ), 
+						sorted( p for p, v in items.items() if not isinstance( v, stor.Stor ) ) )
+
+	def checkCounters( self, sec ):
+		'''Compares the counters of sec and its subsections with a scan. Returns
+		the scanned counters of sec.'''
+		toks = secs = keyBytes = valBytes = maxKey = maxVal = 0
+		nToks = nSecs = 0
+		for k, v in sec.items():
+			if isinstance( v, stor.Stor ):
+				nSecs += 1
+				sub = self.checkCounters( v )
+				toks += sub[0]
+				secs += sub[1] + 1
+				keyBytes += sub[2]
+				valBytes += sub[3]
+				maxKey = max( maxKey, sub[4] )
+				maxVal = max( maxVal, sub[5] )
+			else:
+				nToks += 1
+				toks += 1
+				keyBytes += len( k )
+				valBytes += v.getsize()
+				maxKey = max( maxKey, len( k ) )
+				maxVal = max( maxVal, v.getsize() )
+		path = sec.pathName() if hasattr( sec, "name" ) else "/"
+		self.assertEqual( ( sec.nTokens, sec.nSections ), ( nToks, nSecs ), 
+						"Wrong item numbers in " + path )
+		self.assertEqual( ( sec.tokensAll, sec.sectionsAll, sec.keyBytes, sec.valBytes ),
+						( toks, secs, keyBytes, valBytes ), "Wrong subtree counters in " + path )
+		self.assertEqual( sec.maxLengths(), ( maxKey, maxVal ), "Wrong maximum lengths in " + path )
+		return toks, secs, keyBytes, valBytes, maxKey, maxVal
+
+	def change( self, rnd ):
+		'''Makes a random change of the session tokens.'''
+		items = self.walk( self.stg.fs, "", {} )
+		toks = sorted( p for p, v in items.items() if p.startswith( "/ses/" ) and 
+					not isinstance( v, stor.Stor ) )
+		secs = sorted( p for p, v in items.items() if p.startswith( "/ses/" ) and 
+					isinstance( v, stor.Stor ) )
+		newToks = ["/ses/s{0}/s{1}/k{2}={3}".format( rnd.randrange( 3 ), rnd.randrange( 3 ),
+					rnd.randrange( 30 ), "v" * rnd.randrange( 20 ) ) for _ in range( 5 )]
+		op = rnd.randrange( 10 )
+		try:
+			if op < 4:
+				self.doCmd( defs.ADD_TOKEN, *newToks, opts = { defs.FORCE: True } )
+			elif op == 4 and toks:
+				self.doCmd( defs.ADD_TOKEN, rnd.choice( toks ) + "=1", opts = { defs.SUM: True } )
+			elif op == 5 and toks:
+				self.doCmd( defs.REMOVE_TOKEN, *rnd.sample( toks, min( 3, len( toks ) ) ) )
+			elif op == 6 and secs:
+				self.doCmd( defs.REMOVE_SECTION, rnd.choice( secs ) )
+			elif op == 7:
+				self.doCmd( defs.CREATE_SECTION, "/ses/s{0}/e{1}".format( rnd.randrange( 3 ), 
+																		rnd.randrange( 3 ) ) )
+			elif op == 8 and toks:
+				# Fails on the last command and is rolled back
+				res, _ = self.doCmd( defs.TRANSACTION,
+						{ "cmd": defs.ADD_TOKEN, "params": newToks, defs.FORCE: True },
+						{ "cmd": defs.REMOVE_SECTION, "params": secs[:1] },
+						{ "cmd": defs.REMOVE_TOKEN, "params": ["/ses/missing"] } )
+				self.assertEqual( res, '0' )
+			elif op == 9 and rnd.randrange( 5 ) == 0:
+				self.stg.clearSessionTokens()
+		except IKException:
+			# E.g. removing a section which has been removed with its parent
+			pass
+
+	def testRandomChanges( self ):
+		self.newStorage()
+		rnd = random.Random( 7 )
+		for i in range( 400 ):
+			self.change( rnd )
+			if i % 20 == 0:
+				self.checkIndex()
+				self.checkCounters( self.stg.fs )
+		self.checkIndex()
+		self.checkCounters( self.stg.fs )
+		ses = self.stg.fs.getItem( "/ses" )
+		toks, secs, keyBytes, valBytes, _, _ = self.checkCounters( ses )
+		st = ses.stat()
+		self.assertEqual( ( st["num_of_tokens"], st["num_of_sections"], st["total_size_bytes"] ),
+						( toks, secs, keyBytes + valBytes ) )
+		self.assertEqual( ses.numItems( stor.EnumMode.all ), toks + secs )
+
+	def runTest( self ):
+		log.info( "\nStarting testing the storage tree index." )
+		self.testRandomChanges()
+
+class QueryTest( StorageTest ):
+	'''Checking prefix and range queries against a scan of the token paths.'''
+
+	def setUpTokens( self ):
+		self.newStorage()
+		rnd = random.Random( 5 )
+		names = ["/ses/{0}/{1}{2}".format( rnd.choice( "abc" ), rnd.choice( ["b", "bb", "c", "ab"] ), 
+											rnd.randrange( 1000 ) ) for _ in range( 3000 )]
+		self.doCmd( defs.ADD_TOKEN, *[x + "=v" for x in names], opts = { defs.FORCE: True } )
+		# Removing makes chunks of the sorted keys shrink and disappear
+		self.doCmd( defs.REMOVE_TOKEN, *sorted( set( names ) )[100:1200] )
+		self.paths = sorted( set( names ) - set( sorted( set( names ) )[100:1200] ) )
+
+	def query( self, *params, opts = None ):
+		o = { defs.NOVALUES: True }
+		o.update( opts or {} )
+		res, ret = self.doCmd( defs.QUERY, *params, opts = o )
+		self.assertEqual( res, '1' )
+		return ret
+
+	def testPrefix( self ):
+		for prefix in ( "a/", "a/b", "a/bb", "b/ab1", "c", "d", "/ses/" ):
+			full = prefix if prefix[0] == "/" else "/ses/" + prefix
+			self.assertEqual( self.query( prefix ), [x for x in self.paths if x.startswith( full )],
+							"Wrong result for prefix " + prefix )
+		self.assertEqual( self.query( "a/b*" ), self.query( "a/b" ) )
+		self.assertEqual( self.query( "/ses/a/" ), self.query( "a/" ) )
+
+	def testRange( self ):
+		rnd = random.Random( 3 )
+		for _ in range( 50 ):
+			start, stop = sorted( rnd.sample( self.paths, 2 ) )
+			start = start[:rnd.randrange( 6, len( start ) + 1 )]
+			self.assertEqual( self.query( start, stop ), [x for x in self.paths if start <= x < stop],
+							"Wrong result for range {0} - {1}".format( start, stop ) )
+		self.assertEqual( self.query( "b", "a" ), [] )
+
+	def testLimit( self ):
+		self.assertEqual( self.query( "a/", opts = { defs.LIMIT: ["5"] } ), 
+						[x for x in self.paths if x.startswith( "/ses/a/" )][:5] )
+		self.assertEqual( self.query( "a", "c", opts = { defs.LIMIT: ["3"] } ), 
+						[x for x in self.paths if "/ses/a" <= x < "/ses/c"][:3] )
+		self.assertEqual( self.query( "a/", opts = { defs.LIMIT: ["0"] } ), [] )
+		self.assertRaises( IKException, self.query, "a/", opts = { defs.LIMIT: ["x"] } )
+		self.assertRaises( IKException, self.query, "a/", opts = { defs.LIMIT: ["-1"] } )
+		self.assertRaises( IKException, self.query, "a", "b", "c" )
+		self.assertRaises( IKException, self.query, "" )
+		self.assertRaises( IKException, self.query, "a", "" )
+
+	def testValues( self ):
+		self.newStorage()
+		self.doCmd( defs.ADD_TOKEN, "q/a=1", "q/b\\=x=2", "q/c/d=3" )
+		self.assertEqual( self.doCmd( defs.QUERY, "q/" ), 
+						( '1', ["/ses/q/a=1", "/ses/q/b\\=x=2", "/ses/q/c/d=3"] ) )
+
+	def runTest( self ):
+		log.info( "\nStarting testing queries." )
+		self.setUpTokens()
+		self.testPrefix()
+		self.testRange()
+		self.testLimit()
+		self.testValues()
+
+class FindTest( StorageTest ):
+	'''Checking glob and regex searches against a scan of the tokens.'''
+
+	def setUpTokens( self ):
+		self.newStorage()
+		self.toks = {}
+		for i in range( 500 ):
+			path = "/ses/{0}/{1}/k{2}".format( "ab"[i % 2], "xyz"[i % 3], i )
+			self.toks[path] = "val{0}".format( i % 7 )
+		self.doCmd( defs.ADD_TOKEN, *["{0}={1}".format( k, v ) for k, v in self.toks.items()] )
+
+	def find( self, *params, opts = None ):
+		o = { defs.NOVALUES: True }
+		o.update( opts or {} )
+		res, ret = self.doCmd( defs.FIND, *params, opts = o )
+		self.assertEqual( res, '1' )
+		return ret
+
+	def scan( self, match ):
+		return sorted( k for k, v in self.toks.items() if match( k, v ) )
+
+	def testGlob( self ):
+		for patt in ( "a/*", "*/y/*", "b/?/k1*", "a/[xz]/k*0", "nothing/*" ):
+			self.assertEqual( sorted( self.find( patt ) ), 
+							self.scan( lambda k, v: fnmatch.fnmatchcase( k, "/ses/" + patt ) ),
+							"Wrong result for pattern " + patt )
+		self.assertEqual( sorted( self.find( "*", "val[12]" ) ),
+						self.scan( lambda k, v: v in ( "val1", "val2" ) ) )
+		self.assertEqual( sorted( self.find( "/ses/a/*" ) ), sorted( self.find( "a/*" ) ) )
+		self.assertEqual( self.doCmd( defs.FIND, "a/x/k6" ), ( '1', ["/ses/a/x/k6=val6"] ) )
+
+	def testRegex( self ):
+		for patt in ( "/a/.*k1[0-9]$", "k4[0-9]{2}", "^/ses/b/z/" ):
+			self.assertEqual( sorted( self.find( patt, opts = { defs.REGEX: True } ) ),
+							self.scan( lambda k, v: re.search( patt, k ) ),
+							"Wrong result for regex " + patt )
+		self.assertEqual( sorted( self.find( "/y/", "l[34]$", opts = { defs.REGEX: True } ) ),
+						self.scan( lambda k, v: "/y/" in k and v in ( "val3", "val4" ) ) )
+
+	def testCountLimit( self ):
+		self.assertEqual( self.find( "b/*", opts = { defs.COUNT: True } ), 
+						str( len( self.scan( lambda k, v: k.startswith( "/ses/b/" ) ) ) ) )
+		self.assertEqual( self.find( "*", opts = { defs.COUNT: True, defs.LIMIT: ["7"] } ), "7" )
+		self.assertEqual( len( self.find( "*", opts = { defs.LIMIT: ["7"] } ) ), 7 )
+		self.assertEqual( self.find( "*", opts = { defs.LIMIT: ["0"] } ), [] )
+
+	def testErrors( self ):
+		self.assertRaises( IKException, self.find, "" )
+		self.assertRaises( IKException, self.find, "", opts = { defs.REGEX: True } )
+		self.assertRaises( IKException, self.find, "(", opts = { defs.REGEX: True } )
+		self.assertRaises( IKException, self.find, "a", "b", "c" )
+		self.assertRaises( IKException, self.find, "*", opts = { defs.LIMIT: ["x"] } )
+		self.assertRaises( IKException, self.find, "*", opts = { defs.LIMIT: ["-1"] } )
+
+	def testView( self ):
+		'''find gives the same results from a snapshot.'''
+		snap = fs.Snapshot( 2**20 )
+		self.stg.snap = snap
+		self.doCmd( defs.ADD_TOKEN, "/ses/a/new=1" )
+		self.toks["/ses/a/new"] = "1"
+		self.publish( snap )
+		cmd = { "cmd": defs.FIND, "params": ["a/*", "1"] }
+		self.assertEqual( util.parsePacket( fs.FSView.handleCmd( snap, cmd ) )[:2], 
+						list( self.doCmd( defs.FIND, "a/*", "1" ) ) )
+		self.stg.snap = None
+
+	def runTest( self ):
+		log.info( "\nStarting testing searches." )
+		self.setUpTokens()
+		self.testGlob()
+		self.testRegex()
+		self.testCountLimit()
+		self.testErrors()
+		self.testView()
+
+class StorageComm( comm.RegdComm ):
+	'''RegdComm which sends its commands to the storage of a StorageTest.'''
+	def __init__( self, test, **kwargs ):
+		super( StorageComm, self ).__init__( **kwargs )
+		self.test = test
+
+	def _request( self, m ):
+		try:
+			resp = self.test.stg.processCmd( m )
+		except IKException as e:
+			return False, str( e )
+		self.test.stg.onReplied( m )
+		return util.unpackResponse( util.parsePacket( resp ) )
+
+class CacheTest( StorageTest ):
+	'''Checking that the RegdComm token cache sees the changes made by other 
+	clients.'''
+
+	def testInvalidation( self ):
+		cached = StorageComm( self, cacheSize = 10, cacheSync = 0 )
+		other = StorageComm( self )
+		other.addToken( "c/a", "1" )
+		other.addToken( "c/b", "2" )
+		self.assertEqual( cached.getToken( "c/a" ), ( True, "1" ) )
+		self.assertEqual( cached.cache.get( "/ses/c/a" ), ( True, "1" ) )
+		other.addToken( "c/a", "3", defs.FORCE )
+		self.assertEqual( cached.getToken( "c/a" ), ( True, "3" ), 
+						"Cached value read after a write from another client." )
+		self.assertEqual( cached.getToken( "c/b" ), ( True, "2" ) )
+		other.sendCmd( { "cmd": defs.REMOVE_SECTION, "params": ["c"] } )
+		self.assertFalse( cached.getToken( "c/b" )[0], "Removed token read from cache." )
+
+	def testOverflow( self ):
+		cached = StorageComm( self, cacheSize = 10, cacheSync = 0 )
+		other = StorageComm( self )
+		other.addToken( "o/a", "1" )
+		self.assertEqual( cached.getToken( "o/a" ), ( True, "1" ) )
+		changeLog = stor.changeLog
+		stor.changeLog = deque( maxlen = 3 )
+		try:
+			other.addToken( "o/a", "2", defs.FORCE )
+			# The change of o/a drops out of the change log
+			for i in range( 3 ):
+				other.addToken( "o/x{0}".format( i ), str( i ) )
+			cached.syncCache()
+			self.assertFalse( cached.cache.items, "Cache isn't reset after the change log overflow." )
+			self.assertEqual( cached.getToken( "o/a" ), ( True, "2" ) )
+		finally:
+			stor.changeLog = changeLog
+
+	def testBounds( self ):
+		self.newStorage()
+		cached = StorageComm( self, cacheSize = 2, cacheTtl = 0.05, cacheSync = 0 )
+		for nam in ( "a", "b", "c" ):
+			cached.addToken( "l/" + nam, nam )
+		for nam in ( "a", "b", "c", "b" ):
+			cached.getToken( "l/" + nam )
+		self.assertEqual( list( cached.cache.items ), ["/ses/l/c", "/ses/l/b"] )
+		time.sleep( 0.1 )
+		self.assertEqual( cached.cache.get( "/ses/l/b" ), ( False, None ), 
+						"Expired value read from cache." )
+
+	def runTest( self ):
+		log.info( "\nStarting testing the client token cache." )
+		self.newStorage()
+		self.testInvalidation()
+		self.testOverflow()
+		self.testBounds()
+
 class TokensTest( unittest.TestCase ):
 	'''Checking correct handling of various character combinations in various token parts.'''
 
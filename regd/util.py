@@ -10,15 +10,13 @@
 *******************************************************************'''
 __lastedited__ = "2016-06-16 09:39:59"
 
-import os, pwd, logging, re, json, io
+import os, pwd, logging, re, json, io, struct, threading, zlib, fcntl
 import regd.defs as defs
 import regd.appsm.app as app
 import regd.dtlsm.dtl as dtl
 #import pickle
 from regd.appsm.app import IKException, ErrorCode
 
-connLock = None
-
 # Loggers
 log = logging.getLogger( app.APPNAME )
 logtok = logging.getLogger( app.APPNAME + ".tok" )
@@ -101,6 +99,37 @@ def get_filesock_addr( atuser = None, servername = None ):
 		_sockfile = '{0}/.{1}.{2}'.format( sockdir, servername, defs.sockname )
 	return ( sockdir, _sockfile )
 
+def lockInstance( sockfile ):
+	'''Takes the lock of the server instance with the socket file sockfile and
+	writes the process id to the lock file. Returns the descriptor of the lock 
+	file, which must be kept open while the instance runs, or None if the lock 
+	is held by another instance.'''
+	fd = os.open( sockfile + ".lock", os.O_RDWR | os.O_CREAT, 0o644 )
+	try:
+		fcntl.flock( fd, fcntl.LOCK_EX | fcntl.LOCK_NB )
+	except BlockingIOError:
+		os.close( fd )
+		return None
+	os.ftruncate( fd, 0 )
+	os.write( fd, str( os.getpid() ).encode() )
+	return fd
+
+def isInstanceRunning( sockfile ):
+	'''Checks whether the lock of the server instance with the socket file 
+	sockfile is held. The lock is released when all the processes of the 
+	instance have exited.'''
+	try:
+		fd = os.open( sockfile + ".lock", os.O_RDONLY )
+	except FileNotFoundError:
+		return False
+	try:
+		fcntl.flock( fd, fcntl.LOCK_SH | fcntl.LOCK_NB )
+		return False
+	except BlockingIOError:
+		return True
+	finally:
+		os.close( fd )
+
 def parse_sockfile_name( sf ):
 	if sf.endswith( defs.sockname ):
 		sn = os.path.basename( sf )
@@ -125,54 +154,317 @@ def printMap( m, indent ):
 
 	return ret
 
-def recvPack( sock, pack ):
-	data = bytearray()
-	packlen = 0
-	datalen = -1
-
-	while packlen != datalen:
+# Packet header flags. A flag takes the last byte of the 10-byte header, after
+# a length of at most 9 digits.
+# The sender accepts zlib-compressed data in reply
+HDR_ACCEPT_Z = b'a'
+# The packet data is zlib-compressed. The sender also accepts compressed replies.
+HDR_Z = b'z'
+
+# Default minimal size of compressed packet data
+COMPRESS_THRESHOLD = 65536
+# Maximum length of packet data. Headers with larger lengths are rejected before 
+# anything is allocated for the data.
+MAX_PACKET_LEN = 256 * 2**20
+
+def packHeader( hdr ):
+	'''Returns the data length and the flag from the 10-byte packet header.'''
+	flag = bytes( hdr[9:10] )
+	if flag in ( HDR_ACCEPT_Z, HDR_Z ):
+		hdr = hdr[:9]
+	else:
+		flag = None
+		hdr = hdr[:10]
+	try:
+		packlen = int( bytes( hdr ).decode( 'utf-8' ).strip() )
+	except:
+		log.debug( "wrong format: %s" % ( hdr ) )
+		raise IKException( ErrorCode.unknownDataFormat )
+	if packlen < 0 or packlen > MAX_PACKET_LEN:
+		raise IKException( ErrorCode.unknownDataFormat, packlen, 
+						"Packet length exceeds the maximum of {0} bytes".format( MAX_PACKET_LEN ) )
+	return packlen, flag
+
+def packLength( hdr ):
+	'''Returns the data length from the 10-byte packet header.'''
+	return packHeader( hdr )[0]
+
+def unpackData( data, flag ):
+	'''Decompresses the packet data if the header flag says so. The decompressed
+	data are limited to MAX_PACKET_LEN bytes.'''
+	if flag == HDR_Z:
+		d = zlib.decompressobj()
+		try:
+			out = d.decompress( data, MAX_PACKET_LEN )
+		except zlib.error as e:
+			raise IKException( ErrorCode.unknownDataFormat, moreInfo = str( e ) )
+		if d.unconsumed_tail:
+			raise IKException( ErrorCode.unknownDataFormat, moreInfo = 
+				"Decompressed packet exceeds the maximum of {0} bytes".format( MAX_PACKET_LEN ) )
+		if not d.eof:
+			raise IKException( ErrorCode.unknownDataFormat, moreInfo = "Compressed data are incomplete" )
+		return memoryview( out )
+	return data
+
+def compressPack( pack, threshold = COMPRESS_THRESHOLD ):
+	'''Compresses the packet data if it is longer than threshold and compression
+	makes it shorter. Returns the data and the header flag.'''
+	if threshold and len( pack ) > threshold:
+		z = zlib.compress( pack )
+		# The flag doesn't fit into the header of a 10-digit length
+		if len( z ) < min( len( pack ), 10**9 ):
+			return z, HDR_Z
+	return pack, None
+
+def recvExactly( sock, buf ):
+	'''Fills the writable buffer buf with data from the socket.'''
+	view = memoryview( buf )
+	pos = 0
+	while pos < len( view ):
 		try:
-			newdata = sock.recv( 4096 )
+			n = sock.recv_into( view[pos:] )
 		except OSError as e:
 			raise IKException( ErrorCode.clientConnectionError, moreInfo = str(e) )
-
-		data.extend( newdata )
-		datalen = len( data )
-		if not packlen and datalen >= 10:
-			# First chunk
+		if not n:
+			raise IKException( ErrorCode.clientConnectionError, 
+							moreInfo = "Incomplete packet" if pos else "No data received" )
+		pos += n
+
+def recvPacket( sock ):
+	'''Receives a packet. The header is read first, and the data is read into a 
+	buffer of the exact length. Returns a memoryview of the data without the 
+	header and the header flag. Compressed data is returned as is, see unpackData.
+	The length in the header is limited by MAX_PACKET_LEN, so the buffer is 
+	allocated once.'''
+	hdr = bytearray( 10 )
+	recvExactly( sock, hdr )
+	packlen, flag = packHeader( hdr )
+	data = bytearray( packlen )
+	recvExactly( sock, data )
+	return memoryview( data ), flag
+
+class PacketReader:
+	'''Collects a packet from a non-blocking connection as its data arrive. 
+	Once the header is read, the buffer of the exact data length is allocated and
+	the data are received into it, so they are not copied.'''
+	def __init__( self ):
+		self.hdr = bytearray( 10 )
+		self.view = memoryview( self.hdr )
+		self.flag = None
+		self.pos = 0
+		self.inHeader = True
+
+	def receive( self, sock ):
+		'''Reads the available data of the current packet. Returns True if the 
+		packet is complete, and False if the rest of it hasn't arrived yet. Raises
+		EOFError if the connection has been closed by the peer.'''
+		while True:
+			if self.pos == len( self.view ):
+				if not self.inHeader:
+					return True
+				packlen, self.flag = packHeader( self.hdr )
+				self.view = memoryview( bytearray( packlen ) )
+				self.pos = 0
+				self.inHeader = False
+				continue
 			try:
-				packlen = int( data[:10].decode( 'utf-8' ).strip() ) + 10
-			except:
-				log.debug( "wrong format: %s" % ( data.decode( 'utf-8' ) ) )
-				raise IKException( ErrorCode.unknownDataFormat )
-
-	if not packlen:
-		raise IKException( ErrorCode.clientConnectionError, moreInfo = "No data received" )
+				n = sock.recv_into( self.view[self.pos:] )
+			except BlockingIOError:
+				return False
+			if not n:
+				raise EOFError()
+			self.pos += n
+
+	def take( self ):
+		'''Returns the data and the header flag of the complete packet and starts
+		the next one.'''
+		packet = ( self.view, self.flag )
+		self.view = memoryview( self.hdr )
+		self.flag = None
+		self.pos = 0
+		self.inHeader = True
+		return packet
 
+def recvPack( sock, pack ):
+	'''Receives a packet and appends it with the header to pack. Kept for 
+	compatibility: it copies the data once more, recvPacket returns it without
+	copying.'''
+	data, flag = recvPacket( sock )
+	data = unpackData( data, flag )
+	pack.extend( "{0:<10}".format( len( data ) ).encode() )
 	pack.extend( data )
 
-def sendPack( sock, pack ):
-	packlen = "{0:<10}".format( len( pack ) )
+def framePack( pack, flag = None ):
+	'''Prepends the packet header to the data.'''
+	if flag and len( pack ) < 10**9:
+		packlen = "{0:<9}".format( len( pack ) ) + flag.decode()
+	else:
+		packlen = "{0:<10}".format( len( pack ) )
 	cmdpack = bytearray( packlen, encoding = 'utf-8' )
 	cmdpack.extend( pack )
+	return cmdpack
+
+def sendPack( sock, pack, flag = None ):
+	cmdpack = framePack( pack, flag )
 	sock.sendall( cmdpack )
 	return len( cmdpack )
 
-def createPacket( cpars : "in map" ):
-	'''Create a command packet for sending to a regd server.'''
-	if not cpars.get( "cmd", None ):
-		raise IKException( ErrorCode.unknownDataFormat, "Command parameters must have 'cmd' field." )
+def tagResponse( rid, bresp ):
+	'''Wraps the response to a command packet tagged with a request id.'''
+	if bresp[:1] == BIN_MARKER:
+		out = bytearray( BIN_MARKER )
+		binEncode( { defs.REQUEST_ID: rid }, out, None )
+		# Extending the one-item dictionary with the "resp" item
+		out[2:6] = _u32.pack( 2 )
+		binEncode( "resp", out, None )
+		out += memoryview( bresp )[1:]
+		return bytes( out )
+	return b'{"' + defs.REQUEST_ID.encode() + b'": ' + json.dumps( rid ).encode() + \
+			b', "resp": ' + bytes( bresp ) + b'}'
+
+# First byte of packets in the binary codec. JSON text never starts with it.
+BIN_MARKER = b'\x00'
+
+_i64 = struct.Struct( ">q" )
+_f64 = struct.Struct( ">d" )
+_u32 = struct.Struct( ">I" )
+
+def binEncode( obj, out, js ):
+	'''Appends the binary encoding of obj to the bytearray out. Every value is a 
+	type byte followed by the fixed-size value or by a 4-byte length and the 
+	content. Types without a native encoding are converted with js.tojson.'''
+	t = type( obj )
+	if t is str:
+		b = obj.encode( 'utf-8', errors = 'surrogateescape' )
+		out += b's'
+		out += _u32.pack( len( b ) )
+		out += b
+	elif t is bytes or t is bytearray or t is memoryview:
+		out += b'b'
+		out += _u32.pack( len( obj ) )
+		out += obj
+	elif t is list or t is tuple:
+		out += b'l'
+		out += _u32.pack( len( obj ) )
+		for x in obj:
+			binEncode( x, out, js )
+	elif t is dict:
+		out += b'd'
+		out += _u32.pack( len( obj ) )
+		for k, v in obj.items():
+			binEncode( k, out, js )
+			binEncode( v, out, js )
+	elif obj is None:
+		out += b'N'
+	elif t is bool:
+		out += b'T' if obj else b'F'
+	elif t is int:
+		if -2**63 <= obj < 2**63:
+			out += b'i'
+			out += _i64.pack( obj )
+		else:
+			b = str( obj ).encode()
+			out += b'I'
+			out += _u32.pack( len( b ) )
+			out += b
+	elif t is float:
+		out += b'f'
+		out += _f64.pack( obj )
+	else:
+		binEncode( js.tojson( obj ), out, js )
+
+def binDecode( buf, pos, js ):
+	'''Decodes the value at pos in buf. Returns the value and the position after
+	it. Dictionaries are passed through js.fromjson.'''
+	t = buf[pos]
+	pos += 1
+	if t == 0x73:  # 's'
+		n = _u32.unpack_from( buf, pos )[0]
+		pos += 4
+		return str( buf[pos:pos + n], 'utf-8', 'surrogateescape' ), pos + n
+	elif t == 0x62:  # 'b'
+		n = _u32.unpack_from( buf, pos )[0]
+		pos += 4
+		return bytes( buf[pos:pos + n] ), pos + n
+	elif t == 0x6c:  # 'l'
+		n = _u32.unpack_from( buf, pos )[0]
+		pos += 4
+		ret = []
+		for _ in range( n ):
+			v, pos = binDecode( buf, pos, js )
+			ret.append( v )
+		return ret, pos
+	elif t == 0x64:  # 'd'
+		n = _u32.unpack_from( buf, pos )[0]
+		pos += 4
+		ret = {}
+		for _ in range( n ):
+			k, pos = binDecode( buf, pos, js )
+			ret[k], pos = binDecode( buf, pos, js )
+		return js.fromjson( ret ), pos
+	elif t == 0x4e:  # 'N'
+		return None, pos
+	elif t == 0x54:  # 'T'
+		return True, pos
+	elif t == 0x46:  # 'F'
+		return False, pos
+	elif t == 0x69:  # 'i'
+		return _i64.unpack_from( buf, pos )[0], pos + 8
+	elif t == 0x49:  # 'I'
+		n = _u32.unpack_from( buf, pos )[0]
+		pos += 4
+		return int( str( buf[pos:pos + n], 'ascii' ) ), pos + n
+	elif t == 0x66:  # 'f'
+		return _f64.unpack_from( buf, pos )[0], pos + 8
+
+	raise IKException( ErrorCode.unknownDataFormat, t, "Unknown binary codec type" )
+
+# Codec of the responses composed in the current thread. Responses are encoded
+# with the codec of the command packet they answer.
+_codec = threading.local()
+
+def setCodec( codec ):
+	_codec.name = codec
+
+def getCodec():
+	return getattr( _codec, "name", defs.CODEC_JSON )
+
+def packetCodec( data ):
+	'''Returns the codec of a packet.'''
+	return defs.CODEC_BINARY if data[:1] == BIN_MARKER else defs.CODEC_JSON
+
+def encode( obj, codec = None ):
+	'''Encodes obj with codec or with the codec of the current thread.'''
+	if ( codec or getCodec() ) == defs.CODEC_BINARY:
+		out = bytearray( BIN_MARKER )
+		binEncode( obj, out, dtl.Jsonator() )
+		return bytes( out )
 	#return pickle.dumps( cpars, -1)
 	fh = io.StringIO()
 	js = dtl.Jsonator()
-	json.dump( cpars, fh, default = js.tojson )
+	json.dump( obj, fh, default = js.tojson )
 	return fh.getvalue().encode()
+
+def createPacket( cpars : "in map", codec = None ):
+	'''Create a command packet for sending to a regd server.'''
+	if not cpars.get( "cmd", None ):
+		raise IKException( ErrorCode.unknownDataFormat, "Command parameters must have 'cmd' field." )
+	return encode( cpars, codec or defs.CODEC_JSON )
 	
 def parsePacket( data : 'in bytes' ):
-	#return pickle.loads( data )
-	fh = io.StringIO( data.decode() )
+	'''Decodes a packet in any of the codecs.'''
 	js = dtl.Jsonator( ["regd.stor"] )
-	return json.load( fh, object_hook = js.fromjson )
+	if data[:1] == BIN_MARKER:
+		buf = memoryview( data )
+		try:
+			ret, pos = binDecode( buf, 1, js )
+		except ( IndexError, struct.error, ValueError ) as e:
+			raise IKException( ErrorCode.unknownDataFormat, moreInfo = str( e ) )
+		if pos != len( buf ):
+			raise IKException( ErrorCode.unknownDataFormat, moreInfo = "Trailing data in packet" )
+		return ret
+	#return pickle.loads( data )
+	return json.loads( str( data, 'utf-8' ), object_hook = js.fromjson )
 
 def createPacket_old( cpars : 'in map', bpack : 'out bytearray' ):
 	'''Create a command packet for sending to a regd server.'''
@@ -302,10 +594,71 @@ def composeResponse( code = '1', *args ):
 		args = args[0]
 	resp.append( args )
 	#return pickle.dumps( resp, -1 )
-	fh = io.StringIO()
-	js = dtl.Jsonator()
-	json.dump( resp, fh, default = js.tojson )
-	return fh.getvalue().encode()
+	return encode( resp )
+
+def unpackResponse( lres ):
+	'''Converts a parsed response to the ( result, content ) pair returned by
+	cli.Client(). One-element lists in the content are unwrapped.'''
+	if len( lres ) == 2:
+		if type( lres[1] ) is list and len( lres[1] ) == 1:
+			ret = lres[1][0]
+		else:
+			ret = lres[1]
+	else:
+		ret = lres[1:] 
+	return ( lres[0] == '1', ret )
+
+def formatResult( res, ret ):
+	'''Formats the result of a command as one line of the output of the 'shell'
+	command and of the text protocol: '1' or '0' followed by the content. String content has backslashes and 
+	newlines escaped ('\\\\' and '\\n'), other content is written as JSON.'''
+	if type( ret ) is list and len( ret ) == 1:
+		ret = ret[0]
+	if ret is None or ret == []:
+		ret = ""
+	elif type( ret ) is str:
+		ret = ret.replace( "\\", "\\\\" ).replace( "\n", "\\n" )
+	else:
+		ret = json.dumps( ret )
+	return ( "1" if res else "0" ) + ret
+
+# Number of lines in one frame of a streamed response
+STREAM_FRAME_LINES = 1000
+
+def streamFrames( lines, frameLines = STREAM_FRAME_LINES ):
+	'''Generator of the frames of a streamed response. Each frame is a response
+	with a list of lines. The stream ends with a frame with an empty list, or 
+	with an error response if an exception occurs.'''
+	chunk = []
+	try:
+		for line in lines:
+			chunk.append( line )
+			if len( chunk ) == frameLines:
+				yield composeResponse( '1', chunk )
+				chunk = []
+	except IKException as e:
+		yield composeResponse( '0', str( e ) )
+		return
+	except Exception as e:
+		log.error( "Streamed response failed: {0}".format( e ) )
+		yield composeResponse( '0', "Internal error: {0}".format( e ) )
+		return
+	if chunk:
+		yield composeResponse( '1', chunk )
+	yield composeResponse( '1', [] )
+
+def composeListResponse( code, bresps ):
+	'''Composes a response whose content is the list of already composed responses 
+	bresps, without decoding them.'''
+	if getCodec() == defs.CODEC_BINARY:
+		out = bytearray( BIN_MARKER )
+		out += b'l' + _u32.pack( 2 )
+		binEncode( code, out, None )
+		out += b'l' + _u32.pack( len( bresps ) )
+		for x in bresps:
+			out += memoryview( x )[1:]
+		return bytes( out )
+	return b'["' + code.encode() + b'", [' + b', '.join( bresps ) + b']]'
 
 def composeResponse_old( bpack : 'out bytearray', code = '1', *args ):
 	'''Response message has hierachical recursive format and can have any number of nested